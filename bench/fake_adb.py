@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A stand-in for the adb executable, for benchmarks without a phone. The "device" is this machine: its
+# filesystem is the device's and commands run in the local sh, so fixtures are put in a local directory and
+# addressed by their absolute paths. Set through the environment:
+#   FAKE_ADB_DEVICES    comma-separated serials (default: bench)
+#   FAKE_ADB_LATENCY    seconds added to every adb call and every command sent to a shell (default: 0)
+#   FAKE_ADB_BANDWIDTH  bytes per second of the link to the device (default: unlimited)
+#   FAKE_ADB_MERGED     1 to send an interactive shell's stderr down its stdout, as adb does without shell_v2
+
+import os
+import sys
+import shutil
+import subprocess
+import threading
+import time
+
+DEVICES = os.environ.get('FAKE_ADB_DEVICES', 'bench').split(',')
+LATENCY = float(os.environ.get('FAKE_ADB_LATENCY', 0))
+BANDWIDTH = float(os.environ.get('FAKE_ADB_BANDWIDTH', 0))
+MERGED = os.environ.get('FAKE_ADB_MERGED') == '1'
+FEATURES = ('shell_v2', 'cmd', 'stat_v2', 'ls_v2')
+CHUNK = 65536
+
+
+def throttle(size):
+    if BANDWIDTH:
+        time.sleep(size / BANDWIDTH)
+
+
+def copy(source, sink, close=False):
+    # copies a stream over the link as it arrives
+    try:
+        while True:
+            data = source.read1(CHUNK)
+            if not data:
+                break
+            throttle(len(data))
+            sink.write(data)
+            sink.flush()
+    except (OSError, ValueError):
+        pass
+    if close:
+        try:
+            sink.close()
+        except OSError:
+            pass
+
+
+def copy_file(src, dst, preserve):
+    with open(src, 'rb') as source, open(dst, 'wb') as sink:
+        copy(source, sink)
+    if preserve:
+        shutil.copystat(src, dst)
+
+
+def copy_tree(src, dst, preserve):
+    # adb semantics: into an existing directory, the source keeps its name; returns the number of files
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src.rstrip('/')))
+    if not os.path.isdir(src):
+        # like adbd, make the parents of a file that is pushed
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        copy_file(src, dst, preserve)
+        return 1
+    count = 0
+    for parent, dirs, names in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(parent, src))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            copy_file(os.path.join(parent, name), os.path.join(target, name), preserve)
+            count += 1
+    return count
+
+
+def run(cmd, stdin):
+    # a one-off command: its output over the link, and with stdin its input too
+    proc = subprocess.Popen(['sh', '-c', cmd], stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE)
+    if stdin:
+        threading.Thread(target=copy, args=(sys.stdin.buffer, proc.stdin, True), daemon=True).start()
+    copy(proc.stdout, sys.stdout.buffer)
+    return proc.wait()
+
+
+def interactive():
+    # an interactive shell, as the shell pool keeps open: every line sent to it pays the latency
+    proc = subprocess.Popen(['sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT if MERGED else subprocess.PIPE)
+    readers = [threading.Thread(target=copy, args=(proc.stdout, sys.stdout.buffer))]
+    if not MERGED:
+        readers.append(threading.Thread(target=copy, args=(proc.stderr, sys.stderr.buffer)))
+    for reader in readers:
+        reader.start()
+    try:
+        for line in sys.stdin.buffer:
+            time.sleep(LATENCY)
+            proc.stdin.write(line)
+            proc.stdin.flush()
+        proc.stdin.close()
+    except OSError:
+        pass
+    for reader in readers:
+        reader.join()
+    return proc.wait()
+
+
+def devices(long):
+    lines = ['List of devices attached']
+    for number, serial in enumerate(DEVICES, 1):
+        details = f' product:bench model:Bench_Device device:bench transport_id:{number}' if long else ''
+        lines.append(f'{serial}\tdevice{details}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def main(args):
+    time.sleep(LATENCY)
+    if args[:1] == ['-s']:
+        if args[1] not in DEVICES:
+            sys.stderr.write(f"adb: device '{args[1]}' not found\n")
+            return 1
+        args = args[2:]
+    elif args and args[0] not in ('devices', 'track-devices', 'start-server', 'kill-server') and len(DEVICES) > 1:
+        sys.stderr.write('adb: more than one device/emulator\n')
+        return 1
+    command, args = (args[0], args[1:]) if args else ('help', [])
+    if command == 'devices':
+        sys.stdout.write(devices('-l' in args))
+    elif command == 'track-devices':
+        listing = ''.join(devices('-l' in args).splitlines(True)[1:]).strip('\n') + '\n'
+        sys.stdout.write(f'{len(listing.encode()):04x}{listing}')
+        sys.stdout.flush()
+        while True:
+            time.sleep(3600)
+    elif command == 'features':
+        sys.stdout.write('\n'.join(FEATURES) + '\n')
+    elif command == 'shell':
+        args = [arg for arg in args if arg not in ('-T', '-x')]
+        return run(' '.join(args), True) if args else interactive()
+    elif command == 'exec-out':
+        return run(' '.join(args), False)
+    elif command == 'exec-in':
+        return run(' '.join(args), True)
+    elif command in ('push', 'pull'):
+        preserve = command == 'push' or '-a' in args
+        paths = [arg for arg in args if not arg.startswith('-')]
+        if len(paths) < 2:
+            sys.stderr.write(f'adb: {command} requires an argument\n')
+            return 1
+        try:
+            count = sum(copy_tree(src, paths[-1], preserve) for src in paths[:-1])
+        except OSError as ex:
+            sys.stderr.write(f'adb: error: {ex}\n')
+            return 1
+        sys.stdout.write(f'{paths[0]}: {count} file{"s" if count != 1 else ""} {command}ed.\n')
+    elif command in ('start-server', 'kill-server', 'reconnect', 'root', 'unroot', 'wait-for-device'):
+        pass
+    else:
+        sys.stderr.write(f'fake adb: {command} is not supported\n')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# A stand-in for the adb server, for benchmarking the server backend without a phone. Like fake_adb.py the
+# "device" is this machine, reached through the smart-socket services ServerBackend uses: host requests,
+# sync, shell v2 and exec. Every request and every sync command pays --latency seconds, and everything sent
+# to or from the device is held to --bandwidth bytes per second.
+
+import os
+import sys
+import argparse
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+
+FEATURES = 'shell_v2,cmd,stat_v2,ls_v2'
+CHUNK = 65536
+SHELL_STDIN, SHELL_STDOUT, SHELL_STDERR, SHELL_EXIT, SHELL_CLOSE_STDIN = 0, 1, 2, 3, 4
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+
+class Handler(socketserver.BaseRequestHandler):
+    # one connection: host requests until one of them takes the connection over
+
+    def throttle(self, size):
+        if self.server.bandwidth:
+            time.sleep(size / self.server.bandwidth)
+
+    def send(self, data):
+        self.throttle(len(data))
+        self.request.sendall(data)
+
+    def receive(self, size):
+        data = recv_exact(self.request, size)
+        self.throttle(size)
+        return data
+
+    def okay(self, payload=None):
+        data = b'OKAY'
+        if payload is not None:
+            data += b'%04x' % len(payload) + payload
+        self.request.sendall(data)
+
+    def fail(self, message):
+        message = message.encode()
+        self.request.sendall(b'FAIL' + b'%04x' % len(message) + message)
+
+    def devices(self, long):
+        lines = []
+        for number, serial in enumerate(self.server.devices, 1):
+            details = f' product:bench model:Bench_Device device:bench transport_id:{number}' if long else ''
+            lines.append(f'{serial}\tdevice{details}\n')
+        return ''.join(lines).encode()
+
+    def handle(self):
+        serial = None
+        while True:
+            try:
+                request = recv_exact(self.request, int(recv_exact(self.request, 4), 16)).decode()
+            except (EOFError, ValueError, OSError):
+                return
+            time.sleep(self.server.latency)
+            if request in ('host:devices', 'host:devices-l'):
+                return self.okay(self.devices(request.endswith('-l')))
+            if request.startswith('host:track-devices'):
+                self.okay()
+                devices = self.devices(request.endswith('-l'))
+                try:
+                    self.request.sendall(b'%04x' % len(devices) + devices)
+                    # nothing ever changes: hold the connection until the client drops it
+                    self.request.recv(1)
+                except OSError:
+                    pass
+                return
+            if request.startswith('host-serial:') and request.endswith(':features'):
+                return self.okay(FEATURES.encode())
+            if request.startswith('host:transport:'):
+                serial = request.split(':', 2)[2]
+                if serial not in self.server.devices:
+                    return self.fail(f"device '{serial}' not found")
+                self.okay()
+                continue
+            if request == 'host:transport-any':
+                serial = self.server.devices[0]
+                self.okay()
+                continue
+            if serial is None:
+                return self.fail(f'unknown host service {request}')
+            if request == 'sync:':
+                self.okay()
+                return self.sync()
+            if request.startswith('exec:'):
+                self.okay()
+                return self.exec(request[5:])
+            if request.startswith('shell,v2,raw:') or request.startswith('shell,v2:'):
+                self.okay()
+                return self.shell(request.split(':', 1)[1])
+            return self.fail(f'unknown service {request}')
+
+    def exec(self, cmd):
+        proc = subprocess.Popen(['sh', '-c', cmd], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        try:
+            while True:
+                data = proc.stdout.read1(CHUNK)
+                if not data:
+                    break
+                self.send(data)
+        except OSError:
+            proc.kill()
+        proc.wait()
+
+    def shell(self, cmd):
+        proc = subprocess.Popen(['sh', '-c', cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        lock = threading.Lock()
+
+        def feed():
+            try:
+                while True:
+                    packet, size = struct.unpack('<BI', recv_exact(self.request, 5))
+                    data = self.receive(size)
+                    if packet == SHELL_STDIN:
+                        proc.stdin.write(data)
+                    elif packet == SHELL_CLOSE_STDIN:
+                        break
+            except (EOFError, OSError, struct.error):
+                pass
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        def forward(stream, packet):
+            while True:
+                data = stream.read1(CHUNK)
+                if not data:
+                    return
+                with lock:
+                    self.send(struct.pack('<BI', packet, len(data)) + data)
+
+        threading.Thread(target=feed, daemon=True).start()
+        readers = [threading.Thread(target=forward, args=(proc.stdout, SHELL_STDOUT)),
+                   threading.Thread(target=forward, args=(proc.stderr, SHELL_STDERR))]
+        try:
+            for reader in readers:
+                reader.start()
+            for reader in readers:
+                reader.join()
+            self.request.sendall(struct.pack('<BIB', SHELL_EXIT, 1, proc.wait() & 255))
+        except OSError:
+            proc.kill()
+            proc.wait()
+
+    def sync(self):
+        while True:
+            try:
+                command = recv_exact(self.request, 4)
+                path = recv_exact(self.request, struct.unpack('<I', recv_exact(self.request, 4))[0]).decode()
+            except (EOFError, OSError):
+                return
+            time.sleep(self.server.latency)
+            if command == b'QUIT':
+                return
+            if command in (b'LIST', b'LIS2'):
+                self.list(path, command == b'LIS2')
+            elif command == b'STAT':
+                try:
+                    info = os.lstat(path)
+                    self.request.sendall(b'STAT' + struct.pack('<3I', info.st_mode, info.st_size & 0xffffffff,
+                                                               int(info.st_mtime)))
+                except OSError:
+                    self.request.sendall(b'STAT' + bytes(12))
+            elif command == b'STA2':
+                try:
+                    info = os.stat(path)
+                    self.request.sendall(b'STA2' + self.stat2(0, info))
+                except OSError as ex:
+                    self.request.sendall(b'STA2' + struct.pack('<I', ex.errno or 2) + bytes(64))
+            elif command == b'RECV':
+                self.recv(path)
+            elif command == b'SEND':
+                self.receive_file(path)
+            else:
+                return
+
+    @staticmethod
+    def stat2(error, info):
+        return struct.pack('<IQQIIIIQqqq', error, info.st_dev, info.st_ino, info.st_mode, info.st_nlink,
+                           info.st_uid, info.st_gid, info.st_size, int(info.st_atime), int(info.st_mtime),
+                           int(info.st_ctime))
+
+    def list(self, path, v2):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        out = []
+        for name in ['.', '..'] + names:
+            try:
+                info = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            encoded = name.encode()
+            if v2:
+                out.append(b'DNT2' + self.stat2(0, info) + struct.pack('<I', len(encoded)) + encoded)
+            else:
+                out.append(b'DENT' + struct.pack('<4I', info.st_mode, info.st_size & 0xffffffff,
+                                                 int(info.st_mtime), len(encoded)) + encoded)
+        out.append(b'DONE' + bytes(72 if v2 else 16))
+        self.send(b''.join(out))
+
+    def recv(self, path):
+        try:
+            with open(path, 'rb') as file:
+                while True:
+                    data = file.read(CHUNK)
+                    if not data:
+                        break
+                    self.send(b'DATA' + struct.pack('<I', len(data)) + data)
+            self.request.sendall(b'DONE' + bytes(4))
+        except OSError as ex:
+            message = str(ex).encode()
+            self.request.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+
+    def receive_file(self, spec):
+        path, mode = spec.rsplit(',', 1)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(path, 'wb')
+        except OSError as ex:
+            file = None
+            error = str(ex)
+        mtime = None
+        while True:
+            command = recv_exact(self.request, 4)
+            size = struct.unpack('<I', recv_exact(self.request, 4))[0]
+            if command == b'DONE':
+                mtime = size
+                break
+            data = self.receive(size)
+            if file:
+                file.write(data)
+        if file is None:
+            message = error.encode()
+            self.request.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+            return
+        file.close()
+        os.chmod(path, int(mode) & 0o7777)
+        os.utime(path, (mtime, mtime))
+        self.request.sendall(b'OKAY' + bytes(4))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, devices, latency=0, bandwidth=0):
+        self.devices = devices
+        self.latency = latency
+        self.bandwidth = bandwidth
+        super().__init__(('127.0.0.1', port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A fake adb server whose device is this machine.')
+    parser.add_argument('--port', type=int, default=5037)
+    parser.add_argument('--devices', default='bench', help='comma-separated serials')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0, help='bytes per second, 0 for unlimited')
+    args = parser.parse_args()
+    server = Server(args.port, args.devices.split(','), args.latency, args.bandwidth)
+    # the harness waits for this line before it connects
+    print(f'listening on {server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmarks the engine of main.py against a fake device: fake_adb.py for the subprocess backend and
+# fake_server.py for the server backend, both serving fixtures built in a temporary directory. Results go
+# to a JSON file that a later run can be compared against:
+#   python3 bench/run.py --output before.json
+#   python3 bench/run.py --output after.json --compare before.json
+
+import os
+import sys
+import argparse
+import json
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main  # noqa: E402
+
+SCHEMA = 1
+DEVICE = 'bench'
+FAKE_ADB = os.path.join(HERE, 'fake_adb.py')
+FAKE_SERVER = os.path.join(HERE, 'fake_server.py')
+# a child process that imports the app, makes its backend and lists one directory, as the app does at startup
+STARTUP_SCRIPT = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import main
+main.backend = main.make_backend(sys.argv[2], sys.argv[3] == 'server')
+if sys.argv[3] == 'server':
+    main.backend.address = ('127.0.0.1', int(sys.argv[4]))
+main.fetch_listing(sys.argv[5], sys.argv[6])
+main.backend.close()
+'''
+
+
+def build_fixtures(root, sizes, small_files, large_size):
+    # the device side of the benchmark; every fixture is only built once per run
+    for size in sizes:
+        path = os.path.join(root, f'list_{size}')
+        os.makedirs(path)
+        for number in range(size):
+            open(os.path.join(path, f'file_{number:06d}.txt'), 'w').close()
+    # a chain of directories, each with a few siblings, to walk down and back up
+    path = os.path.join(root, 'nav')
+    for depth in range(8):
+        os.makedirs(path)
+        for number in range(16):
+            open(os.path.join(path, f'item_{number}'), 'w').close()
+        path = os.path.join(path, f'level_{depth}')
+    os.makedirs(path)
+    small = os.path.join(root, 'small')
+    os.makedirs(small)
+    block = os.urandom(4096)
+    for number in range(small_files):
+        with open(os.path.join(small, f'small_{number:05d}.bin'), 'wb') as file:
+            file.write(block)
+    with open(os.path.join(root, 'large.bin'), 'wb') as file:
+        left = large_size
+        while left:
+            chunk = os.urandom(min(left, 1 << 20))
+            file.write(chunk)
+            left -= len(chunk)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def result(name, backend, unit, samples, **extra):
+    return dict(name=name, backend=backend, unit=unit, median=statistics.median(samples), min=min(samples),
+                max=max(samples), samples=samples, **extra)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    return time.perf_counter() - start, value
+
+
+def bench_listing(kind, root, sizes, repeat):
+    results = []
+    for size in sizes:
+        path = os.path.join(root, f'list_{size}')
+        totals = []
+        firsts = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            batches = main.backend.iterdir(DEVICE, path)
+            count = len(next(batches))
+            firsts.append(time.perf_counter() - start)
+            count += sum(len(batch) for batch in batches)
+            totals.append(time.perf_counter() - start)
+            if count != size:
+                raise RuntimeError(f'listed {count} of {size} entries in {path}')
+        results.append(result(f'listing_{size}', kind, 's', totals, entries=size))
+        results.append(result(f'listing_{size}_first_batch', kind, 's', firsts, entries=size))
+    return results
+
+
+def bench_navigation(kind, root, repeat):
+    # what the file pane does for every click into or out of a directory: check it, then list it
+    path = os.path.join(root, 'nav')
+    chain = [path]
+    for depth in range(8):
+        path = os.path.join(path, f'level_{depth}')
+        chain.append(path)
+    samples = []
+    for _ in range(repeat):
+        for path in chain + chain[-2::-1]:
+            elapsed, _ = timed(lambda target: (main.ADBfm.get_file_status(target, DEVICE),
+                                               main.fetch_listing(DEVICE, target)), path)
+            samples.append(elapsed)
+    return [result('navigation_round_trip', kind, 's', samples, steps=len(samples) // repeat)]
+
+
+def transfer(manager, direction, src, dst):
+    job = manager.submit(main.Transfer(DEVICE, direction, src, dst))
+    job.done.wait()
+    if job.state != main.Transfer.DONE:
+        raise RuntimeError(f'{direction} {src} -> {dst}: {job.state} {job.error.decode(errors="replace")}')
+    return job
+
+
+def bench_transfers(kind, root, local, repeat, small_files, large_size, compress):
+    manager = main.TransferManager(main.backend, workers=4, compress=compress)
+    large = os.path.join(root, 'large.bin')
+    small = os.path.join(root, 'small')
+    results = []
+    cases = (('large', large, large_size, 1), ('small', small, small_files * 4096, small_files))
+    for label, src, size, files in cases:
+        for direction in ('pull', 'push'):
+            samples = []
+            archived = None
+            for number in range(repeat):
+                target = os.path.join(local if direction == 'pull' else root, f'{label}_{direction}_{number}')
+                if direction == 'pull':
+                    elapsed, job = timed(transfer, manager, 'pull', src, target)
+                else:
+                    # push the copy the pull left locally, so both directions move the same tree
+                    source = os.path.join(local, f'{label}_pull_0')
+                    elapsed, job = timed(transfer, manager, 'push', source, target)
+                archived = job.archived
+                samples.append(elapsed)
+                if direction == 'push' and os.path.isdir(target):
+                    shutil.rmtree(target)
+                elif direction == 'push':
+                    os.remove(target)
+            results.append(result(f'{direction}_{label}', kind, 's', samples, bytes=size, files=files,
+                                  mb_per_s=size / statistics.median(samples) / 1e6,
+                                  files_per_s=files / statistics.median(samples),
+                                  archived=archived))
+    return results
+
+
+def bench_startup(kind, root, repeat, port):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, os.path.dirname(HERE), FAKE_ADB, kind, str(port),
+                        DEVICE, os.path.join(root, 'nav')], check=True)
+        samples.append(time.perf_counter() - start)
+    return [result('startup_to_first_listing', kind, 's', samples)]
+
+
+def run_backend(kind, args, root, local):
+    port = None
+    server = None
+    if kind == 'server':
+        port = free_port()
+        server = subprocess.Popen([sys.executable, FAKE_SERVER, '--port', str(port), '--devices', DEVICE,
+                                   '--latency', str(args.latency), '--bandwidth', str(args.bandwidth)],
+                                  stdout=subprocess.PIPE)
+        server.stdout.readline()
+    main.backend = main.make_backend(FAKE_ADB, kind == 'server')
+    if port:
+        main.backend.address = ('127.0.0.1', port)
+    main.listings = main.ListingCache()
+    try:
+        results = bench_listing(kind, root, args.sizes, args.repeat)
+        results += bench_navigation(kind, root, args.repeat)
+        results += bench_transfers(kind, root, os.path.join(local, kind), args.repeat, args.small_files,
+                                   args.large_size, args.compress)
+        results += bench_startup(kind, root, args.repeat, port)
+    finally:
+        main.backend.close()
+        if server:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    for item in results:
+        line = f'{item["backend"]:<10} {item["name"]:<32} {item["median"] * 1000:10.1f} ms'
+        if 'mb_per_s' in item:
+            line += f'  {item["mb_per_s"]:8.1f} MB/s  {item["files_per_s"]:8.0f} files/s'
+        print(line)
+
+
+def compare(results, path):
+    # ratios of the medians, new over old: below 1 is faster
+    with open(path, 'rt') as file:
+        old = {(item['backend'], item['name']): item for item in json.load(file)['results']}
+    print(f'\ncompared with {path}:')
+    for item in results:
+        before = old.get((item['backend'], item['name']))
+        if before and before['median']:
+            print(f'{item["backend"]:<10} {item["name"]:<32} {before["median"] * 1000:10.1f} ms -> '
+                  f'{item["median"] * 1000:10.1f} ms  x{item["median"] / before["median"]:.2f}')
+
+
+def benchmark():
+    parser = argparse.ArgumentParser(description='Benchmark ADB Explorer against a fake device.')
+    parser.add_argument('--backends', default='subprocess,server', help='comma-separated: subprocess, server')
+    parser.add_argument('--sizes', default='10,1000,100000', help='entries of the listed directories')
+    parser.add_argument('--small-files', type=int, default=2000, help='4 KiB files in the many-files transfer')
+    parser.add_argument('--large-size', type=int, default=32, help='MiB of the single-file transfer')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per adb call or request')
+    parser.add_argument('--bandwidth', type=float, default=40e6, help='bytes per second, 0 for unlimited')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compress', action='store_true', help='compress archived transfers')
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--compare', help='an earlier results file')
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+    args.large_size <<= 20
+    os.environ.update(FAKE_ADB_DEVICES=DEVICE, FAKE_ADB_LATENCY=str(args.latency),
+                      FAKE_ADB_BANDWIDTH=str(args.bandwidth))
+    work = tempfile.mkdtemp(prefix='adbfm-bench-')
+    try:
+        root = os.path.join(work, 'device')
+        local = os.path.join(work, 'local')
+        build_fixtures(root, args.sizes, args.small_files, args.large_size)
+        results = []
+        for kind in args.backends.split(','):
+            os.makedirs(os.path.join(local, kind))
+            results += run_backend(kind, args, root, local)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    report = {'schema': SCHEMA, 'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'parameters': {'sizes': args.sizes, 'small_files': args.small_files, 'large_size': args.large_size,
+                             'latency': args.latency, 'bandwidth': args.bandwidth, 'repeat': args.repeat,
+                             'compress': args.compress},
+              'results': results}
+    with open(args.output, 'wt') as file:
+        json.dump(report, file, indent=1)
+    print_results(results)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -16,7 +16,7 @@
 
 from tkinter import *
 from tkinter import ttk, messagebox, filedialog
-from natsort import natsorted
+from natsort import natsort_keygen
 import pathlib
 import subprocess
 import re
@@ -24,12 +24,3496 @@ import os
 import sys
 import tempfile
 import shutil
+import tarfile
+import gzip
 import webbrowser
 import traceback
 import json
+import shlex
+import argparse
+import threading
+import queue
+import uuid
+import time
+import socket
+import struct
+import heapq
+import bisect
+import itertools
+import hashlib
+import operator
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-# ensure the script is running in the proper directory
-os.chdir(os.path.dirname(__file__))
+
+# when the app was started, for the time to the first paint of the file pane
+LAUNCHED = time.perf_counter()
+# seconds the first paint should stay under
+FIRST_PAINT_BUDGET = 1.0
+
+name_key = natsort_keygen(key=str.lower)
+entry_key = operator.attrgetter('key')
+
+# what the file pane can be sorted by; every key falls back to the name so the order is stable
+SORT_KEYS = {
+    'name': entry_key,
+    'size': lambda entry: (entry.size, entry.key),
+    'mtime': lambda entry: (entry.mtime, entry.key),
+    'type': lambda entry: (not entry.is_dir(), entry.extension(), entry.key),
+}
+
+# adb invocations kept for the operations log, and the upper bounds in ms of its latency histogram buckets
+COMMAND_LOG_SIZE = 4096
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# the lanes of the Scheduler: what the user waits on, and transfers and background scans
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+# the lane of the device calls made on each thread, interactive unless the thread runs a bulk function
+lanes = threading.local()
+
+
+def bulk(function):
+    # marks the device calls made while function runs as bulk traffic, for the threads of transfers and scans
+    def run(*args, **kwargs):
+        previous = getattr(lanes, 'name', INTERACTIVE)
+        lanes.name = BULK
+        try:
+            return function(*args, **kwargs)
+        finally:
+            lanes.name = previous
+    return run
+
+
+class Command:
+    # one timed adb invocation, added to a CommandLog when it ends; as a context manager it ends with the block,
+    # taking its exit status from the exception that ended it unless one was set
+
+    def __init__(self, log, device, kind, command, scheduler=None, lane=None):
+        self.log = log
+        self.device = device
+        self.kind = kind
+        self.command = command
+        self.time = time.time()
+        self.scheduler = scheduler
+        self.lane = lane
+        # seconds spent waiting for its turn on the device, which the wall time leaves out
+        self.waited = scheduler.admit(self) if scheduler else 0
+        self.start = time.perf_counter()
+        self.wall = None
+        self.bytes = 0
+        self.status = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, tb):
+        if self.status is None:
+            self.status = getattr(error, 'returncode', -1) if error is not None else 0
+        self.finish()
+
+    def finish(self):
+        if self.wall is not None:
+            return
+        self.wall = time.perf_counter() - self.start
+        if self.scheduler:
+            self.scheduler.release(self)
+        if self.log is not None:
+            self.log.add(self)
+
+    def queued(self, seconds):
+        # time spent waiting after its turn came, e.g. for a free shell session, counted as waited all the same
+        self.waited += seconds
+        if self.scheduler:
+            self.scheduler.queued(self, seconds)
+
+    def count(self, size):
+        # bytes moved so far; bulk ones may be held back by the scheduler
+        self.bytes += size
+        if self.scheduler:
+            self.scheduler.throttle(self, size)
+
+    def as_dict(self):
+        return {'time': self.time, 'device': self.device, 'kind': self.kind, 'command': self.command,
+                'wall': self.wall, 'bytes': self.bytes, 'status': self.status, 'lane': self.lane,
+                'waited': self.waited}
+
+    def describe(self):
+        text = f'{time.strftime("%H:%M:%S", time.localtime(self.time))} {self.wall * 1000:8.1f} ms  {self.kind}'
+        if self.device:
+            text += f' [{self.device}]'
+        text += f' {self.command}'
+        if self.bytes:
+            text += f' ({human_size(self.bytes)})'
+        if self.waited >= 0.001:
+            text += f' after {self.waited * 1000:.1f} ms in the {self.lane} lane'
+        if self.status:
+            text += f' exit {self.status}'
+        return text
+
+
+class CommandLog:
+    # the last size adb invocations in a ring buffer, for the operations log window and its export
+
+    def __init__(self, size=COMMAND_LOG_SIZE):
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, command):
+        with self.lock:
+            self.records.append(command)
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def histograms(self):
+        # {kind: (calls, median ms, 95th percentile ms, bytes, [calls per bucket, the last one over the top])}
+        kinds = {}
+        for command in self.snapshot():
+            kinds.setdefault(command.kind, []).append(command)
+        histograms = {}
+        for kind, commands in sorted(kinds.items()):
+            times = sorted(command.wall * 1000 for command in commands)
+            buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+            for ms in times:
+                buckets[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+            histograms[kind] = (len(times), times[len(times) // 2], times[min(len(times) * 95 // 100, len(times) - 1)],
+                                sum(command.bytes for command in commands), buckets)
+        return histograms
+
+    def export(self, path):
+        # one JSON object per line, oldest first
+        with open(path, 'wt') as f:
+            for command in self.snapshot():
+                f.write(json.dumps(command.as_dict()) + '\n')
+
+
+class Scheduler:
+    # every device call of a backend takes its turn here, per device. Calls in the interactive lane, made for
+    # the user, never wait for bulk ones; calls in the bulk lane start only while no interactive call is running
+    # on their device, or after YIELD seconds, and the bytes they move pause while one is. A thread already
+    # holding a turn on a device gets another one straight away, so nested calls can't wait on themselves
+    YIELD = 2.0
+
+    def __init__(self, limits=None, cap=0):
+        # calls at a time per device and lane
+        self.limits = limits or {INTERACTIVE: 8, BULK: 4}
+        # bytes per second per device for the bulk lane, 0 for no cap
+        self.cap = cap
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # device -> {lane: calls running}, {lane: calls waiting}
+        self.running = {}
+        self.waiting = {}
+        # (device, lane) -> [calls, seconds waited, longest wait, deepest queue]
+        self.metrics = {}
+        # device -> (when, bytes the bulk lane may still send then)
+        self.buckets = {}
+        self.held = threading.local()
+
+    def admit(self, command):
+        # blocks until the command may start, returning the seconds it waited
+        if command.device is None or command.lane is None:
+            return 0
+        device, lane = command.device, command.lane
+        held = self.held.__dict__.setdefault('devices', {})
+        start = time.perf_counter()
+        with self.changed:
+            running = self.running.setdefault(device, {INTERACTIVE: 0, BULK: 0})
+            waiting = self.waiting.setdefault(device, {INTERACTIVE: 0, BULK: 0})
+            metrics = self.metrics.setdefault((device, lane), [0, 0.0, 0.0, 0])
+            waiting[lane] += 1
+            metrics[3] = max(metrics[3], waiting[lane])
+            deadline = start + self.YIELD
+            while not held.get(device):
+                now = time.perf_counter()
+                yielding = lane == BULK and (running[INTERACTIVE] or waiting[INTERACTIVE]) and now < deadline
+                if running[lane] < self.limits[lane] and not yielding:
+                    break
+                self.changed.wait(deadline - now if yielding else None)
+            waiting[lane] -= 1
+            running[lane] += 1
+            held[device] = held.get(device, 0) + 1
+            command.held = held
+            waited = time.perf_counter() - start
+            metrics[0] += 1
+            metrics[1] += waited
+            metrics[2] = max(metrics[2], waited)
+        return waited
+
+    def queued(self, command, seconds):
+        if command.device is None or command.lane is None:
+            return
+        with self.lock:
+            metrics = self.metrics[(command.device, command.lane)]
+            metrics[1] += seconds
+            metrics[2] = max(metrics[2], command.waited)
+
+    def release(self, command):
+        if command.device is None or command.lane is None:
+            return
+        with self.changed:
+            self.running[command.device][command.lane] -= 1
+            command.held[command.device] -= 1
+            self.changed.notify_all()
+
+    def throttle(self, command, size):
+        # holds bulk bytes back while an interactive call runs on the device, and to the cap
+        if command.lane != BULK or command.device is None:
+            return
+        deadline = time.perf_counter() + self.YIELD
+        with self.changed:
+            while self.running[command.device][INTERACTIVE] and time.perf_counter() < deadline:
+                self.changed.wait(deadline - time.perf_counter())
+            cap = self.cap
+            if not cap:
+                return
+            now = time.perf_counter()
+            when, allowance = self.buckets.get(command.device, (now, cap))
+            # a second's worth of bytes can build up, no more
+            allowance = min(cap, allowance + (now - when) * cap) - size
+            self.buckets[command.device] = (now, allowance)
+        if allowance < 0:
+            time.sleep(-allowance / cap)
+
+    def stats(self):
+        # a line per device and lane: calls, time waited and queues, now and at their deepest
+        lines = []
+        with self.lock:
+            for (device, lane), (calls, waited, longest, deepest) in sorted(self.metrics.items()):
+                lines.append(f'{device} {lane}: {calls} calls, {self.running[device][lane]} running, '
+                             f'{self.waiting[device][lane]} queued (at most {deepest}), waited '
+                             f'{waited / max(calls, 1) * 1000:.1f} ms on average, {longest * 1000:.1f} ms at most')
+        if self.cap:
+            lines.append(f'bulk lane capped at {human_size(self.cap)}/s per device')
+        return '\n'.join(lines)
+
+
+class CountingStream:
+    # a pipe's stdin or stdout, adding the bytes that go through it to a Command
+
+    def __init__(self, file, command):
+        self.file = file
+        self.command = command
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.command.count(len(data))
+        return data
+
+    def read1(self, size=-1):
+        data = self.file.read1(size)
+        self.command.count(len(data))
+        return data
+
+    def write(self, data):
+        self.command.count(len(data))
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class TimedPipe:
+    # a pipe from Backend.pipe, recorded once communicate has collected its exit status
+
+    def __init__(self, pipe, command):
+        self.pipe = pipe
+        self.command = command
+        self.stdin = pipe.stdin and CountingStream(pipe.stdin, command)
+        self.stdout = pipe.stdout and CountingStream(pipe.stdout, command)
+
+    @property
+    def returncode(self):
+        return self.pipe.returncode
+
+    def poll(self):
+        return self.pipe.poll()
+
+    def terminate(self):
+        self.pipe.terminate()
+
+    def communicate(self):
+        try:
+            return self.pipe.communicate()
+        finally:
+            self.command.status = self.pipe.returncode
+            self.command.finish()
+
+    def close(self):
+        # stops a pipe that was left before communicate, e.g. on cancel, so its scheduler turn is given back
+        if self.command.wall is None:
+            if self.pipe.poll() is None:
+                self.pipe.terminate()
+            self.communicate()
+
+
+class ShellSession:
+    # a long-lived `adb shell` process that runs one framed command at a time
+    # seconds to wait for the stderr frame once stdout is complete
+    FRAME_TIMEOUT = 5
+
+    def __init__(self, adb_path, device):
+        self.device = device
+        self.token = uuid.uuid4().hex
+        self.used = False
+        self.sequence = 0
+        # set once a stderr frame went missing, after which stderr can't be told apart between commands
+        self.lost = False
+        self.proc = subprocess.Popen([adb_path, '-s', device, 'shell'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # stderr is drained on its own thread so a chatty command can't fill the pipe and stall stdout
+        self.stderr = queue.Queue()
+        threading.Thread(target=self.pump_stderr, daemon=True).start()
+
+    def pump_stderr(self):
+        for line in iter(self.proc.stderr.readline, b''):
+            self.stderr.put(line)
+        self.stderr.put(None)
+
+    def alive(self):
+        return not self.lost and self.proc.poll() is None
+
+    def lines(self, cmd):
+        # yields the raw stdout lines of cmd as they arrive, then sets returncode and errors;
+        # raises OSError/EOFError if the session has died
+        self.used = True
+        self.sequence += 1
+        marker = f'{self.token}:{self.sequence}'
+        # the stderr frame goes first, so where adb merges stderr into stdout (no shell_v2) it shows up on
+        # stdout ahead of the exit status instead of being waited for on a stderr that never gets it
+        self.proc.stdin.write(f'( {cmd} ) </dev/null; __status=$?; printf \'\\n%s\\n\' {marker} >&2; '
+                              f'printf \'\\n%s %d\\n\' {self.token} $__status\n'.encode())
+        self.proc.stdin.flush()
+        token = self.token.encode()
+        self.returncode = None
+        merged = False
+        blank = False
+        for line in iter(self.proc.stdout.readline, b''):
+            # the newline the stderr frame put in front of the exit status frame
+            if blank and line in (b'\n', b'\r\n'):
+                blank = False
+                continue
+            blank = False
+            if line.startswith(token):
+                rest = line[len(token):].strip()
+                if rest.startswith(b':'):
+                    merged = blank = True
+                    continue
+                self.returncode = int(rest)
+                break
+            yield line
+        if self.returncode is None:
+            raise EOFError(f'shell session for {self.device} closed')
+        if merged:
+            # whatever the command wrote to stderr is in its stdout
+            self.errors = b''
+            return
+        err = []
+        marker = marker.encode()
+        deadline = time.monotonic() + self.FRAME_TIMEOUT
+        while True:
+            try:
+                line = self.stderr.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.lost = True
+                break
+            if line is None:
+                raise EOFError(f'shell session for {self.device} closed')
+            if line.startswith(marker):
+                break
+            err.append(line)
+        self.errors = self.unframe(err)
+
+    def run(self, cmd):
+        # returns (returncode, stdout, stderr)
+        out = list(self.lines(cmd))
+        # drop the newline the frame put in front of the token
+        return self.returncode, self.unframe(out), self.errors
+
+    @staticmethod
+    def unframe(lines):
+        data = b''.join(lines).replace(b'\r\n', b'\n')
+        return data[:-1] if data.endswith(b'\n') else data
+
+    def leftover_stderr(self):
+        err = []
+        while True:
+            try:
+                line = self.stderr.get(timeout=1)
+            except queue.Empty:
+                break
+            if line is None:
+                break
+            err.append(line)
+        return b''.join(err)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class ShellPool:
+    # keeps a few shell sessions open per device so a command costs a round-trip instead of a process spawn;
+    # calls in the bulk lane get one session fewer than the others, so there is always one left for the user
+
+    def __init__(self, adb_path, size=3):
+        self.adb = adb_path
+        self.size = size
+        self.idle = {}
+        self.open = {}
+        # device -> sessions in use by the bulk lane
+        self.bulk = {}
+        self.freed = threading.Condition()
+
+    def acquire(self, device, command=None):
+        # a session for command, whose wait for one, if any, counts as time waited for its turn
+        lane = command.lane if command else None
+        start = time.perf_counter()
+        session = None
+        with self.freed:
+            while True:
+                if lane != BULK or self.bulk.get(device, 0) < max(self.size - 1, 1):
+                    idle = self.idle.setdefault(device, [])
+                    while idle and not session:
+                        session = idle.pop()
+                        if not session.alive():
+                            self.open[device] -= 1
+                            session.close()
+                            session = None
+                    if session or self.open.get(device, 0) < self.size:
+                        break
+                self.freed.wait()
+            if not session:
+                self.open[device] = self.open.get(device, 0) + 1
+            if lane == BULK:
+                self.bulk[device] = self.bulk.get(device, 0) + 1
+        if command:
+            command.queued(time.perf_counter() - start)
+        if session:
+            session.lane = lane
+            return session
+        try:
+            session = ShellSession(self.adb, device)
+        except Exception:
+            with self.freed:
+                self.open[device] -= 1
+                if lane == BULK:
+                    self.bulk[device] -= 1
+                self.freed.notify_all()
+            raise
+        session.lane = lane
+        return session
+
+    def release(self, session, broken=False):
+        with self.freed:
+            if session.lane == BULK:
+                self.bulk[session.device] -= 1
+            if broken or not session.alive():
+                self.open[session.device] -= 1
+                session.close()
+            else:
+                self.idle[session.device].append(session)
+            # a bulk call can't take a session given back by an interactive one, so wake everyone
+            self.freed.notify_all()
+
+    def run(self, device, cmd, command=None):
+        # returns (returncode, stdout, stderr) for a shell command string
+        while True:
+            session = self.acquire(device, command)
+            stale = session.used
+            try:
+                result = session.run(cmd)
+            except (OSError, EOFError):
+                self.release(session, True)
+                # a session that sat idle may have been killed by a reconnect, so retry on a fresh one,
+                # but a fresh session dying means the device itself is gone
+                if stale:
+                    continue
+                returncode = session.proc.poll()
+                return returncode or 255, b'', session.leftover_stderr()
+            self.release(session)
+            return result
+
+    def stream(self, device, cmd, command=None):
+        # yields the stdout lines of cmd without their newline as they arrive, and raises CalledProcessError
+        # at the end on a non-zero exit status
+        while True:
+            session = self.acquire(device, command)
+            stale = session.used
+            held = None
+            try:
+                for line in session.lines(cmd):
+                    if held is not None:
+                        yield held.rstrip(b'\r\n')
+                    held = line
+            except (OSError, EOFError):
+                self.release(session, True)
+                if stale and held is None:
+                    continue
+                raise subprocess.CalledProcessError(255, cmd, b'', session.leftover_stderr())
+            except GeneratorExit:
+                # the rest of the output was never read, so the session can't be reused
+                self.release(session, True)
+                raise
+            returncode, errors = session.returncode, session.errors
+            self.release(session)
+            break
+        # the last line is the newline the frame put in front of the token, or ends with it
+        if held not in (None, b'\n', b'\r\n'):
+            yield held.rstrip(b'\r\n')
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, b'', errors)
+
+    def drop(self, device):
+        # closes the idle sessions of a device, e.g. after a reconnect or root/unroot restarted adbd
+        with self.freed:
+            idle = self.idle.pop(device, [])
+            self.open[device] = self.open.get(device, 0) - len(idle)
+        for session in idle:
+            session.close()
+
+    def close(self):
+        for device in list(self.idle):
+            self.drop(device)
+
+
+class DirEntry:
+    # one directory entry; for symlinks, kind is the kind of the target and target is the link text
+    __slots__ = ('name', 'kind', 'mode', 'size', 'mtime', 'target', 'key')
+
+    DIR = 'd'
+    FILE = 'f'
+    OTHER = 'o'
+
+    def __init__(self, name, kind, mode=0, size=0, mtime=0, target=None):
+        self.name = name
+        self.kind = kind
+        self.mode = mode
+        self.size = size
+        self.mtime = mtime
+        self.target = target
+        # the natural sort key is worked out once, listings are sorted and searched by it
+        self.key = name_key(name)
+
+    def __repr__(self):
+        return f'DirEntry({self.name!r}, {self.kind!r}, {self.size}, {self.mtime}, {self.target!r})'
+
+    @staticmethod
+    def kind_of(mode):
+        if mode & 0o170000 == 0o040000:
+            return DirEntry.DIR
+        elif mode & 0o170000 == 0o100000:
+            return DirEntry.FILE
+        return DirEntry.OTHER
+
+    def is_dir(self):
+        return self.kind == DirEntry.DIR
+
+    def is_file(self):
+        return self.kind == DirEntry.FILE
+
+    def is_link(self):
+        return self.target is not None
+
+    def is_hidden(self):
+        return self.name.startswith('.')
+
+    def extension(self):
+        stem, dot, extension = self.name.rpartition('.')
+        return extension.lower() if stem and not self.is_dir() else ''
+
+    def label(self):
+        # the name with an `ls -F` style suffix, as shown in the file pane
+        file_type = self.mode & 0o170000
+        if self.is_link() or file_type == 0o120000:
+            return self.name + '@'
+        elif file_type == 0o040000:
+            return self.name + '/'
+        elif file_type == 0o010000:
+            return self.name + '|'
+        elif file_type == 0o140000:
+            return self.name + '='
+        elif self.mode & 0o111:
+            return self.name + '*'
+        return self.name
+
+
+# prints the kind of what each symlink argument points at and its target, in the format parse_listing reads
+LINK_SCRIPT = ('for l; do if [ -d "$l" ]; then k=d; elif [ -e "$l" ]; then k=f; else k=o; fi; '
+               'printf "@%s/%s\\n" "$k" "$l"; readlink "$l"; done')
+
+
+def listing_command(ls_dir):
+    # one shell round-trip that stats every entry, then resolves the kind and target of each symlink;
+    # the trailing slash makes find follow ls_dir itself when it is a symlink
+    quoted = shlex.quote(ls_dir.rstrip('/') + '/')
+    return (f'find {quoted} -mindepth 1 -maxdepth 1 -exec stat -c %f/%s/%Y/%n {{}} + && '
+            f'find {quoted} -mindepth 1 -maxdepth 1 -type l -exec sh -c {shlex.quote(LINK_SCRIPT)} sh {{}} +')
+
+
+def parse_listing(out, entries=None):
+    # returns {name: DirEntry}; link lines fill in the entries already present in entries
+    entries = {} if entries is None else entries
+    parse_listing_lines(out.decode(errors='replace').replace('\r', '').split('\n'), entries)
+    return entries
+
+
+def parse_listing_lines(lines, entries):
+    # adds the entries of stat lines to entries and returns them; a link line and the target line after it
+    # complete an entry that is already there
+    added = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.startswith('@'):
+            kind, path = line[1:].split('/', 1)
+            entry = entries.get(path.rpartition('/')[2])
+            target = lines[i] if i < len(lines) else ''
+            i += 1
+            if entry:
+                entry.kind = kind
+                entry.target = target
+        elif line:
+            try:
+                mode, size, mtime, path = line.split('/', 3)
+                mode = int(mode, 16)
+                size = int(size)
+                mtime = int(mtime)
+            except ValueError:
+                continue
+            name = path.rpartition('/')[2]
+            entries[name] = DirEntry(name, DirEntry.kind_of(mode), mode, size, mtime)
+            added.append(entries[name])
+    return added
+
+
+LISTING_BATCH = 256
+LISTING_BATCH_MAX = 16384
+
+# directories with at least this many files, averaging less than this size, go as one tar stream instead of
+# file by file, where the per-file round-trips of adb push/pull would dominate
+ARCHIVE_MIN_FILES = 64
+ARCHIVE_MAX_AVERAGE = 1 << 20
+# device-side (compress, decompress) commands per archive compression
+ARCHIVE_FILTERS = {'': ('', ''), 'gzip': ('gzip -1', 'gzip -dc'), 'zstd': ('zstd -1 -q -c', 'zstd -d -q -c')}
+
+# files from this size on are pulled in ranges that survive a dropped link, RESUME_CHUNK bytes per dd
+RESUME_MIN_SIZE = 64 << 20
+RESUME_CHUNK = 16 << 20
+RESUME_BLOCK = 1 << 16
+RESUME_RETRIES = 10
+
+# large files with these suffixes open in the viewer, which reads VIEW_WINDOW bytes at a time, instead of
+# being pulled whole
+TEXT_SUFFIXES = ('.txt', '.log', '.csv', '.json', '.xml')
+VIEW_WINDOW = 256 << 10
+
+# how many times files that don't match their checksums after a verified transfer are sent again
+VERIFY_RETRIES = 2
+
+# bytes of quoted arguments per device command, within the 0xffff bytes a request to the adb server can carry
+COMMAND_BYTES = 60000
+
+
+def add_range(ranges, start, end):
+    # merges [start, end) into a sorted list of disjoint [start, end) ranges
+    merged = []
+    for first, last in sorted(ranges + [[start, end]]):
+        if merged and first <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def command_batches(args, limit=COMMAND_BYTES):
+    # splits args into lists whose quoted, encoded length stays within limit bytes, for one command each
+    batch = []
+    length = 0
+    for arg in args:
+        size = len(shlex.quote(arg).encode()) + 1
+        if batch and length + size > limit:
+            yield batch
+            batch = []
+            length = 0
+        batch.append(arg)
+        length += size
+    if batch:
+        yield batch
+
+
+def pump(source, sink, close=False):
+    # copies source into sink on a thread, e.g. between adb and a local zstd
+    def copy():
+        try:
+            shutil.copyfileobj(source, sink, 65536)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if close:
+                sink.close()
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    return thread
+
+
+def extract(tar, member, path):
+    # refuses members that would land outside path where this Python can check for it
+    if hasattr(tarfile, 'data_filter'):
+        tar.extract(member, path, filter='data')
+    else:
+        tar.extract(member, path)
+
+
+def parse_devices(out):
+    # [(serial, state, {key: value})] from adb devices output; with -l the state is followed by key:value
+    # columns, and some states take several words, e.g. "no permissions (...); see [...]"
+    devices = []
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or line.startswith(('List of devices', '*')):
+            continue
+        info = {}
+        while len(fields) > 2 and re.match(r'[a-z_]+:\S', fields[-1]):
+            key, value = fields.pop().split(':', 1)
+            info[key] = value
+        devices.append((fields[0], ' '.join(fields[1:]), info))
+    return devices
+
+
+def read_device_lists(stream):
+    # yields the device list every time the adb server reports a change on a track-devices stream
+    while True:
+        length = stream.read(4)
+        if len(length) < 4:
+            return
+        yield parse_devices(stream.read(int(length, 16)).decode(errors='replace'))
+
+
+class Backend:
+    # how the file manager reaches a device; call, check_output, listdir and size are built on run
+    # the CommandLog every adb invocation is timed into, and the Scheduler each one takes its turn from, if any
+    log = None
+    scheduler = None
+
+    def timed(self, device, kind, command, scheduled=True):
+        lane = None
+        if scheduled:
+            lane = BULK if kind in ('pull', 'push') else getattr(lanes, 'name', INTERACTIVE)
+        return Command(self.log, device, kind, command, self.scheduler, lane)
+
+    def run(self, device, cmd):
+        # returns (returncode, stdout, stderr) for a shell command string
+        raise NotImplementedError
+
+    def devices(self):
+        # returns [(serial, state, {key: value}), ...] as parsed by parse_devices
+        raise NotImplementedError
+
+    def track_devices(self):
+        # starts following the adb server's device list, returning an object with the stdout and terminate of
+        # a Popen whose stdout is a track-devices stream
+        raise NotImplementedError
+
+    def transfer(self, transfer, interval):
+        # runs a push or pull, updating transfer.transferred as it goes; returns True on success
+        raise NotImplementedError
+
+    def open_pipe(self, device, cmd, direction):
+        # starts cmd with its raw stdout to read ('pull') or its stdin to write ('push'), returning an object
+        # with the stdin, stdout, poll, terminate and communicate of a Popen
+        raise NotImplementedError
+
+    def pipe(self, device, cmd, direction, scheduled=True):
+        # a pipe that stays open, like a tail -f, isn't scheduled, or it would hold its lane's turn for good
+        command = self.timed(device, 'exec', cmd, scheduled)
+        try:
+            return TimedPipe(self.open_pipe(device, cmd, direction), command)
+        except BaseException:
+            command.finish()
+            raise
+
+    def device_features(self, device):
+        return set()
+
+    def call(self, device, args):
+        return self.run(device, shlex.join(args))[0]
+
+    def check_output(self, device, args):
+        cmd = shlex.join(args)
+        returncode, out, err = self.run(device, cmd)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, out, err)
+        return out
+
+    def stream(self, device, cmd):
+        # yields the stdout lines of cmd without their newline, and raises CalledProcessError at the end on a
+        # non-zero exit status; backends that can, yield them as they arrive
+        returncode, out, err = self.run(device, cmd)
+        yield from out.replace(b'\r', b'').split(b'\n')
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, out, err)
+
+    def find_lines(self, device, cmd):
+        # yields the decoded stdout lines of a find over a whole tree. Unreadable directories make find fail
+        # without spoiling the rest, so its complaints and exit status are dropped on the device
+        for line in self.stream(device, f'{cmd} 2>/dev/null || true'):
+            yield line.decode(errors='replace')
+
+    def iterdir(self, device, path):
+        # yields the entries of path in unsorted batches as they arrive; the first batch is small so the pane
+        # can show something quickly, later ones grow. Entries already yielded may be completed in place, e.g.
+        # the target of a symlink, in which case an empty batch is yielded
+        entries = {}
+        lines = []
+        limit = LISTING_BATCH
+        try:
+            for line in self.stream(device, listing_command(path)):
+                lines.append(line.decode(errors='replace'))
+                # a link line is never separated from the target line after it
+                if len(lines) >= limit and not lines[-1].startswith('@'):
+                    yield parse_listing_lines(lines, entries)
+                    lines = []
+                    limit = min(limit * 4, LISTING_BATCH_MAX)
+        except subprocess.CalledProcessError:
+            # entries that vanish or can't be stat'ed mid-listing make find fail, but the rest is still good
+            if not entries and not lines:
+                raise
+        yield parse_listing_lines(lines, entries)
+
+    def listdir(self, device, path):
+        # returns the unsorted entries of path
+        return [entry for batch in self.iterdir(device, path) for entry in batch]
+
+    def entries(self, device, paths):
+        # the DirEntries for paths in one directory, in one round-trip; missing paths are left out
+        quoted = ' '.join(shlex.quote(path) for path in paths)
+        out = self.run(device, f'stat -c %f/%s/%Y/%n {quoted}; '
+                               f'find {quoted} -maxdepth 0 -type l -exec sh -c {shlex.quote(LINK_SCRIPT)} sh {{}} +')[1]
+        return list(parse_listing(out).values())
+
+    def manifest(self, device, path):
+        # {relative path: (size, mtime)} of every regular file under path, in one pass over the device
+        manifest = {}
+        try:
+            for line in self.stream(device, f'cd {shlex.quote(path)} && find . -type f -exec stat -c %s/%Y/%n {{}} +'):
+                try:
+                    size, mtime, name = line.decode(errors='replace').split('/', 2)
+                    manifest[name[2:]] = (int(size), int(mtime))
+                except ValueError:
+                    continue
+        except subprocess.CalledProcessError:
+            # as with listings, files that vanish mid-walk make find fail without spoiling the rest
+            if not manifest:
+                raise
+        return manifest
+
+    def checksums(self, device, path):
+        # {relative posix path: md5} of every regular file under a device directory, or {'': md5} for a file,
+        # in one round-trip
+        quoted = shlex.quote(path)
+        cmd = f'if [ -d {quoted} ]; then cd {quoted} && find . -type f -exec md5sum {{}} +; else md5sum {quoted}; fi'
+        sums = {}
+        try:
+            for line in self.stream(device, cmd):
+                digest, name = parse_md5sum(line)
+                sums[name[2:] if name.startswith('./') else ''] = digest
+        except subprocess.CalledProcessError:
+            # files that can't be read are left out, so they count as different
+            pass
+        return sums
+
+    def scan(self, device, path):
+        # (files, bytes) under a device directory in one round-trip, or None if path isn't a directory
+        quoted = shlex.quote(path)
+        out = self.run(device, f'[ -d {quoted} ] && cd {quoted} && find . -type f | wc -l && du -sk . | cut -f1')[1]
+        try:
+            files, size = out.split()
+            return int(files), int(size) * 1024
+        except ValueError:
+            return None
+
+    def archive_compression(self, device, direction, compress):
+        # the compression for a tar stream with device, '' for none, or None if the device can't do one
+        if device not in self.tools:
+            out = self.run(device, 'for tool in tar gzip zstd; do command -v $tool >/dev/null && echo $tool; done')[1]
+            self.tools[device] = set(out.decode(errors='replace').split())
+        tools = self.tools[device]
+        # stdin only reaches a command unmangled over shell v2
+        if 'tar' not in tools or direction == 'push' and 'shell_v2' not in self.device_features(device):
+            return None
+        if compress and 'zstd' in tools and shutil.which('zstd'):
+            return 'zstd'
+        if compress and 'gzip' in tools:
+            return 'gzip'
+        return ''
+
+    def archive(self, transfer, compression):
+        # a push or pull of a whole directory as one tar stream, unpacked as it arrives
+        transfer.archived = compression
+        if transfer.direction == 'pull':
+            return self.pull_archive(transfer, compression)
+        return self.push_archive(transfer, compression)
+
+    def pull_archive(self, transfer, compression):
+        dst = transfer.dst
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, pathlib.PurePosixPath(transfer.src).name)
+        os.makedirs(dst, exist_ok=True)
+        compress = ARCHIVE_FILTERS[compression][0]
+        # the stream is raw, so errors about unreadable files must not end up in it
+        cmd = f'cd {shlex.quote(transfer.src)} && tar cf - . 2>/dev/null' + (f' | {compress}' if compress else '')
+        pipe = transfer.proc = self.pipe(transfer.device, cmd, 'pull')
+        decoder = None
+        try:
+            source = pipe.stdout
+            if compression == 'zstd':
+                decoder = subprocess.Popen(['zstd', '-d', '-q', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                pump(pipe.stdout, decoder.stdin, True)
+                source = decoder.stdout
+            done = 0
+            with tarfile.open(fileobj=source, mode='r|gz' if compression == 'gzip' else 'r|') as tar:
+                for member in tar:
+                    if transfer.cancelled.is_set():
+                        return False
+                    extract(tar, member, dst)
+                    done += member.size
+                    transfer.sample(done)
+            transfer.error = pipe.communicate()[1] or b''
+            return pipe.returncode == 0
+        finally:
+            pipe.close()
+            if decoder and decoder.poll() is None:
+                decoder.kill()
+                decoder.wait()
+
+    def push_archive(self, transfer, compression):
+        # same rule as adb push of a directory: it ends up inside dst
+        remote = shlex.quote(str(pathlib.PurePosixPath(transfer.dst, pathlib.Path(transfer.src).name)))
+        decompress = ARCHIVE_FILTERS[compression][1]
+        cmd = f'mkdir -p {remote} && cd {remote} && ' + (f'{decompress} | ' if decompress else '') + 'tar xf -'
+        pipe = transfer.proc = self.pipe(transfer.device, cmd, 'push')
+        encoder = None
+        try:
+            sink = pipe.stdin
+            if compression == 'zstd':
+                encoder = subprocess.Popen(['zstd', '-1', '-q', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                pumping = pump(encoder.stdout, pipe.stdin)
+                sink = encoder.stdin
+            elif compression == 'gzip':
+                sink = gzip.GzipFile(fileobj=sink, mode='wb', compresslevel=1)
+            done = 0
+            # toybox and busybox tar read GNU long names, not all of them read pax headers
+            with tarfile.open(fileobj=sink, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+                for parent, dirs, names in os.walk(transfer.src):
+                    # os.walk doesn't descend into symlinked directories, they go in as links
+                    names += [name for name in dirs if os.path.islink(os.path.join(parent, name))]
+                    for path in [parent] + [os.path.join(parent, name) for name in names]:
+                        if transfer.cancelled.is_set():
+                            return False
+                        tar.add(path, pathlib.Path(os.path.relpath(path, transfer.src)).as_posix(), recursive=False)
+                        if not os.path.islink(path) and os.path.isfile(path):
+                            done += os.path.getsize(path)
+                            transfer.sample(done)
+            if encoder:
+                encoder.stdin.close()
+                pumping.join()
+                encoder.wait()
+            elif compression == 'gzip':
+                sink.close()
+            transfer.error = pipe.communicate()[0] or b''
+            return pipe.returncode == 0
+        finally:
+            pipe.close()
+            if encoder and encoder.poll() is None:
+                encoder.kill()
+                encoder.wait()
+
+    def pull_ranges(self, transfer):
+        # pulls a large file in chunks read with dd, journaling the chunks that have arrived in a file next to
+        # it, so a pull interrupted by a dropped link resumes where it stopped instead of starting over; retries
+        # with backoff while the device is away. Returns None if src isn't a regular file
+        quoted = shlex.quote(transfer.src)
+        out = self.run(transfer.device, f'stat -L -c %F/%s/%Y {quoted}')[1].decode(errors='replace').strip()
+        try:
+            kind, size, mtime = out.rsplit('/', 2)
+            size, mtime = int(size), int(mtime)
+        except ValueError:
+            return None
+        if not kind.startswith('regular'):
+            return None
+        local = transfer.target
+        if os.path.isdir(local):
+            local = os.path.join(local, pathlib.PurePosixPath(transfer.src).name)
+        journal_path = local + '.journal'
+        version = [transfer.device, transfer.src, size, mtime]
+        try:
+            with open(journal_path, 'rt') as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            journal = {}
+        # a journal only counts for the same version of the same file
+        if journal.get('version') != version or journal.get('chunk') != RESUME_CHUNK or not os.path.isfile(local):
+            journal = {'version': version, 'chunk': RESUME_CHUNK, 'done': []}
+            with open(local, 'wb') as file:
+                file.truncate(size)
+        transfer.size = size
+        done = sum(last - first for first, last in journal['done'])
+        with open(local, 'r+b') as file:
+            for start in range(0, size, RESUME_CHUNK):
+                end = min(start + RESUME_CHUNK, size)
+                if any(first <= start and end <= last for first, last in journal['done']):
+                    continue
+                for attempt in range(RESUME_RETRIES):
+                    if transfer.cancelled.is_set():
+                        return False
+                    try:
+                        if self.pull_range(transfer, file, start, end, done):
+                            break
+                    except (OSError, subprocess.SubprocessError):
+                        pass
+                    if transfer.cancelled.is_set():
+                        return False
+                    # the link dropped: let go of connections to the device and wait for it to come back
+                    self.drop(transfer.device)
+                    transfer.cancelled.wait(min(2 ** attempt, 30))
+                else:
+                    transfer.error = f'{transfer.src}: gave up at byte {start} after {RESUME_RETRIES} attempts; ' \
+                                     f'pulling again resumes from there'.encode()
+                    return False
+                file.flush()
+                os.fsync(file.fileno())
+                done += end - start
+                journal['done'] = add_range(journal['done'], start, end)
+                with open(journal_path + '.new', 'wt') as f:
+                    json.dump(journal, f)
+                os.replace(journal_path + '.new', journal_path)
+        os.remove(journal_path)
+        if transfer.preserve:
+            os.utime(local, (mtime, mtime))
+        return True
+
+    def pull_range(self, transfer, file, start, end, base):
+        # reads [start, end) of src into the same place of file; True if all of it arrived
+        cmd = (f'dd if={shlex.quote(transfer.src)} bs={RESUME_BLOCK} skip={start // RESUME_BLOCK} '
+               f'count={-(-(end - start) // RESUME_BLOCK)} 2>/dev/null')
+        pipe = transfer.proc = self.pipe(transfer.device, cmd, 'pull')
+        received = 0
+        try:
+            file.seek(start)
+            while received < end - start:
+                data = pipe.stdout.read(min(RESUME_BLOCK, end - start - received))
+                if not data:
+                    break
+                file.write(data)
+                received += len(data)
+                transfer.sample(base + received)
+        finally:
+            # also when the link drops mid-read, so the retry doesn't leave this turn taken
+            pipe.close()
+        return received == end - start
+
+    def size(self, device, path):
+        # bytes under a device file or directory in one round-trip; du only reports KiB, so directories are
+        # approximate
+        quoted = shlex.quote(path)
+        # the trailing slash makes du follow a symlinked directory
+        as_dir = shlex.quote(path.rstrip('/') + '/')
+        out = self.run(device, f'if [ -d {quoted} ]; then echo $(($(du -sk {as_dir} | cut -f1) * 1024)); '
+                               f'else stat -L -c %s {quoted}; fi')[1]
+        try:
+            return int(out)
+        except ValueError:
+            return None
+
+    def drop(self, device):
+        # forgets open connections to a device, e.g. after a reconnect or root/unroot restarted adbd
+        pass
+
+    def close(self):
+        pass
+
+
+class SubprocessBackend(Backend):
+    # goes through the adb executable: commands on pooled shell sessions, transfers as adb push/pull
+
+    def __init__(self, adb_path):
+        self.adb = adb_path
+        self.shells = ShellPool(adb_path)
+        self.features = {}
+        self.tools = {}
+
+    def run(self, device, cmd):
+        with self.timed(device, 'shell', cmd) as command:
+            result = self.shells.run(device, cmd, command)
+            command.status, command.bytes = result[0], len(result[1])
+        return result
+
+    def stream(self, device, cmd):
+        with self.timed(device, 'shell', cmd) as command:
+            for line in self.shells.stream(device, cmd, command):
+                command.bytes += len(line) + 1
+                yield line
+
+    def devices(self):
+        with self.timed(None, 'host', 'devices -l') as command:
+            out = subprocess.check_output([self.adb, 'devices', '-l'])
+            command.bytes = len(out)
+        return parse_devices(out.decode(errors='replace'))
+
+    def track_devices(self):
+        return subprocess.Popen([self.adb, 'track-devices'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def transfer(self, transfer, interval):
+        with self.timed(transfer.device, transfer.direction, f'{transfer.src} {transfer.dst}') as command:
+            succeeded = self.adb_transfer(transfer, interval)
+            command.status = transfer.proc.returncode
+            command.bytes = transfer.size if succeeded and transfer.size else transfer.transferred
+        return succeeded
+
+    def adb_transfer(self, transfer, interval):
+        flags = ['-a'] if transfer.preserve and transfer.direction == 'pull' else []
+        transfer.proc = subprocess.Popen([self.adb, '-s', transfer.device, transfer.direction, *flags, transfer.src,
+                                          transfer.dst], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        # read stderr on the side so the pipe can't fill while the progress loop below is sleeping
+        error = []
+        reader = threading.Thread(target=lambda: error.append(transfer.proc.stderr.read()), daemon=True)
+        reader.start()
+        if transfer.cancelled.is_set():
+            transfer.proc.terminate()
+        # adb prints no progress when not writing to a terminal, so count the bytes that have arrived; pushes
+        # are measured on the device, which costs a round-trip, so they are sampled less often
+        if transfer.direction == 'push':
+            interval *= 2
+        while True:
+            try:
+                transfer.proc.wait(timeout=interval)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if transfer.direction == 'pull':
+                transfer.sample(local_size(transfer.target))
+            else:
+                transfer.sample(self.size(transfer.device, transfer.target) or 0)
+        reader.join()
+        transfer.error = b''.join(error)
+        return transfer.proc.returncode == 0
+
+    def open_pipe(self, device, cmd, direction):
+        if direction == 'pull':
+            return subprocess.Popen([self.adb, '-s', device, 'exec-out', cmd], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        return subprocess.Popen([self.adb, '-s', device, 'shell', cmd], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def device_features(self, device):
+        if device not in self.features:
+            with self.timed(device, 'host', 'features') as command:
+                try:
+                    out = subprocess.check_output([self.adb, '-s', device, 'features'], stderr=subprocess.DEVNULL)
+                except subprocess.CalledProcessError as ex:
+                    command.status = ex.returncode
+                    out = b''
+            self.features[device] = set(out.decode(errors='replace').split())
+        return self.features[device]
+
+    def drop(self, device):
+        self.shells.drop(device)
+        self.features.pop(device, None)
+        self.tools.pop(device, None)
+
+    def close(self):
+        self.shells.close()
+
+
+class AdbServerError(OSError):
+    pass
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AdbServerError('connection to the adb server closed')
+        data += chunk
+    return bytes(data)
+
+
+class SyncConnection:
+    # the sync: sub-protocol of adbd; requests are a 4-byte id, a little-endian length and a path
+    CHUNK = 64 * 1024
+
+    def __init__(self, sock, features):
+        self.sock = sock
+        self.features = features
+        # the Command of a transfer over this connection, which counts and paces its data
+        self.command = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self.sock.sendall(b'QUIT' + struct.pack('<I', 0))
+        except OSError:
+            pass
+        self.sock.close()
+
+    def request(self, command, path):
+        data = path.encode()
+        self.sock.sendall(command + struct.pack('<I', len(data)) + data)
+
+    def fail(self):
+        length = struct.unpack('<I', recv_exact(self.sock, 4))[0]
+        raise AdbServerError(recv_exact(self.sock, length).decode(errors='replace'))
+
+    def list(self, path):
+        # yields (name, mode, size, mtime); LIS2 carries 64-bit sizes where the device supports it
+        if 'ls_v2' in self.features:
+            self.request(b'LIS2', path)
+            while True:
+                header = recv_exact(self.sock, 76)
+                if header[:4] == b'DONE':
+                    return
+                error, mode, size, mtime, length = struct.unpack('<I16xI12xQ8xq8xI', header[4:])
+                name = recv_exact(self.sock, length).decode(errors='replace')
+                if not error:
+                    yield name, mode, size, mtime
+        else:
+            self.request(b'LIST', path)
+            while True:
+                header = recv_exact(self.sock, 20)
+                if header[:4] == b'DONE':
+                    return
+                mode, size, mtime, length = struct.unpack('<4I', header[4:])
+                yield recv_exact(self.sock, length).decode(errors='replace'), mode, size, mtime
+
+    def stat(self, path):
+        # returns (mode, size, mtime) following symlinks where the device supports it, or None if missing
+        if 'stat_v2' in self.features:
+            self.request(b'STA2', path)
+            header = recv_exact(self.sock, 72)
+            error, mode, size, mtime = struct.unpack('<I16xI12xQ8xq8x', header[4:])
+            return None if error else (mode, size, mtime)
+        self.request(b'STAT', path)
+        mode, size, mtime = struct.unpack('<3I', recv_exact(self.sock, 16)[4:])
+        return (mode, size, mtime) if mode else None
+
+    def recv(self, path, file, transfer):
+        self.request(b'RECV', path)
+        while True:
+            header = recv_exact(self.sock, 8)
+            if header[:4] == b'DONE':
+                return True
+            if header[:4] == b'FAIL':
+                length = struct.unpack('<I', header[4:])[0]
+                raise AdbServerError(recv_exact(self.sock, length).decode(errors='replace'))
+            data = recv_exact(self.sock, struct.unpack('<I', header[4:])[0])
+            file.write(data)
+            if self.command:
+                self.command.count(len(data))
+            transfer.sample(file.tell() + transfer.base)
+            # the rest of the stream can't be skipped, so a cancelled receive ends with the connection
+            if transfer.cancelled.is_set():
+                return False
+
+    def send(self, path, mode, mtime, file, transfer):
+        self.request(b'SEND', f'{path},{mode}')
+        while True:
+            data = file.read(self.CHUNK)
+            if not data:
+                break
+            if transfer.cancelled.is_set():
+                return False
+            self.sock.sendall(b'DATA' + struct.pack('<I', len(data)) + data)
+            if self.command:
+                self.command.count(len(data))
+            transfer.sample(file.tell() + transfer.base)
+        self.sock.sendall(b'DONE' + struct.pack('<I', int(mtime)))
+        status = recv_exact(self.sock, 4)
+        if status != b'OKAY':
+            self.fail()
+        recv_exact(self.sock, 4)
+        return True
+
+
+class ExecPipe:
+    # the raw stdout of an exec: service, with the part of the Popen interface archive transfers use; exec:
+    # carries no exit status, so a stream that ends counts as a success
+    def __init__(self, sock):
+        self.sock = sock
+        self.stdin = None
+        self.stdout = sock.makefile('rb')
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def communicate(self):
+        self.stdout.close()
+        self.sock.close()
+        self.returncode = 0
+        return b'', b''
+
+
+class ShellPipe:
+    # a shell v2 command fed through its stdin, with the part of the Popen interface archive transfers use
+    CHUNK = 4091
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.stdin = self
+        self.stdout = None
+        self.returncode = None
+
+    def write(self, data):
+        for start in range(0, len(data), self.CHUNK):
+            chunk = data[start:start + self.CHUNK]
+            self.sock.sendall(struct.pack('<BI', 0, len(chunk)) + chunk)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def communicate(self):
+        # closes stdin and collects the output until the command exits
+        output = bytearray()
+        self.returncode = 255
+        with self.sock:
+            try:
+                self.sock.sendall(struct.pack('<BI', 4, 0))
+                while True:
+                    stream, length = struct.unpack('<BI', recv_exact(self.sock, 5))
+                    data = recv_exact(self.sock, length)
+                    if stream == 3:
+                        self.returncode = data[0]
+                        break
+                    output += data
+            except OSError:
+                pass
+        return bytes(output), None
+
+
+class ServerBackend(Backend):
+    # talks to the local adb server directly, so nothing spawns an adb process: smart-socket requests for
+    # devices and transport, sync for listings and transfers and shell v2 for commands
+
+    def __init__(self, adb_path, host='127.0.0.1', port=5037):
+        self.adb = adb_path
+        self.address = (host, port)
+        self.features = {}
+        self.tools = {}
+        self.fallback = None
+
+    def connect(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=10)
+        except ConnectionRefusedError:
+            subprocess.call([self.adb, 'start-server'])
+            sock = socket.create_connection(self.address, timeout=10)
+        sock.settimeout(None)
+        return sock
+
+    @staticmethod
+    def request(sock, payload):
+        data = payload.encode()
+        sock.sendall(b'%04x' % len(data) + data)
+        status = recv_exact(sock, 4)
+        if status != b'OKAY':
+            message = recv_exact(sock, int(recv_exact(sock, 4), 16)) if status == b'FAIL' else status
+            raise AdbServerError(f'{payload}: {message.decode(errors="replace")}')
+
+    def query(self, payload):
+        with self.timed(None, 'host', payload) as command, self.connect() as sock:
+            self.request(sock, payload)
+            out = recv_exact(sock, int(recv_exact(sock, 4), 16))
+            command.bytes = len(out)
+        return out.decode()
+
+    def devices(self):
+        return parse_devices(self.query('host:devices-l'))
+
+    def track_devices(self):
+        sock = self.connect()
+        try:
+            self.request(sock, 'host:track-devices-l')
+        except AdbServerError:
+            # servers older than the long format only track serials and states
+            sock.close()
+            sock = self.connect()
+            self.request(sock, 'host:track-devices')
+        except Exception:
+            sock.close()
+            raise
+        return ExecPipe(sock)
+
+    def device_features(self, device):
+        if device not in self.features:
+            self.features[device] = set(self.query(f'host-serial:{device}:features').split(','))
+        return self.features[device]
+
+    def service(self, device, service):
+        sock = self.connect()
+        try:
+            self.request(sock, f'host:transport:{device}')
+            self.request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def sync(self, device):
+        return SyncConnection(self.service(device, 'sync:'), self.device_features(device))
+
+    def run(self, device, cmd):
+        if 'shell_v2' not in self.device_features(device):
+            # without shell v2 the exit status is lost, so old devices keep using the adb executable
+            return self.subprocess_fallback().run(device, cmd)
+        out = bytearray()
+        err = bytearray()
+        returncode = 255
+        for stream, data in self.shell_packets(device, cmd):
+            if stream == 1:
+                out += data
+            elif stream == 2:
+                err += data
+            elif stream == 3:
+                returncode = data[0]
+        return returncode, bytes(out), bytes(err)
+
+    def stream(self, device, cmd):
+        if 'shell_v2' not in self.device_features(device):
+            yield from self.subprocess_fallback().stream(device, cmd)
+            return
+        partial = b''
+        err = bytearray()
+        returncode = 255
+        for stream, data in self.shell_packets(device, cmd):
+            if stream == 1:
+                lines = (partial + data).replace(b'\r', b'').split(b'\n')
+                partial = lines.pop()
+                yield from lines
+            elif stream == 2:
+                err += data
+            elif stream == 3:
+                returncode = data[0]
+        if partial:
+            yield partial
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, b'', bytes(err))
+
+    def subprocess_fallback(self):
+        if self.fallback is None:
+            self.fallback = SubprocessBackend(self.adb)
+            self.fallback.log = self.log
+            self.fallback.scheduler = self.scheduler
+        return self.fallback
+
+    def shell_packets(self, device, cmd):
+        # yields (stream, data) shell v2 packets: 1 stdout, 2 stderr, 3 the exit status
+        with self.timed(device, 'shell', cmd) as command, self.service(device, f'shell,v2,raw:{cmd}') as sock:
+            command.status = 255
+            while True:
+                try:
+                    stream, length = struct.unpack('<BI', recv_exact(sock, 5))
+                    data = recv_exact(sock, length)
+                except AdbServerError:
+                    # the device went away before the command finished
+                    return
+                if stream == 3:
+                    command.status = data[0]
+                else:
+                    command.bytes += length
+                yield stream, data
+                if stream == 3:
+                    return
+
+    def iterdir(self, device, path):
+        entries = {}
+        batch = []
+        limit = LISTING_BATCH
+        with self.timed(device, 'list', path) as command, self.sync(device) as sync:
+            for name, mode, size, mtime in sync.list(path.rstrip('/') + '/'):
+                command.bytes += len(name)
+                if name in ('.', '..'):
+                    continue
+                entries[name] = DirEntry(name, DirEntry.kind_of(mode), mode, size, mtime)
+                batch.append(entries[name])
+                if len(batch) >= limit:
+                    yield batch
+                    batch = []
+                    limit = min(limit * 4, LISTING_BATCH_MAX)
+            # an unreadable or missing directory lists as empty, so tell those apart from an empty one
+            if not entries:
+                stat = sync.stat(path)
+                if not stat or DirEntry.kind_of(stat[0]) != DirEntry.DIR:
+                    raise subprocess.CalledProcessError(1, f'LIST {path}', b'',
+                                                        f'{path}: No such file or directory\n'.encode())
+        yield batch
+        # sync can't read links, so their targets are resolved in one shell round-trip
+        links = [name for name, entry in entries.items() if entry.mode & 0o170000 == 0o120000]
+        if links:
+            out = self.run(device, f'cd {shlex.quote(path)} && sh -c {shlex.quote(LINK_SCRIPT)} sh '
+                                   f'{" ".join(shlex.quote(name) for name in links)}')[1]
+            parse_listing(out, entries)
+            yield []
+
+    def transfer(self, transfer, interval):
+        transfer.base = 0
+        with self.timed(transfer.device, transfer.direction, f'{transfer.src} {transfer.dst}') as command, \
+                self.sync(transfer.device) as sync:
+            sync.command = command
+            succeeded = self.pull(sync, transfer) if transfer.direction == 'pull' else self.push(sync, transfer)
+            command.status = 0 if succeeded else 1
+            command.bytes = transfer.size if succeeded and transfer.size else transfer.transferred
+        return succeeded
+
+    def open_pipe(self, device, cmd, direction):
+        if direction == 'pull':
+            return ExecPipe(self.service(device, f'exec:{cmd}'))
+        return ShellPipe(self.service(device, f'shell,v2,raw:{cmd}'))
+
+    def pull(self, sync, transfer):
+        stat = sync.stat(transfer.src)
+        if not stat:
+            raise AdbServerError(f'{transfer.src}: No such file or directory')
+        # same rule as adb pull: into an existing local directory, the remote name is kept
+        dst = transfer.dst
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, pathlib.PurePosixPath(transfer.src).name)
+        if DirEntry.kind_of(stat[0]) != DirEntry.DIR:
+            with open(dst, 'wb') as file:
+                succeeded = sync.recv(transfer.src, file, transfer)
+            if succeeded and transfer.preserve:
+                os.utime(dst, (stat[2], stat[2]))
+            return succeeded
+        pending = [(transfer.src.rstrip('/') or '/', dst)]
+        while pending:
+            remote, local = pending.pop()
+            os.makedirs(local, exist_ok=True)
+            for name, mode, size, mtime in list(sync.list(remote + '/')):
+                if name in ('.', '..'):
+                    continue
+                remote_path = f'{remote.rstrip("/")}/{name}'
+                local_path = os.path.join(local, name)
+                kind = DirEntry.kind_of(mode)
+                if mode & 0o170000 == 0o120000:
+                    stat = sync.stat(remote_path)
+                    kind = DirEntry.kind_of(stat[0]) if stat else DirEntry.OTHER
+                if kind == DirEntry.DIR:
+                    pending.append((remote_path, local_path))
+                elif kind == DirEntry.FILE:
+                    with open(local_path, 'wb') as file:
+                        if not sync.recv(remote_path, file, transfer):
+                            return False
+                    if transfer.preserve:
+                        os.utime(local_path, (mtime, mtime))
+                    transfer.base += os.path.getsize(local_path)
+        return True
+
+    def push(self, sync, transfer):
+        stat = sync.stat(transfer.dst)
+        dst = transfer.dst
+        if stat and DirEntry.kind_of(stat[0]) == DirEntry.DIR:
+            dst = str(pathlib.PurePosixPath(dst, pathlib.Path(transfer.src).name))
+        if not os.path.isdir(transfer.src):
+            local = os.stat(transfer.src)
+            with open(transfer.src, 'rb') as file:
+                return sync.send(dst, local.st_mode, local.st_mtime, file, transfer)
+        empty = []
+        for parent, dirs, names in os.walk(transfer.src):
+            remote = str(pathlib.PurePosixPath(dst, pathlib.Path(os.path.relpath(parent, transfer.src)).as_posix()))
+            if not dirs and not names:
+                empty.append(remote)
+            for name in names:
+                local_path = os.path.join(parent, name)
+                local = os.stat(local_path)
+                with open(local_path, 'rb') as file:
+                    if not sync.send(f'{remote}/{name}', local.st_mode, local.st_mtime, file, transfer):
+                        return False
+                transfer.base += local.st_size
+        # adbd makes the parents of every file it receives, but empty directories have to be made separately
+        if empty:
+            self.check_output(transfer.device, ['mkdir', '-p', *empty])
+        return True
+
+    def drop(self, device):
+        self.features.pop(device, None)
+        self.tools.pop(device, None)
+        if self.fallback:
+            self.fallback.drop(device)
+
+    def close(self):
+        if self.fallback:
+            self.fallback.close()
+
+
+def make_backend(adb_path, use_server, log=None, scheduler=None):
+    backend = ServerBackend(adb_path) if use_server else SubprocessBackend(adb_path)
+    backend.log = log
+    backend.scheduler = scheduler
+    return backend
+
+
+class DeviceTracker:
+    # keeps the device list current from the adb server's track-devices stream, falling back to polling
+    # while the server can't be followed, and fetches the properties of each device once
+    # one line each, even where a property is missing
+    PROPERTIES = ('echo "$(getprop ro.product.manufacturer)"; echo "$(getprop ro.product.model)"; '
+                  'echo "$(getprop ro.build.version.release)"; df -k /data 2>/dev/null | tail -n 1')
+
+    def __init__(self, backend, interval=2):
+        self.backend = backend
+        self.interval = interval
+        self.devices = []
+        self.properties = {}
+        # bumped on every change, so the Tk thread only redraws when there is something new
+        self.version = 0
+        self.pipe = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        pipe = self.pipe
+        if pipe:
+            pipe.terminate()
+
+    def refresh(self):
+        self.update(self.backend.devices())
+
+    def update(self, devices):
+        with self.lock:
+            if devices == self.devices:
+                return
+            self.devices = devices
+            self.version += 1
+        for serial, state, info in devices:
+            if state == 'device' and serial not in self.properties:
+                self.properties[serial] = None
+                threading.Thread(target=self.fetch_properties, args=(serial,), daemon=True).start()
+
+    def fetch_properties(self, serial):
+        try:
+            out = self.backend.run(serial, self.PROPERTIES)[1].decode(errors='replace').splitlines()
+            manufacturer, model, release, df = (out + [''] * 4)[:4]
+            properties = {'model': f'{manufacturer} {model}'.strip(), 'android': release}
+            fields = df.split()
+            if len(fields) >= 4 and fields[1].isdigit() and fields[3].isdigit():
+                properties['storage'] = f'{human_size(int(fields[3]) * 1024)} free of ' \
+                                        f'{human_size(int(fields[1]) * 1024)}'
+        except (subprocess.CalledProcessError, OSError):
+            # not cached, so the next change of the device's state tries again
+            self.properties.pop(serial, None)
+            return
+        self.properties[serial] = properties
+        with self.lock:
+            self.version += 1
+
+    def describe(self, serial, state, info):
+        # adb devices -l has the model with underscores for spaces, getprop has it as it is
+        properties = self.properties.get(serial) or {}
+        details = [properties.get('model') or info.get('model', '').replace('_', ' ')]
+        if properties.get('android'):
+            details.append(f'Android {properties["android"]}')
+        if properties.get('storage'):
+            details.append(properties['storage'])
+        details = [detail for detail in details if detail]
+        return f'{serial}: {state}' + (f' - {", ".join(details)}' if details else '')
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.pipe = self.backend.track_devices()
+                if self.stopped.is_set():
+                    continue
+                for devices in read_device_lists(self.pipe.stdout):
+                    self.update(devices)
+            except (OSError, ValueError, subprocess.SubprocessError):
+                pass
+            finally:
+                if self.pipe:
+                    self.pipe.terminate()
+                    self.pipe.communicate()
+                self.pipe = None
+            # the server went away or can't be followed: poll until following works again
+            if not self.stopped.wait(self.interval):
+                try:
+                    self.refresh()
+                except (OSError, subprocess.SubprocessError):
+                    pass
+
+
+def fetch_listing(device, ls_dir):
+    # returns every entry of ls_dir, hidden ones included, as sorted DirEntry objects
+    return sorted(backend.listdir(device, ls_dir), key=entry_key)
+
+
+def merge_sorted(listing, batch):
+    # merges an unsorted batch of new entries into a sorted listing
+    return list(heapq.merge(listing, sorted(batch, key=entry_key), key=entry_key))
+
+
+def find_entry(listing, name):
+    # binary search of a sorted listing; returns the index of the entry called name, or where it would go
+    key = name_key(name)
+    low, high = 0, len(listing)
+    while low < high:
+        middle = (low + high) // 2
+        if listing[middle].key < key:
+            low = middle + 1
+        else:
+            high = middle
+    # names that only differ in case share a key
+    index = low
+    while index < len(listing) and listing[index].key == key:
+        if listing[index].name == name:
+            return index
+        index += 1
+    return low
+
+
+def patch_listing(listing, remove=(), add=()):
+    # removes the entries named in remove and inserts the entries in add, keeping listing sorted in place
+    for name in remove:
+        index = find_entry(listing, name)
+        if index < len(listing) and listing[index].name == name:
+            del listing[index]
+    for entry in add:
+        index = find_entry(listing, entry.name)
+        if index < len(listing) and listing[index].name == entry.name:
+            listing[index] = entry
+        else:
+            listing.insert(index, entry)
+
+
+def diff_listing(old, new):
+    # the names to remove from old and the entries to add to it to make it new, for patch_listing
+    def state(entry):
+        return entry.kind, entry.mode, entry.size, entry.mtime, entry.target
+
+    before = {entry.name: entry for entry in old}
+    after = {entry.name: entry for entry in new}
+    remove = [name for name in before if name not in after]
+    add = [entry for name, entry in after.items() if name not in before or state(entry) != state(before[name])]
+    return remove, add
+
+
+class ListingStream:
+    # lists a directory on a background thread; the Tk thread drains the batches with take()
+
+    def __init__(self, device, path):
+        self.device = device
+        self.path = path
+        self.generation = listings.generation
+        self.batches = queue.Queue()
+        self.cancelled = False
+        self.entries = []
+        # whether the pane shows a snapshot meanwhile, which stays up until the listing is complete
+        self.stale = False
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def worker(self):
+        try:
+            for batch in backend.iterdir(self.device, self.path):
+                if self.cancelled:
+                    return
+                self.batches.put(batch)
+        except (subprocess.CalledProcessError, OSError) as ex:
+            self.batches.put(ex)
+            return
+        self.batches.put(None)
+
+    def take(self):
+        # batches of entries, then None once the listing is complete, or the exception that ended it
+        items = []
+        while True:
+            try:
+                items.append(self.batches.get_nowait())
+            except queue.Empty:
+                return items
+
+
+class ListingCache:
+    # recent directory listings per device, evicted least recently used first and expired after ttl seconds;
+    # a device's listings are saved at exit as a snapshot the next session shows until it has listed again
+    SNAPSHOTS = os.path.join('cache', 'listings')
+
+    def __init__(self, size=128, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.listings = OrderedDict()
+        # key -> (time the snapshot was saved, listing), never served as fresh
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        # bumped on every invalidation so a fetch that raced with a mutation isn't stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    @staticmethod
+    def key(device, path):
+        return device, str(pathlib.PurePosixPath(path))
+
+    def get(self, device, path):
+        key = self.key(device, path)
+        with self.lock:
+            cached = self.listings.get(key)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                self.listings.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            if cached:
+                del self.listings[key]
+            self.misses += 1
+            return None
+
+    def __contains__(self, key):
+        with self.lock:
+            cached = self.listings.get(self.key(*key))
+            return bool(cached) and time.monotonic() - cached[0] < self.ttl
+
+    def put(self, device, path, listing, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            key = self.key(device, path)
+            self.listings[key] = (time.monotonic(), listing)
+            self.listings.move_to_end(key)
+            self.snapshots.pop(key, None)
+            while len(self.listings) > self.size:
+                self.listings.popitem(last=False)
+
+    def invalidate(self, device, path, subtree=False):
+        # drops the listing of path, and with subtree also every listing below it
+        device, path = self.key(device, path)
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.generation += 1
+            for cache in (self.listings, self.snapshots):
+                for key in list(cache):
+                    if key[0] == device and (key[1] == path or subtree and key[1].startswith(prefix)):
+                        del cache[key]
+
+    def patch(self, device, path, remove=(), add=()):
+        # applies a change made through the app to a cached listing; returns the listing, or None if not cached
+        key = self.key(device, path)
+        with self.lock:
+            self.generation += 1
+            cached = self.listings.get(key)
+            if not cached or time.monotonic() - cached[0] >= self.ttl:
+                return None
+            patch_listing(cached[1], remove, add)
+            return cached[1]
+
+    def clear(self, device):
+        with self.lock:
+            self.generation += 1
+            for cache in (self.listings, self.snapshots):
+                for key in [key for key in cache if key[0] == device]:
+                    del cache[key]
+
+    def neighbours(self, device, path, limit=32):
+        # the parent and the children of path that have a listing cached, the ones a watcher keeps current
+        path = self.key(device, path)[1]
+        parent = str(pathlib.PurePosixPath(path).parent)
+        with self.lock:
+            cached = [key[1] for key in self.listings if key[0] == device and key[1] != path and
+                      (key[1] == parent or str(pathlib.PurePosixPath(key[1]).parent) == path)]
+        return cached[-limit:]
+
+    def stale(self, device, path):
+        # (time saved, listing) of path from the last session's snapshot, or None
+        with self.lock:
+            return self.snapshots.get(self.key(device, path))
+
+    @staticmethod
+    def snapshot_file(device):
+        return os.path.join(ListingCache.SNAPSHOTS, hashlib.sha1(device.encode()).hexdigest() + '.json')
+
+    def save(self, device):
+        # the listings of device, fresh or still from the last snapshot, for the next session
+        with self.lock:
+            listings = {key[1]: listing for key, (stamp, listing) in self.snapshots.items() if key[0] == device}
+            saved = {key[1]: stamp for key, (stamp, listing) in self.snapshots.items() if key[0] == device}
+            listings.update((key[1], listing) for key, (stamp, listing) in self.listings.items() if key[0] == device)
+        now = time.time()
+        data = {'device': device, 'listings': [
+            [path, saved.get(path, now), [[entry.name, entry.kind, entry.mode, entry.size, entry.mtime, entry.target]
+                                          for entry in listing]] for path, listing in listings.items()]}
+        os.makedirs(ListingCache.SNAPSHOTS, exist_ok=True)
+        with open(self.snapshot_file(device) + '.new', 'wt') as f:
+            json.dump(data, f)
+        os.replace(self.snapshot_file(device) + '.new', self.snapshot_file(device))
+
+    def load(self, device):
+        # the snapshot of device from the last session, unless it has already been loaded
+        try:
+            with open(self.snapshot_file(device), 'rt') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for path, stamp, entries in data['listings']:
+                key = self.key(device, path)
+                if key not in self.listings and key not in self.snapshots:
+                    self.snapshots[key] = (stamp, [DirEntry(*fields) for fields in entries])
+
+    @bulk
+    def prefetch(self, device, path):
+        # runs on the prefetch pool; failures only mean the directory gets listed when it is entered
+        if (device, path) in self:
+            return
+        generation = self.generation
+        try:
+            listing = fetch_listing(device, path)
+        except (subprocess.CalledProcessError, OSError):
+            return
+        self.put(device, path, listing, generation)
+        with self.lock:
+            self.prefetched += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return (f'Cached listings: {len(self.listings)}/{self.size} (TTL {self.ttl} s)\n'
+                    f'Hits: {self.hits}\nMisses: {self.misses}\n'
+                    f'Hit rate: {self.hits / lookups if lookups else 0:.0%}\n'
+                    f'Prefetched: {self.prefetched}')
+
+
+class DirectoryWatcher:
+    # keeps watched directory listings current without relisting them. Where the device has inotifywait, its
+    # events stream in and only the entries they name are stat'ed again; elsewhere the mtimes of all the watched
+    # directories are polled in one stat and only the directories that changed are listed again. changes()
+    # hands over (path, names removed, entries added or changed), or (path, None, listing) for a new listing
+    EVENTS = 'create,delete,moved_from,moved_to,modify,attrib,close_write'
+    # seconds to collect events for before stat'ing what they name
+    SETTLE = 0.1
+
+    def __init__(self, backend, device, interval=2):
+        self.backend = backend
+        self.device = device
+        self.interval = interval
+        self.paths = []
+        self.mtimes = {}
+        self.inotify = None
+        self.pipe = None
+        self.found = queue.Queue()
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def watch(self, paths):
+        paths = sorted({str(pathlib.PurePosixPath(path)) for path in paths})
+        with self.lock:
+            if paths == self.paths:
+                return
+            self.paths = paths
+            self.changed.set()
+            pipe = self.pipe
+        if pipe:
+            pipe.terminate()
+
+    def stop(self):
+        self.stopped.set()
+        self.watch([])
+
+    def changes(self):
+        found = []
+        while True:
+            try:
+                found.append(self.found.get_nowait())
+            except queue.Empty:
+                return found
+
+    @bulk
+    def run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                self.changed.clear()
+                paths = self.paths
+            try:
+                if not paths:
+                    self.changed.wait()
+                    continue
+                if self.inotify is None:
+                    self.inotify = self.backend.call(self.device, ['sh', '-c', 'command -v inotifywait']) == 0
+                if self.inotify:
+                    self.follow(paths)
+                else:
+                    self.poll(paths)
+            except (OSError, subprocess.SubprocessError):
+                # the device is away for now
+                self.changed.wait(self.interval)
+
+    def follow(self, paths):
+        cmd = f'inotifywait -m -q -e {self.EVENTS} --format %e/%w%f ' + \
+              ' '.join(shlex.quote(path.rstrip('/') + '/') for path in paths)
+        events = queue.Queue()
+        with self.lock:
+            if self.changed.is_set():
+                return
+            pipe = self.pipe = self.backend.pipe(self.device, cmd, 'pull', False)
+
+        def read():
+            for line in iter(pipe.stdout.readline, b''):
+                flags, _, path = line.decode(errors='replace').rstrip('\n').partition('/')
+                events.put(path)
+            events.put(None)
+
+        threading.Thread(target=read, daemon=True).start()
+        try:
+            while True:
+                path = events.get()
+                if path is None:
+                    break
+                # events come in bursts, so collect a burst and stat each name once
+                touched = {}
+                deadline = time.monotonic() + self.SETTLE
+                while path is not None:
+                    parent, _, name = path.rpartition('/')
+                    if name:
+                        touched.setdefault(str(pathlib.PurePosixPath(parent or '/')), set()).add(name)
+                    try:
+                        path = events.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                for parent, names in touched.items():
+                    present = self.backend.entries(self.device, [f'{parent.rstrip("/")}/{name}' for name in names])
+                    self.found.put((parent, [name for name in names if name not in
+                                             {entry.name for entry in present}], present))
+                if path is None:
+                    break
+        finally:
+            pipe.terminate()
+            pipe.communicate()
+            with self.lock:
+                self.pipe = None
+        # inotifywait ended on its own, e.g. out of watches or on a directory that can't be watched
+        if not self.changed.is_set():
+            self.inotify = False
+
+    def poll(self, paths):
+        # %y has the fractions of a second, so changes in the second a directory was listed still show
+        out = self.backend.run(self.device, f'stat -c %y/%n {" ".join(shlex.quote(path) for path in paths)}')[1]
+        mtimes = {}
+        for line in out.decode(errors='replace').splitlines():
+            mtime, _, path = line.partition('/')
+            if path:
+                mtimes[str(pathlib.PurePosixPath(path))] = mtime
+        for path in paths:
+            if path in self.mtimes and path in mtimes and mtimes[path] != self.mtimes[path]:
+                try:
+                    listing = sorted(self.backend.listdir(self.device, path), key=entry_key)
+                except subprocess.CalledProcessError:
+                    continue
+                self.found.put((path, None, listing))
+        self.mtimes = mtimes
+        self.changed.wait(self.interval)
+
+
+class FileCache:
+    # opened files kept on disk across sessions, keyed by what identifies one version of a device file (serial,
+    # path, size and mtime) and evicted least recently used first once they add up to more than budget bytes;
+    # only used from the Tk thread
+    def __init__(self, root=os.path.join('cache', 'files'), budget=1 << 30):
+        self.root = root
+        self.budget = budget
+        # key -> {'device', 'path', 'size', 'mtime', 'file'}, least recently used first
+        self.entries = OrderedDict()
+        self.pending = set()
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+        self.load()
+
+    @staticmethod
+    def key(device, path, size, mtime):
+        return hashlib.sha1(f'{device}\0{path}\0{size}\0{mtime}'.encode()).hexdigest()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.root, 'index.json'), 'rt') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, entry in index:
+            if os.path.isfile(entry['file']):
+                self.entries[key] = entry
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'index.json'), 'wt') as f:
+            json.dump(list(self.entries.items()), f)
+
+    @staticmethod
+    def intact(entry):
+        # an opened file may have been edited in place, in which case it no longer is that version
+        try:
+            stat = os.stat(entry['file'])
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and int(stat.st_mtime) == entry['mtime']
+
+    def get(self, device, path, size, mtime):
+        # the local copy of that version of path, or None
+        key = self.key(device, path, size, mtime)
+        entry = self.entries.get(key)
+        if entry and self.intact(entry):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved += size
+            return entry['file']
+        if entry:
+            self.remove(key)
+        self.misses += 1
+        return None
+
+    def reserve(self, device, path, size, mtime):
+        # where to pull that version of path to before put(), or None if it can't be cached
+        key = self.key(device, path, size, mtime)
+        if size > self.budget or key in self.pending:
+            return None
+        self.pending.add(key)
+        directory = os.path.join(self.root, key[:2], key)
+        os.makedirs(directory, exist_ok=True)
+        # the file keeps its name so it opens with the right application
+        return os.path.join(directory, pathlib.PurePosixPath(path).name)
+
+    def put(self, device, path, size, mtime, file):
+        key = self.key(device, path, size, mtime)
+        self.pending.discard(key)
+        # other versions of the same file won't be asked for again
+        for old in [old for old, entry in self.entries.items() if (entry['device'], entry['path']) == (device, path)]:
+            self.remove(old)
+        self.entries[key] = {'device': device, 'path': path, 'size': size, 'mtime': mtime, 'file': file}
+        total = sum(entry['size'] for entry in self.entries.values())
+        while total > self.budget:
+            old, entry = next(iter(self.entries.items()))
+            total -= entry['size']
+            self.remove(old)
+        self.save()
+
+    def discard(self, device, path, size, mtime):
+        # gives up a reservation whose pull didn't finish; a part with a journal is kept, so opening that version
+        # again reserves the same place and the pull resumes
+        key = self.key(device, path, size, mtime)
+        self.pending.discard(key)
+        directory = os.path.join(self.root, key[:2], key)
+        if not os.path.isfile(os.path.join(directory, pathlib.PurePosixPath(path).name + '.journal')):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        shutil.rmtree(os.path.dirname(entry['file']), ignore_errors=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        total = sum(entry['size'] for entry in self.entries.values())
+        return (f'Cached files: {len(self.entries)} ({human_size(total)} of {human_size(self.budget)})\n'
+                f'Hits: {self.hits}\nMisses: {self.misses}\n'
+                f'Hit rate: {self.hits / lookups if lookups else 0:.0%}\n'
+                f'Transfers saved: {human_size(self.saved)}')
+
+
+def glob_pattern(glob):
+    # a regex matching what a shell glob does; * and ? stay within a path component, ** doesn't
+    out = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**', i):
+            out.append('[^\n]*')
+            i += 2
+            continue
+        char = glob[i]
+        end = glob.find(']', i + 2) if char == '[' else -1
+        if char == '*':
+            out.append('[^/\n]*')
+        elif char == '?':
+            out.append('[^/\n]')
+        elif end != -1:
+            body = glob[i + 1:end].replace('\\', '\\\\')
+            out.append(f'[^/\n{body[1:]}]' if body[0] in '!^' else f'[{body}]')
+            i = end
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return ''.join(out)
+
+
+class FileIndex:
+    # every path on a device, searchable by substring or glob without asking the device. Built by one find
+    # over the whole device and kept current by listing again only the directories whose mtime changed; the
+    # paths are searched as one lowercased newline-separated string, so a query is a scan at C speed
+    ROOTS = os.path.join('cache', 'index')
+    # virtual filesystems that are huge, change all the time and hold nothing worth finding
+    PRUNE = r'\( -path /proc -o -path /sys -o -path /dev \) -prune -o'
+
+    def __init__(self, backend, device):
+        self.backend = backend
+        self.device = device
+        # directory -> mtime, and directory -> names of what isn't a directory in it
+        self.dirs = {}
+        self.files = {}
+        self.printf = None
+        self.paths = []
+        self.blob = ''
+        self.starts = []
+        self.scanned = None
+        self.count = 0
+        self.busy = False
+        self.error = None
+        self.load()
+
+    def file(self):
+        return os.path.join(FileIndex.ROOTS, hashlib.sha1(self.device.encode()).hexdigest() + '.txt')
+
+    def load(self):
+        try:
+            with open(self.file(), 'rt', encoding='utf-8', errors='replace') as f:
+                self.scanned = float(f.readline())
+                for line in f:
+                    self.add(line.rstrip('\n'))
+        except (OSError, ValueError):
+            self.dirs = {}
+            self.files = {}
+            self.scanned = None
+            return
+        self.build()
+
+    def save(self):
+        os.makedirs(FileIndex.ROOTS, exist_ok=True)
+        with open(self.file() + '.new', 'wt', encoding='utf-8', errors='replace') as f:
+            f.write(f'{self.scanned}\n')
+            f.writelines(f'd/{mtime}/{path}\n' for path, mtime in self.dirs.items())
+            f.writelines(f'f/0/{parent.rstrip("/")}/{name}\n' for parent, names in self.files.items() for name in names)
+        os.replace(self.file() + '.new', self.file())
+
+    def add(self, line):
+        # takes a type/mtime/path line as printed by find -printf '%y/%T@/%p\n'
+        try:
+            kind, mtime, path = line.split('/', 2)
+            if kind == 'd':
+                self.dirs[path] = int(float(mtime))
+            else:
+                parent, name = path.rsplit('/', 1)
+                self.files.setdefault(parent or '/', []).append(name)
+        except ValueError:
+            return
+        self.count += 1
+
+    def find(self, args, dirs_only=False):
+        # streams the lines of a find over args in the format add() takes, through -printf where find has it
+        # and stat where it doesn't (older toybox)
+        if self.printf is None:
+            self.printf = self.backend.call(self.device, ['find', '/', '-maxdepth', '0', '-printf', '']) == 0
+        if self.printf:
+            cmd = f'find {args} {self.PRUNE} {"-type d " if dirs_only else ""}-printf "%y/%T@/%p\\n"'
+        else:
+            cmd = f'find {args} {self.PRUNE} -type d -exec stat -c d/%Y/%n {{}} +'
+            if not dirs_only:
+                cmd += ' -o -exec stat -c f/0/%n {} +'
+        yield from self.backend.find_lines(self.device, cmd)
+
+    @bulk
+    def update(self):
+        # a full scan the first time, afterwards only the directories that changed are listed again
+        self.busy = True
+        self.error = None
+        try:
+            started = time.time()
+            if self.scanned is None:
+                self.dirs = {}
+                self.files = {}
+                self.count = 0
+                for line in self.find('/'):
+                    self.add(line)
+            else:
+                self.refresh()
+            self.scanned = started
+            self.build()
+            self.save()
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.busy = False
+
+    def refresh(self):
+        old = self.dirs
+        self.dirs = {}
+        self.count = 0
+        for line in self.find('/', True):
+            self.add(line)
+        # a directory's mtime changes when names are added to it or removed from it
+        changed = [path for path, mtime in self.dirs.items() if old.get(path) != mtime]
+        for path in old.keys() - self.dirs.keys():
+            self.files.pop(path, None)
+        for batch in command_batches(changed):
+            for path in batch:
+                self.files.pop(path, None)
+            args = ' '.join(shlex.quote(path) for path in batch)
+            for line in self.find(f'{args} -mindepth 1 -maxdepth 1'):
+                if not line.startswith('d/'):
+                    self.add(line)
+
+    def build(self):
+        paths = [path if path == '/' else path + '/' for path in self.dirs]
+        paths += [f'{parent.rstrip("/")}/{name}' for parent, names in self.files.items() for name in names]
+        paths.sort(key=str.lower)
+        # lowercasing can change the length of a name, e.g. İ becomes i and a combining dot, so the offsets
+        # are those of the lowered paths
+        lowered = [path.lower() for path in paths]
+        blob = '\n'.join(lowered) + '\n'
+        starts = list(itertools.accumulate((len(path) + 1 for path in lowered), initial=0))
+        # swapped in together, so a search on the Tk thread never sees half of a rebuild
+        self.paths, self.blob, self.starts = paths, blob, starts
+        self.count = len(paths)
+
+    def search(self, query, limit=1000):
+        # paths matching query, directories with a trailing slash; a query with * ? or [ is a glob, matched
+        # against whole names unless it has a /, anything else a substring of the path. Case doesn't matter
+        paths, blob, starts = self.paths, self.blob, self.starts
+        query = query.lower()
+        results = []
+        if not query:
+            return results
+        pattern = None
+        whole = '/' in query
+        if any(char in query for char in '*?['):
+            pattern = re.compile(glob_pattern(query) + '/?')
+            # only the paths holding the longest literal part of the glob are tried against it
+            query = max(re.split(r'\*|\?|\[[^]]*]', query), key=len)
+        position = blob.find(query)
+        while position != -1 and len(results) < limit:
+            line = bisect.bisect_right(starts, position) - 1
+            path = paths[line]
+            name = path.lower() if whole else path.lower().rstrip('/').rpartition('/')[2]
+            if pattern is None or pattern.fullmatch(name):
+                results.append(path)
+            position = blob.find(query, starts[line + 1])
+        return results
+
+    def status(self):
+        if self.busy:
+            return f'Indexing {self.device}... {self.count} paths'
+        if self.error is not None:
+            return f'Indexing failed: {self.error}'
+        if self.scanned is None:
+            return 'Not indexed yet'
+        return f'{len(self.paths)} paths, indexed {time.strftime("%Y-%m-%d %H:%M", time.localtime(self.scanned))}'
+
+
+class DiskUsage:
+    # bytes under every directory below root, summed on a background thread from one find over its files, so
+    # the biggest subtrees stand out while the scan is still running; directories further down are served from
+    # the same totals without scanning again
+    def __init__(self, backend, device, root):
+        self.backend = backend
+        self.device = device
+        self.root = str(pathlib.PurePosixPath(root))
+        self.totals = {}
+        self.files = 0
+        self.bytes = 0
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def covers(self, path):
+        path = pathlib.PurePosixPath(path)
+        return path == pathlib.PurePosixPath(self.root) or pathlib.PurePosixPath(self.root) in path.parents
+
+    def total(self, path):
+        return self.totals.get(str(pathlib.PurePosixPath(path)), 0)
+
+    @bulk
+    def worker(self):
+        # the trailing slash makes find follow a symlinked root, e.g. /sdcard
+        cmd = f'find {shlex.quote(self.root.rstrip("/") + "/")} {FileIndex.PRUNE} -type f -exec stat -c %s/%n {{}} +'
+        totals = self.totals
+        try:
+            for line in self.backend.find_lines(self.device, cmd):
+                if self.cancelled:
+                    return
+                size, _, path = line.partition('/')
+                try:
+                    size = int(size)
+                except ValueError:
+                    continue
+                self.files += 1
+                self.bytes += size
+                # every directory from the file's own up to root gets its size
+                parent = path.replace('//', '/')
+                while parent != self.root and parent != '/':
+                    parent = parent.rpartition('/')[0] or '/'
+                    totals[parent] = totals.get(parent, 0) + size
+        except OSError as ex:
+            self.error = ex
+        finally:
+            self.done = True
+
+    def status(self):
+        if self.error is not None:
+            return f'Scanning {self.root} failed: {self.error}'
+        return f'{"Scanned" if self.done else "Scanning"} {self.root}: {self.files} files, {human_size(self.bytes)}'
+
+
+class DuplicateFinder:
+    # files with the same contents below root, found without pulling anything: one find gathers every size,
+    # and only files that share a size are hashed on the device, in as few md5sum calls as the command length
+    # allows, biggest first. Groups of duplicates show up in groups() while the hashing goes on
+
+    def __init__(self, backend, device, root):
+        self.backend = backend
+        self.device = device
+        self.root = str(pathlib.PurePosixPath(root))
+        # (size, digest) -> [paths]
+        self.hashes = {}
+        self.candidates = 0
+        self.hashed = 0
+        self.files = 0
+        self.version = 0
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    @bulk
+    def worker(self):
+        try:
+            sizes = self.sizes()
+            # path -> size of the files that share their size with another, biggest first
+            candidates = {path: size for size, paths in sorted(sizes.items(), reverse=True) if len(paths) > 1
+                          for path in paths}
+            self.candidates = len(candidates)
+            for batch in command_batches(candidates, COMMAND_BYTES - len('md5sum ')):
+                if self.cancelled:
+                    return
+                self.hash(batch, candidates)
+        except OSError as ex:
+            self.error = ex
+        finally:
+            self.done = True
+            self.version += 1
+
+    def sizes(self):
+        # size -> [paths] of every non-empty file below root, in one pass
+        sizes = {}
+        cmd = f'find {shlex.quote(self.root.rstrip("/") + "/")} {FileIndex.PRUNE} -type f -size +0 ' \
+              f'-exec stat -c %s/%n {{}} +'
+        for line in self.backend.find_lines(self.device, cmd):
+            if self.cancelled:
+                break
+            size, _, path = line.partition('/')
+            if size.isdigit():
+                sizes.setdefault(int(size), []).append(path.replace('//', '/'))
+                self.files += 1
+        return sizes
+
+    def hash(self, batch, sizes):
+        cmd = 'md5sum ' + shlex.join(batch)
+        try:
+            for line in self.backend.stream(self.device, cmd):
+                if self.cancelled:
+                    return
+                digest, path = parse_md5sum(line)
+                if path not in sizes:
+                    continue
+                self.hashed += 1
+                self.hashes.setdefault((sizes[path], digest), []).append(path)
+                self.version += 1
+        except subprocess.CalledProcessError:
+            # files that vanished or can't be read are left out
+            pass
+
+    def groups(self):
+        # [(size, [paths])] of the duplicates found so far, the most space wasted first
+        groups = [(size, sorted(paths)) for (size, digest), paths in list(self.hashes.items()) if len(paths) > 1]
+        return sorted(groups, key=lambda group: group[0] * (len(group[1]) - 1), reverse=True)
+
+    def forget(self, paths):
+        # drops deleted files from their groups
+        paths = set(paths)
+        for key, group in list(self.hashes.items()):
+            self.hashes[key] = [path for path in group if path not in paths]
+        self.version += 1
+
+    def status(self):
+        groups = self.groups()
+        wasted = sum(size * (len(paths) - 1) for size, paths in groups)
+        if self.error is not None:
+            return f'Searching {self.root} failed: {self.error}'
+        if not self.candidates and not self.done:
+            return f'Listing {self.root}: {self.files} files'
+        return (f'{"Searched" if self.done else "Hashing"} {self.root}: {self.hashed} of {self.candidates} files '
+                f'with a shared size hashed, {len(groups)} groups of duplicates, {human_size(wasted)} to free')
+
+
+class RemoteFile:
+    # a device file read only where it is looked at: byte ranges come over exec-out pipes of dd, a page at a
+    # time, with the full pages kept; follow() streams what gets appended with tail -f
+    PAGE = 64 << 10
+    # full pages kept in memory
+    PAGES = 64
+
+    def __init__(self, backend, device, path):
+        self.backend = backend
+        self.device = device
+        self.path = path
+        # page number -> bytes, least recently used first
+        self.pages = OrderedDict()
+        self.size = self.stat()
+        self.appended = queue.Queue()
+        self.following = None
+        self.lock = threading.Lock()
+
+    def stat(self):
+        out = self.backend.run(self.device, f'stat -L -c %s {shlex.quote(self.path)}')[1]
+        try:
+            return int(out)
+        except ValueError:
+            raise OSError(f'{self.path}: can\'t be read') from None
+
+    def read(self, start, end):
+        # bytes [start, end) of the file, fewer at its end; pages not in memory come in one dd
+        first, last = start // self.PAGE, -(-end // self.PAGE)
+        missing = [page for page in range(first, last) if page not in self.pages]
+        fetched = {}
+        if missing:
+            cmd = f'dd if={shlex.quote(self.path)} bs={self.PAGE} skip={missing[0]} ' \
+                  f'count={missing[-1] - missing[0] + 1} 2>/dev/null'
+            pipe = self.backend.pipe(self.device, cmd, 'pull')
+            try:
+                data = pipe.stdout.read()
+                pipe.communicate()
+            finally:
+                pipe.close()
+            for page in range(missing[0], missing[-1] + 1):
+                chunk = data[(page - missing[0]) * self.PAGE:(page - missing[0] + 1) * self.PAGE]
+                fetched[page] = chunk
+                # the last page may still grow, only full ones are kept
+                if len(chunk) == self.PAGE:
+                    self.pages[page] = chunk
+            self.size = max(self.size, missing[0] * self.PAGE + len(data))
+        data = b''.join(fetched[page] if page in fetched else self.pages[page] for page in range(first, last))
+        for page in range(first, last):
+            if page in self.pages:
+                self.pages.move_to_end(page)
+        while len(self.pages) > self.PAGES:
+            self.pages.popitem(False)
+        return data[start - first * self.PAGE:end - first * self.PAGE]
+
+    def follow(self, offset):
+        # streams the bytes from offset on into appended as (offset, data), new ones as they are written
+        self.unfollow()
+        pipe = self.backend.pipe(self.device, f'tail -c +{offset + 1} -f {shlex.quote(self.path)}', 'pull', False)
+        with self.lock:
+            self.following = pipe
+
+        def read():
+            position = offset
+            for data in iter(lambda: pipe.stdout.read1(self.PAGE), b''):
+                self.appended.put((position, data))
+                position += len(data)
+                self.size = max(self.size, position)
+
+        threading.Thread(target=read, daemon=True).start()
+
+    def unfollow(self):
+        with self.lock:
+            pipe, self.following = self.following, None
+        if pipe is not None:
+            pipe.terminate()
+            pipe.communicate()
+
+
+def parse_md5sum(line):
+    # (digest, path) from a line of md5sum output; names with a newline or backslash come escaped, on a line
+    # marked with a leading backslash
+    line = line.decode(errors='replace')
+    if line.startswith('\\'):
+        line = re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), line[1:])
+    digest, _, path = line.partition('  ')
+    return digest, path
+
+
+def file_md5(path):
+    # runs in the hashing processes of a TransferManager, so it lives at module level; None if unreadable
+    digest = hashlib.md5()
+    try:
+        with open(path, 'rb') as file:
+            for data in iter(lambda: file.read(1 << 20), b''):
+                digest.update(data)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def human_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+def local_size(path):
+    # bytes under a local file or directory, tolerating files that appear or vanish while counting
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+    except OSError:
+        return 0
+    total = 0
+    for parent, dirs, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(parent, name))
+            except OSError:
+                pass
+    return total
+
+
+def local_manifest(path):
+    # {relative posix path: (size, mtime)} of every file under a local directory
+    manifest = {}
+    for parent, dirs, names in os.walk(path):
+        for name in names:
+            local_path = os.path.join(parent, name)
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                continue
+            manifest[pathlib.Path(os.path.relpath(local_path, path)).as_posix()] = (stat.st_size, int(stat.st_mtime))
+    return manifest
+
+
+class Transfer:
+    # one adb push or pull; progress is measured by counting the bytes that have arrived at target
+    QUEUED = 'Queued'
+    RUNNING = 'Running'
+    VERIFYING = 'Verifying'
+    DONE = 'Done'
+    FAILED = 'Failed'
+    CANCELLED = 'Cancelled'
+
+    def __init__(self, device, direction, src, dst, target=None, size=None, on_done=None, preserve=False,
+                 archive=None, resume=None):
+        self.device = device
+        self.direction = direction
+        self.src = src
+        self.dst = dst
+        self.target = target or dst
+        self.size = size
+        self.on_done = on_done
+        # keep the modification time of pulled files, like adb pull -a; adbd always keeps it on a push
+        self.preserve = preserve
+        # whether a directory goes as one tar stream: None decides from a scan of it, and once running
+        # archived holds the compression of the stream, or None if it went file by file
+        self.archive = archive
+        self.archived = None
+        # whether a file pull goes in resumable chunks: None decides by its size
+        self.resume = resume
+        self.state = Transfer.QUEUED
+        self.transferred = 0
+        self.rate = 0
+        # bytes of the files already finished, for backends that count per file
+        self.base = 0
+        self.last = None
+        self.started = None
+        self.finished = None
+        self.error = b''
+        self.proc = None
+        # with verification on: the (remote, local) paths the copy lands at, the files found intact, the
+        # transfers sending the others again, and how many sends of these files came before this one
+        self.landed = None
+        self.checked = None
+        self.children = []
+        self.attempt = 0
+        self.cancelled = threading.Event()
+        # set once the transfer has finished one way or another, for threads that wait on it
+        self.done = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        proc = self.proc
+        if proc and proc.poll() is None:
+            proc.terminate()
+        for child in self.children:
+            child.cancel()
+
+    def active(self):
+        return self.state in (Transfer.QUEUED, Transfer.RUNNING, Transfer.VERIFYING)
+
+    def sample(self, transferred):
+        now = time.monotonic()
+        self.transferred = transferred
+        if self.last is None:
+            self.last = (self.started, 0)
+        if now - self.last[0] < 0.2:
+            return
+        rate = (transferred - self.last[1]) / (now - self.last[0])
+        # smooth the rate so the ETA doesn't jump around with every sample
+        self.rate = rate if not self.rate else self.rate * 0.7 + rate * 0.3
+        self.last = (now, transferred)
+
+    def progress(self):
+        if self.state == Transfer.DONE:
+            return 1
+        if not self.size:
+            return None
+        return min(self.transferred / self.size, 1)
+
+    def eta(self):
+        if self.state != Transfer.RUNNING or not self.size or not self.rate:
+            return None
+        return max(self.size - self.transferred, 0) / self.rate
+
+    def describe(self):
+        progress = self.progress()
+        text = f'{self.state}: {self.direction} {self.src} -> {self.dst}'
+        if self.archived is not None:
+            text += f' (tar{"+" + self.archived if self.archived else ""})'
+        if self.state == Transfer.RUNNING:
+            text += f' [{progress:.0%}]' if progress is not None else f' [{human_size(self.transferred)}]'
+            text += f' {human_size(int(self.rate))}/s'
+            eta = self.eta()
+            if eta is not None:
+                text += f' ETA {int(eta) // 60}:{int(eta) % 60:02d}'
+        elif self.state == Transfer.DONE and self.finished > self.started:
+            text += f' ({human_size(int(self.size or self.transferred))} at ' \
+                    f'{human_size(int((self.size or self.transferred) / (self.finished - self.started)))}/s)'
+        if self.checked is not None and self.state != Transfer.FAILED:
+            text += f' [{self.checked} files verified' + (f', {len(self.children)} sent again]' if self.children
+                                                           else ']')
+        elif self.state == Transfer.FAILED and self.error.strip():
+            text += f' ({self.error.decode(errors="replace").strip().splitlines()[-1]})'
+        return text
+
+
+class TransferManager:
+    # runs pushes and pulls on worker threads, at most limit of them per device at a time; the Tk thread
+    # polls completed() to act on finished jobs
+
+    def __init__(self, backend, workers=16, limit=3, interval=0.5, compress=False, verify=False):
+        self.backend = backend
+        self.interval = interval
+        self.limit = limit
+        self.compress = compress
+        # compare every finished transfer with checksums taken on the device, and send what differs again
+        self.verify = verify
+        # processes hashing the local side of verified transfers, started on first use
+        self.hashers = None
+        self.limits = {}
+        self.pending = []
+        self.running = {}
+        self.finished = queue.Queue()
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, transfer):
+        with self.ready:
+            self.transfers.append(transfer)
+            self.pending.append(transfer)
+            self.ready.notify()
+        return transfer
+
+    def set_limit(self, limit, device=None):
+        # concurrent transfers per device; small files leave the link idle between files, so several
+        # streams at once keep it busy
+        with self.ready:
+            if device is None:
+                self.limit = limit
+            else:
+                self.limits[device] = limit
+            self.ready.notify_all()
+
+    def next_job(self):
+        # the oldest pending transfer whose device has a free slot
+        with self.ready:
+            while True:
+                for index, transfer in enumerate(self.pending):
+                    if self.running.get(transfer.device, 0) < self.limits.get(transfer.device, self.limit):
+                        del self.pending[index]
+                        self.running[transfer.device] = self.running.get(transfer.device, 0) + 1
+                        return transfer
+                self.ready.wait()
+
+    def summary(self):
+        # aggregate progress of the unfinished transfers, across all devices
+        running = self.active()
+        if not running:
+            return None
+        size = sum(transfer.size or 0 for transfer in running)
+        done = sum(min(transfer.transferred, transfer.size or 0) for transfer in running)
+        rate = sum(transfer.rate for transfer in running if transfer.state == Transfer.RUNNING)
+        active = sum(1 for transfer in running if transfer.state == Transfer.RUNNING)
+        text = f'{active} running, {len(running) - active} queued'
+        if size:
+            text += f', {done / size:.0%} of {human_size(size)}'
+        return text + f', {human_size(int(rate))}/s'
+
+    def active(self):
+        with self.lock:
+            return [transfer for transfer in self.transfers if transfer.active()]
+
+    def clear_finished(self):
+        with self.lock:
+            self.transfers = [transfer for transfer in self.transfers if transfer.active()]
+
+    def cancel_all(self):
+        for transfer in self.active():
+            transfer.cancel()
+
+    def completed(self):
+        # finished transfers since the last call, for running their on_done on the Tk thread
+        done = []
+        while True:
+            try:
+                done.append(self.finished.get_nowait())
+            except queue.Empty:
+                return done
+
+    @bulk
+    def worker(self):
+        while True:
+            transfer = self.next_job()
+            try:
+                if not transfer.cancelled.is_set():
+                    self.run(transfer)
+            except Exception:
+                transfer.state = Transfer.FAILED
+                transfer.error = traceback.format_exc().encode()
+            if transfer.cancelled.is_set():
+                transfer.state = Transfer.CANCELLED
+            elif transfer.state == Transfer.RUNNING:
+                transfer.state = Transfer.FAILED
+            transfer.finished = time.monotonic()
+            with self.ready:
+                self.running[transfer.device] -= 1
+                self.ready.notify_all()
+            if transfer.state == Transfer.DONE and self.verify and transfer.landed:
+                # the slot already went to the next transfer, which runs while this one is checked
+                transfer.state = Transfer.VERIFYING
+                threading.Thread(target=self.check, args=(transfer,), daemon=True).start()
+            else:
+                self.finish(transfer)
+
+    def finish(self, transfer):
+        transfer.done.set()
+        self.finished.put(transfer)
+
+    def run(self, transfer):
+        transfer.state = Transfer.RUNNING
+        transfer.started = time.monotonic()
+        if self.verify:
+            transfer.landed = self.landing(transfer)
+        compression = self.archive_mode(transfer)
+        if transfer.size is None:
+            if transfer.direction == 'pull':
+                transfer.size = self.backend.size(transfer.device, transfer.src)
+            else:
+                transfer.size = local_size(transfer.src)
+        succeeded = None
+        if compression is not None:
+            succeeded = self.backend.archive(transfer, compression)
+        elif transfer.direction == 'pull' and (transfer.resume or transfer.resume is None and
+                                               (transfer.size or 0) >= RESUME_MIN_SIZE):
+            succeeded = self.backend.pull_ranges(transfer)
+        if succeeded is None:
+            succeeded = self.backend.transfer(transfer, self.interval)
+        if transfer.cancelled.is_set():
+            # a half-written single file is useless unless a journal says which of it arrived, so pulling it
+            # again resumes; a half-pulled directory still holds complete files
+            if transfer.direction == 'pull' and os.path.isfile(transfer.target) and \
+                    not os.path.isfile(transfer.target + '.journal'):
+                try:
+                    os.remove(transfer.target)
+                except OSError:
+                    pass
+        elif succeeded:
+            transfer.state = Transfer.DONE
+            transfer.transferred = transfer.size or transfer.transferred
+
+    def landing(self, transfer):
+        # (remote, local) paths of the copy a transfer makes; adb puts it inside dst when dst is an existing
+        # directory, so this is worked out before the transfer creates it
+        if transfer.direction == 'pull':
+            local = transfer.target
+            if os.path.isdir(local):
+                local = os.path.join(local, pathlib.PurePosixPath(transfer.src).name)
+            return transfer.src, local
+        remote = transfer.target
+        if remote == transfer.dst and self.backend.run(transfer.device, f'[ -d {shlex.quote(remote)} ]')[0] == 0:
+            remote = str(pathlib.PurePosixPath(remote, pathlib.Path(transfer.src).name))
+        return remote, transfer.src
+
+    def local_checksums(self, path):
+        # ([relative posix paths], iterator of their md5s) of a local file ('') or of the files under a
+        # directory; hashing starts in the process pool right away, so the device can be asked meanwhile
+        if os.path.isdir(path):
+            files = {}
+            for parent, dirs, names in os.walk(path):
+                for name in names:
+                    local_path = os.path.join(parent, name)
+                    # a link goes as a link, the device side doesn't hash those either
+                    if not os.path.islink(local_path):
+                        files[pathlib.Path(os.path.relpath(local_path, path)).as_posix()] = local_path
+        else:
+            files = {'': path}
+        if self.hashers is None:
+            try:
+                self.hashers = ProcessPoolExecutor()
+            except (OSError, NotImplementedError):
+                # no multiprocessing here: hash on this thread
+                self.hashers = False
+        if not self.hashers or len(files) < 2 and local_size(path) < RESUME_CHUNK:
+            return list(files), map(file_md5, files.values())
+        chunk = max(1, len(files) // (4 * (os.cpu_count() or 1)))
+        return list(files), self.hashers.map(file_md5, files.values(), chunksize=chunk)
+
+    @bulk
+    def check(self, transfer):
+        # the verify stage, on a thread of its own: checksums of the device side in one shell call and of the
+        # local side in the process pool, then the files that differ go again as transfers of their own
+        try:
+            remote, local = transfer.landed
+            names, hashing = self.local_checksums(local)
+            remote_sums = self.backend.checksums(transfer.device, remote)
+            local_sums = dict(zip(names, hashing))
+            source, copy = (remote_sums, local_sums) if transfer.direction == 'pull' else (local_sums, remote_sums)
+            if not remote_sums and local_sums:
+                raise OSError(f'{remote}: no checksums from the device')
+            differ = sorted(name for name, digest in source.items() if digest is None or copy.get(name) != digest)
+            transfer.checked = len(source) - len(differ)
+            if differ and transfer.attempt >= VERIFY_RETRIES:
+                transfer.state = Transfer.FAILED
+                transfer.error = f'{len(differ)} files still differ after {VERIFY_RETRIES + 1} tries: ' \
+                                 f'{", ".join(differ[:5]) or transfer.src}'.encode()
+                return
+            for name in differ:
+                remote_path = str(pathlib.PurePosixPath(remote, name)) if name else remote
+                local_path = os.path.join(local, *name.split('/')) if name else local
+                if transfer.direction == 'pull':
+                    child = Transfer(transfer.device, 'pull', remote_path, local_path, preserve=transfer.preserve,
+                                     archive=False)
+                else:
+                    child = Transfer(transfer.device, 'push', local_path, remote_path, archive=False)
+                child.attempt = transfer.attempt + 1
+                transfer.children.append(self.submit(child))
+            for child in transfer.children:
+                child.done.wait()
+            failed = [child for child in transfer.children if child.state != Transfer.DONE]
+            if transfer.cancelled.is_set():
+                transfer.state = Transfer.CANCELLED
+            elif failed:
+                transfer.state = Transfer.FAILED
+                # a lone file says why itself, the errors of more are summed up
+                transfer.error = failed[0].error if len(failed) == 1 else \
+                    f'{len(failed)} of the {len(differ)} files that differed failed again, ' \
+                    f'{failed[0].src}: {failed[0].error.decode(errors="replace").strip()}'.encode()
+            else:
+                transfer.checked += len(differ)
+                transfer.state = Transfer.DONE
+        except Exception:
+            transfer.state = Transfer.FAILED
+            transfer.error = traceback.format_exc().encode()
+        finally:
+            self.finish(transfer)
+
+    def archive_mode(self, transfer):
+        # the compression to stream a directory transfer as a tar archive with, or None to go file by file;
+        # unsized pulls are the directories, their scan sizes them on the way
+        if transfer.archive is False:
+            return None
+        if transfer.direction == 'pull':
+            if transfer.size is not None:
+                return None
+            scan = self.backend.scan(transfer.device, transfer.src)
+            if scan is None:
+                return None
+            files, transfer.size = scan
+        else:
+            if not os.path.isdir(transfer.src):
+                return None
+            manifest = local_manifest(transfer.src)
+            files, transfer.size = len(manifest), sum(size for size, mtime in manifest.values())
+        if not transfer.archive and (files < ARCHIVE_MIN_FILES or transfer.size >= files * ARCHIVE_MAX_AVERAGE):
+            return None
+        return self.backend.archive_compression(transfer.device, transfer.direction, self.compress)
+
+
+class Mirror:
+    # makes a local folder match a device directory (pull) or the other way round (push) by transferring only
+    # new or changed files, in parallel on a TransferManager. The device side is walked in one manifest pass,
+    # and the manifest is saved so the next run can start transferring from it while the device is walked again
+    MANIFESTS = os.path.join('cache', 'manifests')
+    # FAT-backed storage only keeps even seconds
+    SLACK = 2
+
+    def __init__(self, device, direction, remote, local, delete=False):
+        self.device = device
+        self.direction = direction
+        self.remote = str(pathlib.PurePosixPath(remote))
+        self.local = local
+        self.delete = delete
+        self.transfers = {}
+        self.deleted = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def manifest_file(self):
+        key = '\0'.join((self.device, self.remote, os.path.abspath(self.local)))
+        return os.path.join(Mirror.MANIFESTS, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def load(self):
+        try:
+            with open(self.manifest_file(), 'rt') as f:
+                return {name: tuple(value) for name, value in json.load(f)['files'].items()}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, remote):
+        os.makedirs(Mirror.MANIFESTS, exist_ok=True)
+        with open(self.manifest_file(), 'wt') as f:
+            json.dump({'device': self.device, 'remote': self.remote, 'local': self.local, 'files': remote}, f)
+
+    def changed(self, source, dest):
+        # the files of source that dest lacks or holds in another version
+        return [name for name, (size, mtime) in source.items()
+                if name not in dest or dest[name][0] != size or abs(dest[name][1] - mtime) > Mirror.SLACK]
+
+    def queue(self, manager, remote, local):
+        source, dest = (remote, local) if self.direction == 'pull' else (local, remote)
+        for name in self.changed(source, dest):
+            if name in self.transfers:
+                continue
+            remote_path = f'{self.remote.rstrip("/")}/{name}'
+            local_path = os.path.join(self.local, *name.split('/'))
+            if self.direction == 'pull':
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                transfer = Transfer(self.device, 'pull', remote_path, local_path, size=source[name][0], preserve=True)
+            else:
+                transfer = Transfer(self.device, 'push', local_path, remote_path, size=source[name][0])
+            self.transfers[name] = manager.submit(transfer)
+
+    @bulk
+    def run(self, manager):
+        try:
+            self.sync(manager)
+        except Exception as ex:
+            self.error = ex
+            self.cancel()
+        finally:
+            self.done.set()
+
+    def sync(self, manager):
+        backend = manager.backend
+        local = local_manifest(self.local)
+        saved = self.load()
+        if saved is not None:
+            self.queue(manager, saved, local)
+        if self.direction == 'push':
+            backend.check_output(self.device, ['mkdir', '-p', self.remote])
+        remote = backend.manifest(self.device, self.remote)
+        if self.direction == 'pull':
+            # files pulled from the saved manifest that have since gone from the device
+            for name, transfer in self.transfers.items():
+                if name not in remote:
+                    transfer.cancel()
+        self.queue(manager, remote, local)
+        if self.delete:
+            self.delete_orphans(backend, remote, local)
+        for name, transfer in self.transfers.items():
+            transfer.done.wait()
+            if self.direction == 'push' and transfer.state == Transfer.DONE:
+                remote[name] = local[name]
+        self.save(remote)
+
+    def delete_orphans(self, backend, remote, local):
+        # removes the files of the destination that the source doesn't have; directories are left in place
+        if self.direction == 'pull':
+            for name in local.keys() - remote.keys():
+                try:
+                    os.remove(os.path.join(self.local, *name.split('/')))
+                    self.deleted += 1
+                except OSError:
+                    pass
+            return
+        prefix = self.remote.rstrip('/') + '/'
+        for batch in command_batches(prefix + name for name in sorted(remote.keys() - local.keys())):
+            backend.check_output(self.device, ['rm', '-f', *batch])
+            for path in batch:
+                del remote[path[len(prefix):]]
+            self.deleted += len(batch)
+
+    def cancel(self):
+        for transfer in list(self.transfers.values()):
+            transfer.cancel()
+
+    def describe(self):
+        states = [transfer.state for transfer in self.transfers.values()]
+        text = (f'{self.direction} {self.remote} {"->" if self.direction == "pull" else "<-"} {self.local}: '
+                f'{states.count(Transfer.DONE)} transferred')
+        for state in (Transfer.FAILED, Transfer.CANCELLED):
+            if states.count(state):
+                text += f', {states.count(state)} {state.lower()}'
+        if self.deleted:
+            text += f', {self.deleted} deleted'
+        return text
+
+
+class DeviceJob:
+    # the part of a FanOut that runs on one device
+    def __init__(self, device):
+        self.device = device
+        self.state = Transfer.QUEUED
+        self.transfers = []
+        self.output = b''
+        self.error = ''
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        for transfer in self.transfers:
+            transfer.cancel()
+
+    def transferred(self):
+        return sum(transfer.transferred for transfer in self.transfers)
+
+    def describe(self):
+        text = f'{self.device}: {self.state}'
+        if self.transfers:
+            size = sum(transfer.size or 0 for transfer in self.transfers)
+            text += f', {human_size(self.transferred())}' + (f' of {human_size(size)}' if size else '')
+            if self.state == Transfer.RUNNING:
+                rate = sum(transfer.rate for transfer in self.transfers if transfer.state == Transfer.RUNNING)
+                text += f' at {human_size(int(rate))}/s'
+            elif self.finished and self.finished > self.started:
+                text += f' at {human_size(int(self.transferred() / (self.finished - self.started)))}/s'
+        if self.started and self.finished:
+            text += f' in {self.finished - self.started:.1f}s'
+        lines = (self.error or self.output.decode(errors='replace')).strip().splitlines()
+        if lines:
+            text += f' - {lines[-1]}'
+        return text
+
+
+class FanOut:
+    # runs one operation on several devices in parallel, at most limit devices at a time. Each device goes at its
+    # own pace, and one that takes longer than timeout seconds is given up on so its slot goes to the next one:
+    # a stuck phone can't hold up the rest. Operations: ('push', [local paths], remote dir),
+    # ('delete', [remote paths]) and ('shell', command)
+    def __init__(self, manager, devices, operation, args, limit=4, timeout=None, offline=()):
+        self.manager = manager
+        self.operation = operation
+        self.args = args
+        self.limit = limit
+        self.timeout = timeout
+        self.jobs = [DeviceJob(device) for device in devices]
+        self.running = 0
+        self.changed = threading.Condition()
+        self.done = threading.Event()
+        for job in self.jobs:
+            if job.device in offline:
+                job.state = Transfer.FAILED
+                job.error = 'device is offline'
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        with self.changed:
+            for job in self.jobs:
+                if job.state != Transfer.QUEUED:
+                    continue
+                while self.running >= self.limit:
+                    self.changed.wait(1)
+                    self.expire()
+                if job.cancelled.is_set():
+                    job.state = Transfer.CANCELLED
+                    continue
+                self.running += 1
+                job.state = Transfer.RUNNING
+                job.started = time.monotonic()
+                threading.Thread(target=self.work, args=(job,), daemon=True).start()
+            while self.running:
+                self.changed.wait(1)
+                self.expire()
+        self.done.set()
+
+    def expire(self):
+        # called with the lock held: frees the slots of the devices that have run out of time
+        for job in self.jobs:
+            if job.state == Transfer.RUNNING and self.timeout and time.monotonic() - job.started > self.timeout:
+                job.error = f'gave up after {self.timeout}s'
+                self.end(job, Transfer.FAILED)
+                job.cancel()
+
+    def end(self, job, state):
+        job.state = state
+        job.finished = time.monotonic()
+        self.running -= 1
+        self.changed.notify_all()
+
+    @bulk
+    def work(self, job):
+        state = Transfer.DONE
+        try:
+            if not self.operate(job):
+                state = Transfer.FAILED
+        except subprocess.CalledProcessError as ex:
+            job.error = (ex.stderr or b'').decode(errors='replace').strip() or str(ex)
+            state = Transfer.FAILED
+        except Exception as ex:
+            job.error = str(ex) or type(ex).__name__
+            state = Transfer.FAILED
+        if job.cancelled.is_set() and state != Transfer.DONE:
+            state = Transfer.CANCELLED
+        with self.changed:
+            # a device given up on has already handed its slot over
+            if job.state == Transfer.RUNNING:
+                self.end(job, state)
+
+    def operate(self, job):
+        backend = self.manager.backend
+        if self.operation == 'push':
+            paths, remote = self.args
+            job.transfers = [Transfer(job.device, 'push', path, remote) for path in paths]
+            for transfer in job.transfers:
+                self.manager.submit(transfer)
+            for transfer in job.transfers:
+                transfer.done.wait()
+            failed = [transfer for transfer in job.transfers if transfer.state != Transfer.DONE]
+            if failed:
+                job.error = failed[0].error.decode(errors='replace').strip() or f'{len(failed)} pushes failed'
+            return not failed
+        if self.operation == 'delete':
+            backend.check_output(job.device, ['rm', '-rf', *self.args])
+            return True
+        returncode, job.output, err = backend.run(job.device, self.args)
+        if returncode:
+            job.error = err.decode(errors='replace').strip() or f'exit status {returncode}'
+        return returncode == 0
+
+    def cancel(self):
+        for job in self.jobs:
+            job.cancel()
+        with self.changed:
+            self.changed.notify_all()
+
+    def summary(self):
+        states = [job.state for job in self.jobs]
+        return ', '.join(f'{states.count(state)} {state.lower()}' for state in
+                         (Transfer.RUNNING, Transfer.QUEUED, Transfer.DONE, Transfer.FAILED, Transfer.CANCELLED)
+                         if states.count(state))
+
+
+class VirtualList(Frame):
+    # a listbox that only holds the rows in view, so its cost in Tk doesn't grow with the number of items;
+    # items can be any objects and are shown through format
+
+    def __init__(self, master, format=str, **kwargs):
+        Frame.__init__(self, master)
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.items = []
+        self.format = format
+        self.top = 0
+        self.rows = 1
+        self.active = None
+        self.anchor = None
+        self.selected = set()
+        self.listbox = Listbox(self, exportselection=False, **kwargs)
+        self.multiple = self.listbox['selectmode'] in (EXTENDED, MULTIPLE)
+        self.listbox.grid(sticky='nsew', row=0, column=0)
+        self.scrollbar = Scrollbar(self, command=self.yview)
+        self.scrollbar.grid(sticky='ns', row=0, column=1)
+        self.listbox.bind('<Configure>', self.resize)
+        self.listbox.bind('<<ListboxSelect>>', self.select)
+        self.listbox.bind('<MouseWheel>', lambda e: self.yview('scroll', -3 if e.delta > 0 else 3, 'units'))
+        self.listbox.bind('<Button-4>', lambda e: self.yview('scroll', -3, 'units'))
+        self.listbox.bind('<Button-5>', lambda e: self.yview('scroll', 3, 'units'))
+        # clicks and keys are handled here, since Tk only knows about the rows in view
+        self.listbox.bind('<Button-1>', lambda e: self.click(e))
+        self.listbox.bind('<Shift-Button-1>', lambda e: self.click(e, extend=True))
+        self.listbox.bind('<Control-Button-1>', lambda e: self.click(e, toggle=True))
+        self.listbox.bind('<B1-Motion>', self.drag)
+        self.listbox.bind('<Control-a>', lambda e: self.select_all())
+        for key in ('Up', 'Down', 'Prior', 'Next', 'Home', 'End'):
+            self.listbox.bind(f'<{key}>', lambda e, key=key: self.move(self.step(key)))
+            self.listbox.bind(f'<Shift-{key}>', lambda e, key=key: self.move(self.step(key), True))
+
+    def bind(self, sequence=None, func=None, add=None):
+        return self.listbox.bind(sequence, func, add)
+
+    def focus_set(self):
+        self.listbox.focus_set()
+
+    def set(self, items, reset=False):
+        # replaces the items; the selection follows the selected objects to wherever they are now
+        if reset:
+            self.top = 0
+            self.active = None
+            self.anchor = None
+            self.selected = set()
+        elif self.selected:
+            kept = {id(self.items[index]) for index in self.selected if index < len(self.items)}
+            self.selected = {index for index, item in enumerate(items) if id(item) in kept}
+        self.items = items
+        self.scroll_to(self.top)
+
+    def curselection(self):
+        return tuple(sorted(self.selected))
+
+    def resize(self, event):
+        # the usable height divided by the height Tk gives each listbox line
+        line = int(self.tk.call('font', 'metrics', self.listbox['font'], '-linespace')) + 1 + \
+            2 * int(self.listbox['selectborderwidth'])
+        border = 2 * (int(self.listbox['borderwidth']) + int(self.listbox['highlightthickness']))
+        rows = max(1, (event.height - border) // line)
+        if rows != self.rows:
+            self.rows = rows
+            self.scroll_to(self.top)
+
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.scroll_to(int(float(args[1]) * len(self.items)))
+        elif args[0] == 'scroll':
+            self.scroll_to(self.top + int(args[1]) * (self.rows if args[2] == 'pages' else 1))
+
+    def scroll_to(self, top):
+        self.top = max(0, min(top, len(self.items) - self.rows))
+        self.redraw()
+
+    def see(self, index):
+        if index < self.top:
+            self.scroll_to(index)
+        elif index >= self.top + self.rows:
+            self.scroll_to(index - self.rows + 1)
+
+    def redraw(self):
+        end = min(self.top + self.rows, len(self.items))
+        self.listbox.delete(0, END)
+        self.listbox.insert(END, *[self.format(item) for item in self.items[self.top:end]])
+        for index in self.selected:
+            if self.top <= index < end:
+                self.listbox.selection_set(index - self.top)
+        if self.active is not None and self.top <= self.active < end:
+            self.listbox.activate(self.active - self.top)
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items), end / len(self.items))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def select(self, event):
+        visible = {self.top + index for index in self.listbox.curselection()}
+        if self.multiple:
+            # rows out of view keep their selection
+            end = self.top + self.rows
+            self.selected = {index for index in self.selected if not self.top <= index < end} | visible
+        else:
+            self.selected = visible
+        if visible:
+            self.active = self.top + self.listbox.index(ACTIVE)
+
+    def choose(self, index, extend=False, toggle=False):
+        if extend and self.multiple and self.anchor is not None:
+            self.selected = set(range(min(self.anchor, index), max(self.anchor, index) + 1))
+        elif toggle and self.multiple:
+            self.selected ^= {index}
+            self.anchor = index
+        else:
+            self.selected = {index}
+            self.anchor = index
+        self.active = index
+        self.see(index)
+        self.redraw()
+        self.listbox.event_generate('<<ListboxSelect>>')
+
+    def click(self, event, extend=False, toggle=False):
+        self.listbox.focus_set()
+        if self.items:
+            self.choose(min(self.top + self.listbox.nearest(event.y), len(self.items) - 1), extend, toggle)
+        return 'break'
+
+    def drag(self, event):
+        if not self.items or not self.multiple or self.anchor is None:
+            return 'break'
+        # dragging past the edge scrolls
+        if event.y < 0:
+            self.scroll_to(self.top - 1)
+        elif event.y > self.listbox.winfo_height():
+            self.scroll_to(self.top + 1)
+        self.choose(min(self.top + self.listbox.nearest(event.y), len(self.items) - 1), True)
+        return 'break'
+
+    def select_all(self):
+        if self.multiple:
+            self.selected = set(range(len(self.items)))
+            self.redraw()
+            self.listbox.event_generate('<<ListboxSelect>>')
+        return 'break'
+
+    def step(self, key):
+        return {'Up': -1, 'Down': 1, 'Prior': -self.rows, 'Next': self.rows, 'Home': -len(self.items),
+                'End': len(self.items)}[key]
+
+    def move(self, delta, extend=False):
+        if self.items:
+            index = self.active + delta if self.active is not None else 0
+            self.choose(max(0, min(index, len(self.items) - 1)), extend)
+        return 'break'
 
 
 # noinspection PyTypeChecker,PyGlobalUndefined
@@ -42,8 +3526,52 @@ class ADBfm:
         global cut
         global hidden
         global adb
+        global backend
+        global server
+        global sort_by
+        global sort_reverse
+        global transfer_limit
+        global compress
+        global verify
+        global listings
+        global prefetcher
+        global transfers
+        global transfers_list
+        global tracker
+        global file_cache
+        global indexes
+        global find_list
+        global usage_scans
+        global usage_sort
+        global readers
+        global commands
+        global scheduler
+        global bulk_bandwidth
+        global operations_list
+        global auto_connect
+        global connected
+        global painted
+        global stale_since
+        global last_device
+        global last_dir
+        global watch
+        global watcher
         cut = False
+        watcher = None
+        connected = None
+        painted = False
+        stale_since = None
         garbage = []
+        transfers_list = None
+        find_list = None
+        operations_list = None
+        commands = CommandLog()
+        indexes = {}
+        usage_scans = {}
+        # the (sort_by, sort_reverse) the disk usage view replaced while it is on, put back when it goes off
+        usage_sort = None
+        # duplicate scans and file viewers, which hold the backend for as long as their window is open
+        readers = []
         if sys.platform.startswith('linux'):
             system = 'linux'
         elif sys.platform.startswith('darwin'):
@@ -63,15 +3591,57 @@ class ADBfm:
                 f = open('config.json', 'xt')
                 self.adb_config(self.root, True)
                 hidden = BooleanVar(value=False)
-                f.write(json.dumps({'ADB_Path': adb, 'Show_Hidden': False}))
+                server = BooleanVar(value=False)
+                sort_by = StringVar(value='name')
+                sort_reverse = BooleanVar(value=False)
+                transfer_limit = IntVar(value=3)
+                compress = BooleanVar(value=False)
+                verify = BooleanVar(value=False)
+                file_cache_size = 1024
+                auto_connect = BooleanVar(value=True)
+                watch = BooleanVar(value=False)
+                bulk_bandwidth = IntVar(value=0)
+                last_device = None
+                last_dir = '/'
+                f.write(json.dumps({'ADB_Path': adb, 'Show_Hidden': False, 'Use_Server': False, 'Sort_By': 'name',
+                                    'Sort_Reverse': False, 'Transfer_Limit': 3, 'Compress': False,
+                                    'Verify': False, 'File_Cache_Size': 1024, 'Auto_Connect': True,
+                                    'Last_Device': None, 'Last_Dir': '/', 'Watch': False, 'Bulk_Bandwidth': 0}))
                 f.close()
             else:
                 f = open('config.json', 'rt')
                 config_data = json.loads(f.read())
                 f.close()
                 hidden = BooleanVar(value=config_data['Show_Hidden'])
+                server = BooleanVar(value=config_data.get('Use_Server', False))
+                sort_by = StringVar(value=config_data.get('Sort_By', 'name'))
+                sort_reverse = BooleanVar(value=config_data.get('Sort_Reverse', False))
+                transfer_limit = IntVar(value=config_data.get('Transfer_Limit', 3))
+                compress = BooleanVar(value=config_data.get('Compress', False))
+                verify = BooleanVar(value=config_data.get('Verify', False))
+                # MiB of opened files kept between sessions
+                file_cache_size = config_data.get('File_Cache_Size', 1024)
+                # the device and directory of the last session, reopened at startup
+                auto_connect = BooleanVar(value=config_data.get('Auto_Connect', True))
+                last_device = config_data.get('Last_Device')
+                last_dir = config_data.get('Last_Dir', '/')
+                watch = BooleanVar(value=config_data.get('Watch', False))
+                # MB/s per device for transfers and background scans, 0 for no cap
+                bulk_bandwidth = IntVar(value=config_data.get('Bulk_Bandwidth', 0))
                 adb = config_data['ADB_Path']
-            self.choose_device()
+            scheduler = Scheduler(cap=bulk_bandwidth.get() << 20)
+            backend = make_backend(adb, server.get(), commands, scheduler)
+            listings = ListingCache()
+            # two workers leave at least one pooled shell free for whatever the user does next
+            prefetcher = ThreadPoolExecutor(max_workers=2)
+            transfers = TransferManager(backend, limit=transfer_limit.get(), compress=compress.get(),
+                                        verify=verify.get())
+            tracker = DeviceTracker(backend)
+            file_cache = FileCache(budget=file_cache_size << 20)
+            if auto_connect.get() and last_device:
+                self.file_manager(last_device, self.root, last_dir)
+            else:
+                self.choose_device()
         except Exception:
             messagebox.showerror('An exception has occurred:', traceback.format_exc())
             raise
@@ -138,29 +3708,47 @@ class ADBfm:
 
     def choose_device(self):
         try:
-            devices = None
+            devices = []
             devices_friendly = None
-            status = None
+            status = []
             devs_var = StringVar()
+            shown = None
 
-            def reload_devs():
+            def reload_devs(force=False):
                 nonlocal devices
                 nonlocal devices_friendly
                 nonlocal status
                 nonlocal devs_var
-                devices = subprocess.check_output([adb, 'devices']).decode().split()[4:]
-                devices_friendly = [f'{devices[i]}: {devices[i + 1]}'
-                                    for i in range(0, len(devices) - 1, 2)]
-                status = devices[1::2]
-                devices = devices[::2]
+                nonlocal shown
+                if force:
+                    tracker.refresh()
+                if shown == tracker.version:
+                    return
+                shown = tracker.version
+                # keep the selected device selected as the list changes under it
+                selected = [devices[index] for index in devices_list.curselection() if index < len(devices)]
+                found = tracker.devices
+                devices_friendly = [tracker.describe(*device) for device in found]
+                status = [state for serial, state, info in found]
+                devices = [serial for serial, state, info in found]
                 devs_var.set(value=devices_friendly)
+                devices_list.selection_clear(0, END)
+                for serial in selected:
+                    if serial in devices:
+                        devices_list.selection_set(devices.index(serial))
 
-            # find devices
-            reload_devs()
+            def poll_devs():
+                if chooser_frame.winfo_exists():
+                    reload_devs()
+                    chooser_frame.after(250, poll_devs)
+
+            # follow devices as they come and go
+            tracker.backend = backend
+            tracker.start()
 
             # configure root
             self.root.title('Pick device')
-            self.root.geometry('200x250')
+            self.root.geometry('400x250')
 
             # create the frame
             chooser_frame = Frame(self.root)
@@ -188,9 +3776,9 @@ class ADBfm:
 
             # create the label, refresh button and listbox
             Label(ribbon, text='Select device:').grid(row=0, column=0)
-            reload_button = Button(ribbon, image=refresh, command=reload_devs)
+            reload_button = Button(ribbon, image=refresh, command=lambda: reload_devs(True))
             reload_button.grid(sticky='e', row=0, column=1)
-            devices_list = Listbox(chooser_frame, listvariable=devs_var, justify=CENTER)
+            devices_list = Listbox(chooser_frame, listvariable=devs_var, justify=CENTER, selectmode=EXTENDED)
             devices_list.grid(sticky='nsew', row=1, column=0)
 
             # create the button
@@ -199,6 +3787,9 @@ class ADBfm:
                            devices_list.curselection(), self.root, devices, status, chooser_frame))
             b.grid(row=2, column=0)
             self.root.bind('<Return>', lambda e: b.invoke())
+            # the tracker fills the list as soon as the server answers, there is no need to wait for it here
+            reload_devs()
+            poll_devs()
 
             try:
                 self.root.mainloop()
@@ -211,14 +3802,23 @@ class ADBfm:
     def connect(self, device, root, devices, status, chooser_frame):
         if device == ():
             messagebox.showinfo(message='No device selected!')
+        elif len(device) > 1:
+            # several devices are worked on together, the chooser stays open behind them
+            self.fan_out_window(root, [devices[index] for index in device])
         else:
+            tracker.stop()
             chooser_frame.destroy()
             root.unbind('<Return>')
             if not status[device[0]] == 'device':
-                subprocess.Popen([adb, '-s', devices[device[0]], 'reconnect', 'offline']).wait()
+                with backend.timed(devices[device[0]], 'adb', 'reconnect offline') as command:
+                    command.status = subprocess.Popen([adb, '-s', devices[device[0]], 'reconnect', 'offline']).wait()
             self.file_manager(devices[device[0]], root)
 
-    def file_manager(self, device, root):
+    def file_manager(self, device, root, resume=None):
+        # resume is the directory to reopen the last session's device in, before knowing whether it is there
+        global connected
+        global last_device
+        connected = last_device = device
         try:
             # set title and add frame
             root.title(f'ADB Explorer ({device})')
@@ -228,6 +3828,20 @@ class ADBfm:
             main_frame.columnconfigure(0, weight=1)
             main_frame.rowconfigure(1, weight=1)
 
+            # the disk usage view of the file pane
+            global usage_mode
+            global usage_status
+            global usage_device
+            global usage_sort
+            usage_mode = BooleanVar(value=False)
+            usage_status = StringVar()
+            usage_device = device
+            # the view starts off, so a sort it replaced in a previous file manager goes back
+            if usage_sort:
+                sort_by.set(usage_sort[0])
+                sort_reverse.set(usage_sort[1])
+                usage_sort = None
+
             # create the menubar
             menubar = Menu(main_frame)
             root['menu'] = menubar
@@ -241,17 +3855,36 @@ class ADBfm:
             menubar.add_cascade(menu=menu_info, label='Help')
 
             # add menubar items
-            menu_device.add_command(label='Reconnect',
-                                    command=lambda: subprocess.Popen([adb, '-s', device, 'reconnect', 'device']).wait())
+            menu_device.add_command(label='Reconnect', command=lambda: self.adb_restart(device, 'reconnect', 'device'))
             menu_device.add_command(label='Change device', command=lambda: self.change_device(main_frame))
-            menu_device.add_command(label='Root', command=lambda: subprocess.Popen([adb, '-s', device, 'root']).wait())
-            menu_device.add_command(label='Unroot', command=lambda: subprocess.Popen(
-                [adb, '-s', device, 'unroot']).wait())
+            menu_device.add_command(label='Root', command=lambda: self.adb_restart(device, 'root'))
+            menu_device.add_command(label='Unroot', command=lambda: self.adb_restart(device, 'unroot'))
+            menu_device.add_separator()
+            menu_device.add_checkbutton(label='Use adb server protocol', variable=server, onvalue=True, offvalue=False,
+                                        command=self.switch_backend)
+            menu_device.add_checkbutton(label='Compress bulk transfers', variable=compress, onvalue=True,
+                                        offvalue=False, command=lambda: setattr(transfers, 'compress', compress.get()))
+            menu_device.add_checkbutton(label='Verify transfers', variable=verify, onvalue=True, offvalue=False,
+                                        command=lambda: setattr(transfers, 'verify', verify.get()))
+            menu_device.add_checkbutton(label='Reopen at startup', variable=auto_connect, onvalue=True,
+                                        offvalue=False)
 
             menu_view.add_checkbutton(label='Show hidden files', variable=hidden, onvalue=True, offvalue=False,
-                                      command=lambda: self.reload(device))
+                                      command=lambda: self.show(dir_entries))
+            menu_view.add_checkbutton(label='Disk usage', variable=usage_mode, onvalue=True, offvalue=False,
+                                      command=lambda: self.toggle_usage(device))
+            menu_view.add_checkbutton(label='Watch for changes', variable=watch, onvalue=True, offvalue=False,
+                                      command=lambda: self.toggle_watch(device))
+            menu_sort = Menu(menu_view)
+            menu_view.add_cascade(menu=menu_sort, label='Sort by')
+            for label, value in (('Name', 'name'), ('Size', 'size'), ('Date modified', 'mtime'), ('Type', 'type')):
+                menu_sort.add_radiobutton(label=label, variable=sort_by, value=value,
+                                          command=lambda: self.show(dir_entries))
+            menu_sort.add_separator()
+            menu_sort.add_checkbutton(label='Descending', variable=sort_reverse, onvalue=True, offvalue=False,
+                                      command=lambda: self.show(dir_entries))
 
-            menu_file.add_command(label='Upload file...', command=lambda: self.push(device, root))
+            menu_file.add_command(label='Upload files...', command=lambda: self.push(device, root))
             menu_file.add_command(label='Upload dir...', command=lambda: self.push_dir(device, root))
             menu_file.add_command(label='Download...', command=lambda: self.pull(
                 files.curselection(), device, root, False))
@@ -259,7 +3892,18 @@ class ADBfm:
             menu_file.add_command(label='Copy', command=lambda: self.copy(files.curselection(), menu_file))
             menu_file.add_command(label='Cut', command=lambda: self.cut(files.curselection(), menu_file))
             menu_file.add_command(label='Paste', state=DISABLED, command=lambda: self.paste(device, menu_file))
+            menu_file.add_separator()
+            menu_file.add_command(label='Mirror current dir to folder...', command=lambda: self.mirror(device, 'pull'))
+            menu_file.add_command(label='Mirror folder to current dir...', command=lambda: self.mirror(device, 'push'))
+            menu_file.add_command(label='Transfers...', command=lambda: self.transfers_window(root))
+            menu_file.add_command(label='Find...', accelerator='Ctrl+F', command=lambda: self.find_window(device, root))
+            menu_file.add_command(label='Find duplicates...', command=lambda: self.duplicates_window(device, root))
+            menu_file.add_command(label='View as text...', command=lambda: self.view_selected(
+                files.curselection(), device, root))
 
+            menu_info.add_command(label='Cache statistics...', command=lambda: messagebox.showinfo(
+                'Cache statistics', f'Listings\n{listings.stats()}\n\nOpened files\n{file_cache.stats()}'))
+            menu_info.add_command(label='Operations log...', command=lambda: self.operations_window(root))
             menu_info.add_command(label='About...', command=lambda: self.about(root))
 
             # create the right-click menu
@@ -275,6 +3919,8 @@ class ADBfm:
             menu_rmb.add_command(label='Paste', state=DISABLED, command=lambda: self.paste(device, menu_file))
             menu_rmb.add_separator()
             menu_rmb.add_command(label='Delete', command=lambda: self.delete(files.curselection(), device))
+            menu_rmb.add_command(label='View as text', command=lambda: self.view_selected(
+                files.curselection(), device, root))
 
             # load assets
             up_dir = PhotoImage(file='assets/subdirectory_arrow_left.png')
@@ -302,29 +3948,37 @@ class ADBfm:
             go_button = Button(ribbon, image=arrow, command=lambda: self.go_abs(device, root))
             go_button.grid(row=0, column=3)
 
-            reload_button = Button(ribbon, image=refresh, command=lambda: self.reload(device))
+            reload_button = Button(ribbon, image=refresh, command=lambda: self.reload(device, True))
             reload_button.grid(row=0, column=4)
 
             # create the file pane
             global open_dir
-            global filesvar
-            global fileslist
+            global files
+            global dir_entries
+            global listing_stream
+            global reveal
             open_dir = '/'
-            fileslist = self.ls(open_dir, device)
-            filesvar = StringVar(value=fileslist)
-            files_frame = Frame(main_frame)
-            files_frame.grid(sticky='nsew', row=1, column=0)
-            files_frame.columnconfigure(0, weight=1)
-            files_frame.rowconfigure(0, weight=1)
-            files = Listbox(files_frame, listvariable=filesvar)
+            dir_entries = []
+            listing_stream = None
+            reveal = None
+            listings.load(device)
+            files = VirtualList(main_frame, DirEntry.label, selectmode=EXTENDED)
+            files.grid(sticky='nsew', row=1, column=0)
+            global usage_label
+            usage_label = Label(main_frame, textvariable=usage_status, anchor='w')
             files.bind('<Double-1>', lambda e: self.open_file(files.curselection(), device, root))
             files.bind('<Return>', lambda e: self.open_file(files.curselection(), device, root))
             files.bind('<Button-3>', self.popup_menu)
-            files.grid(sticky='nsew', row=0, column=0)
-            files_scroll = Scrollbar(files_frame)
-            files_scroll.grid(sticky='nse', row=0, column=1)
-            files.config(yscrollcommand=files_scroll.set)
-            files_scroll.config(command=files.yview)
+            root.bind('<Control-f>', lambda e: self.find_window(device, root))
+            self.toggle_watch(device)
+            if resume is None:
+                self.reload(device)
+            else:
+                open_dir = resume
+                self.resume(device, main_frame)
+
+            root.protocol('WM_DELETE_WINDOW', lambda: self.quit(root))
+            self.poll_transfers(device, root)
 
             try:
                 root.mainloop()
@@ -335,30 +3989,58 @@ class ADBfm:
             raise
 
     def change_device(self, main_frame):
+        global connected
+        global last_dir
+        global watcher
+        if watcher:
+            watcher.stop()
+            watcher = None
+        listings.save(connected)
+        connected = None
+        last_dir = open_dir
+        main_frame.winfo_toplevel().after_cancel(transfer_poll)
+        # the search window belongs to the device being left
+        if find_list is not None and find_list.winfo_exists():
+            find_list.winfo_toplevel().destroy()
         main_frame.destroy()
         self.choose_device()
 
+    @staticmethod
+    def adb_restart(device, *args):
+        # these restart adbd, so open connections to the device are gone afterwards
+        with backend.timed(device, 'adb', ' '.join(args)) as command:
+            command.status = subprocess.Popen([adb, '-s', device, *args]).wait()
+        backend.drop(device)
+        # root changes what can be listed
+        listings.clear(device)
+
+    @staticmethod
+    def switch_backend():
+        global backend
+        old = backend
+        backend = make_backend(adb, server.get(), commands, scheduler)
+        transfers.backend = backend
+        tracker.backend = backend
+        if watcher:
+            watcher.backend = backend
+        # the background scans pick the new backend up on their next device call
+        for index in indexes.values():
+            index.backend = backend
+        for scan in itertools.chain(*usage_scans.values()):
+            scan.backend = backend
+        for reader in readers:
+            reader.backend = backend
+        old.close()
+
     @staticmethod
     def is_ip(device):
         return bool(re.match('^[0-9.:]*$', device))
 
     @staticmethod
-    def ls(ls_dir, device):
-        try:
-            if hidden.get():
-                out = subprocess.check_output([adb, '-s', device, 'shell', 'ls', f'"{ls_dir}"', '-F', '-A'],
-                                              stderr=subprocess.PIPE)
-            else:
-                out = subprocess.check_output([adb, '-s', device, 'shell', 'ls', f'"{ls_dir}"', '-F'],
-                                              stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as ex:
-            if ex.stderr.endswith(b'Permission denied\n'):
-                messagebox.showerror('Permission denied', ex.stderr)
-            else:
-                messagebox.showerror('An exception has occurred:', ex.stderr)
-            raise
-        cont = out.decode().replace('\r', '').split('\n')[:-1]
-        return natsorted(cont, key=lambda x: x.lower())
+    def prefetch(ls_dir, listing, device, limit=32):
+        # lists the subdirectories in the background so going down a level is served from the cache
+        for entry in [entry for entry in listing if entry.is_dir()][:limit]:
+            prefetcher.submit(listings.prefetch, device, str(pathlib.PurePosixPath(ls_dir, entry.name)))
 
     def up(self, device):
         global open_dir
@@ -367,41 +4049,30 @@ class ADBfm:
             open_dir = open_dir[1:]
         self.reload(device)
 
-    def go(self, item, device, root):
+    def go(self, item, device):
+        # enters a directory of the current listing
         global open_dir
-        prev_dir = open_dir
         open_dir = str(pathlib.PurePosixPath(open_dir, item))
         if len(open_dir) > 1 and open_dir[1] == '/':
             open_dir = open_dir[1:]
-        status = self.get_file_status(open_dir, device)
-        if status == 2:
-            if len(open_dir) > 1:
-                open_dir += '/'
-            self.reload(device)
-        elif status == 1:
-            pull_from = pathlib.PurePosixPath(open_dir).parts[-1]
-            open_dir = prev_dir
-            self.pull(pull_from, device, root, True)
-        else:
-            print('Permission denied')
-            open_dir = prev_dir
+        if len(open_dir) > 1:
+            open_dir += '/'
+        self.reload(device)
 
     @staticmethod
     def get_file_status(file, device):
         # return 0 if file does not exist, 1 if a file, 2 if a directory
-        if subprocess.Popen([adb, '-s', device, 'shell', '[', '-f', f'"{file}"', ']']).wait() == 0:
-            return 1
-        elif subprocess.Popen([adb, '-s', device, 'shell', '[', '-d', f'"{file}"', ']']).wait() == 0:
-            return 2
-        else:
+        quoted = shlex.quote(file)
+        out = backend.run(device, f'if [ -f {quoted} ]; then echo 1; elif [ -d {quoted} ]; then echo 2; '
+                                 f'else echo 0; fi')[1]
+        try:
+            return int(out)
+        except ValueError:
             return 0
 
     def rename_dialog(self, item, root, device):
         try:
-            if fileslist[item[0]][-1] == '@' or fileslist[item[0]][-1] == '*' or fileslist[item[0]][-1] == '/':
-                file = fileslist[item[0]][:-1]
-            else:
-                file = fileslist[item[0]]
+            file = fileslist[item[0]].name
             win = Toplevel(root)
             win.title('Rename')
             win.geometry('300x150')
@@ -441,50 +4112,447 @@ class ADBfm:
     def rename(self, file, win, device, rename_var):
         original = str(pathlib.PurePosixPath(open_dir, file))
         renamed = str(pathlib.PurePosixPath(open_dir, rename_var.get()))
-        status = self.get_file_status(renamed, device)
-        if status == 0:
-            subprocess.Popen([adb, '-s', device, 'shell', 'mv', f'"{original}"', f'"{renamed}"']).wait()
+        # a plain name can be checked against the listing, only a path needs asking the device
+        if '/' in rename_var.get():
+            exists = self.get_file_status(renamed, device) != 0
+        else:
+            exists = any(entry.name == rename_var.get() for entry in dir_entries)
+        if not exists:
+            backend.call(device, ['mv', original, renamed])
+            listings.invalidate(device, original, True)
             self.dismiss(win)
-            self.reload(device)
+            self.patch(device, open_dir, [file])
+            self.patch(device, str(pathlib.PurePosixPath(renamed).parent), add=backend.entries(device, [renamed]))
         else:
             messagebox.showinfo(message='File already exists.')
 
-    def reload(self, device):
-        # reload the file pane
+    def resume(self, device, main_frame):
+        # reopens the last session: its listing of open_dir goes up straight away, and is listed for real once the
+        # device turns out to be connected; if it isn't, it's back to choosing one
+        global dir_entries
+        global stale_since
+        bar_dir.set(open_dir)
+        snapshot = listings.stale(device, open_dir)
+        if snapshot:
+            stale_since = snapshot[0]
+            dir_entries = snapshot[1]
+            self.show(dir_entries, True)
+        found = []
+
+        def check():
+            try:
+                found.append({serial: state for serial, state, info in backend.devices()}.get(device))
+            except (OSError, subprocess.SubprocessError):
+                found.append(None)
+
+        def wait():
+            if not main_frame.winfo_exists():
+                return
+            if not found:
+                main_frame.after(20, wait)
+            elif found[0] == 'device':
+                self.reload(device)
+            else:
+                self.change_device(main_frame)
+
+        threading.Thread(target=check, daemon=True).start()
+        wait()
+
+    def reload(self, device, force=False):
+        # reload the file pane, from the listing cache unless force is set
         global open_dir
         global bar_dir
-        global filesvar
-        global fileslist
+        global dir_entries
+        global listing_stream
+        global stale_since
         bar_dir.set(open_dir)
-        try:
-            fileslist = self.ls(open_dir, device)
-            filesvar.set(fileslist)
-        except subprocess.CalledProcessError:
-            self.up(device)
+        if watcher:
+            watcher.watch([open_dir, *listings.neighbours(device, open_dir)])
+        if usage_mode.get():
+            self.scan_usage(device, force)
+        if listing_stream:
+            listing_stream.cancelled = True
+        listing = None if force else listings.get(device, open_dir)
+        if listing is not None:
+            listing_stream = None
+            stale_since = None
+            dir_entries = listing
+            self.show(dir_entries, True)
+            self.clear_reveal()
+            self.prefetch(open_dir, dir_entries, device)
+            return
+        # stream the listing in, so the first rows show up before the whole directory has been read; the last
+        # session's listing of it stands in until then
+        snapshot = None if force else listings.stale(device, open_dir)
+        stale_since = snapshot and snapshot[0]
+        dir_entries = snapshot[1] if snapshot else []
+        self.show(dir_entries, True)
+        listing_stream = ListingStream(device, open_dir)
+        listing_stream.stale = bool(snapshot)
+        self.poll_listing(device, listing_stream)
+
+    def poll_listing(self, device, stream):
+        # runs on the Tk thread: merges the batches that have arrived into the file pane
+        global dir_entries
+        global listing_stream
+        global stale_since
+        if stream is not listing_stream:
+            return
+        batches = []
+        finished = False
+        for item in stream.take():
+            if item is None:
+                finished = True
+            elif isinstance(item, Exception):
+                listing_stream = None
+                stderr = getattr(item, 'stderr', None) or str(item).encode()
+                if stderr.endswith(b'Permission denied\n'):
+                    messagebox.showerror('Permission denied', stderr)
+                else:
+                    messagebox.showerror('An exception has occurred:', stderr)
+                self.up(device)
+                return
+            else:
+                batches.extend(item)
+        if batches:
+            stream.entries = merge_sorted(stream.entries, batches)
+        if batches and not stream.stale or finished:
+            dir_entries = stream.entries
+            self.show(dir_entries)
+        if finished:
+            listing_stream = None
+            stale_since = None
+            self.clear_reveal()
+            listings.put(device, stream.path, dir_entries, stream.generation)
+            self.prefetch(stream.path, dir_entries, device)
+        else:
+            files.after(50, lambda: self.poll_listing(device, stream))
+
+    @staticmethod
+    def show(entries, reset=False):
+        # fills the file pane from a listing, leaving out hidden files unless asked not to; listings are kept
+        # in name order, other orders are sorted from the keys the entries already carry
+        global fileslist
+        global reveal
+        # sorting and drawing are timed too, to tell them apart from the time spent on the device
+        pane = Command(commands, None, 'pane', f'{len(entries)} entries')
+        fileslist = [entry for entry in entries if hidden.get() or not entry.is_hidden()]
+        if usage_mode.get() and sort_by.get() == 'size':
+            # directories count with everything under them
+            fileslist.sort(key=lambda entry: (ADBfm.usage(entry), entry.key), reverse=sort_reverse.get())
+        elif sort_by.get() != 'name' or sort_reverse.get():
+            fileslist.sort(key=SORT_KEYS[sort_by.get()], reverse=sort_reverse.get())
+        files.set(fileslist, reset)
+        files.update_idletasks()
+        pane.finish()
+        if not painted and (entries or listing_stream is None):
+            files.after_idle(ADBfm.first_paint)
+        # a file found through the index is selected as soon as it is listed
+        for index, entry in enumerate(fileslist if reveal is not None else ()):
+            if entry.name == reveal:
+                reveal = None
+                files.choose(index)
+                break
+
+    def toggle_watch(self, device):
+        # starts or stops keeping the open directory and the cached ones around it current on their own
+        global watcher
+        if watcher:
+            watcher.stop()
+            watcher = None
+        if watch.get():
+            watcher = DirectoryWatcher(backend, device)
+            watcher.watch([open_dir, *listings.neighbours(device, open_dir)])
+            self.poll_watcher(device, watcher)
+
+    def poll_watcher(self, device, current):
+        # runs on the Tk thread: patches what the watcher saw change into the cached and shown listings
+        global dir_entries
+        if current is not watcher or not files.winfo_exists():
+            return
+        for path, remove, add in current.changes():
+            if remove is not None:
+                self.patch(device, path, remove, add)
+                continue
+            # a directory listed again: patched rather than replaced, so the pane keeps its place
+            if pathlib.PurePosixPath(path) == pathlib.PurePosixPath(open_dir) and not listing_stream:
+                remove, add = diff_listing(dir_entries, add)
+                patch_listing(dir_entries, remove, add)
+                listings.put(device, path, dir_entries)
+                self.show(dir_entries)
+            else:
+                listings.put(device, path, add)
+        files.after(250, lambda: self.poll_watcher(device, current))
+
+    @staticmethod
+    def first_paint():
+        # the time from launch until the file pane first showed a listing, kept in the operations log
+        global painted
+        if painted:
+            return
+        painted = True
+        # an overrun is marked in the log entry itself
+        label = 'first paint'
+        if time.perf_counter() - LAUNCHED > FIRST_PAINT_BUDGET:
+            label += f', over the budget of {FIRST_PAINT_BUDGET}s'
+        paint = Command(commands, connected, 'startup', label)
+        paint.start = LAUNCHED
+        paint.finish()
+
+    def toggle_usage(self, device):
+        # shows what each entry takes up, directories included, largest first
+        global usage_sort
+        if usage_mode.get():
+            usage_sort = sort_by.get(), sort_reverse.get()
+            sort_by.set('size')
+            sort_reverse.set(True)
+            files.format = self.usage_label
+            usage_label.grid(sticky='ew', row=2, column=0)
+            self.scan_usage(device)
+            self.poll_usage(None)
+        else:
+            if usage_sort:
+                sort_by.set(usage_sort[0])
+                sort_reverse.set(usage_sort[1])
+                usage_sort = None
+            files.format = DirEntry.label
+            usage_label.grid_remove()
+        self.show(dir_entries)
+
+    @staticmethod
+    def scan_usage(device, force=False):
+        # starts a scan of the current directory unless one further up already covers it
+        scans = usage_scans.setdefault(device, [])
+        if ADBfm.current_usage(device, open_dir) and not force:
+            return
+        scan = DiskUsage(backend, device, open_dir)
+        # scans of this directory or below it are superseded
+        for old in [old for old in scans if scan.covers(old.root)]:
+            old.cancelled = True
+            scans.remove(old)
+        scans.append(scan)
+
+    @staticmethod
+    def current_usage(device, path):
+        # the closest scan covering path
+        covering = [scan for scan in usage_scans.get(device, []) if scan.covers(path)]
+        return max(covering, key=lambda scan: len(scan.root), default=None)
+
+    @staticmethod
+    def usage(entry):
+        if not entry.is_dir() or entry.is_link():
+            return entry.size
+        scan = ADBfm.current_usage(usage_device, open_dir)
+        return scan.total(pathlib.PurePosixPath(open_dir, entry.name)) if scan else 0
+
+    @staticmethod
+    def usage_label(entry):
+        return f'{human_size(ADBfm.usage(entry))}    {entry.label()}'
+
+    def poll_usage(self, counted):
+        # redraws the pane as the totals grow, until the scan is done
+        if not usage_mode.get() or not files.winfo_exists():
+            return
+        scan = self.current_usage(usage_device, open_dir)
+        if scan:
+            usage_status.set(scan.status())
+            if scan.files != counted:
+                self.show(dir_entries)
+            counted = scan.files
+        files.after(500, lambda: self.poll_usage(counted))
+
+    @staticmethod
+    def clear_reveal():
+        # the listing is complete, so a file still not found to select won't be
+        global reveal
+        reveal = None
+
+    def patch(self, device, path, remove=(), add=()):
+        # applies a change made through the app to the listing of path instead of listing it again
+        listing = listings.patch(device, path, remove, add)
+        if pathlib.PurePosixPath(path) != pathlib.PurePosixPath(open_dir) or listing_stream:
+            return
+        if listing is not dir_entries:
+            patch_listing(dir_entries, remove, add)
+        self.show(dir_entries)
 
     def push(self, device, root):
         # pushes a file
         global open_dir
-        file = filedialog.askopenfilename(title='Push file')
-        if file:
-            root.title('Uploading...')
-            try:
-                subprocess.Popen([adb, '-s', device, 'push', file, open_dir]).wait()
-                self.reload(device)
-            finally:
-                root.title(f'ADB Explorer ({device})')
+        for file in filedialog.askopenfilenames(title='Push files'):
+            self.queue_push(file, device)
 
     def push_dir(self, device, root):
         # pushes a directory
         global open_dir
         file = filedialog.askdirectory(title='Push file')
         if file:
-            root.title('Uploading...')
-            try:
-                subprocess.Popen([adb, '-s', device, 'push', file, open_dir]).wait()
-                self.reload(device)
-            finally:
-                root.title(f'ADB Explorer ({device})')
+            self.queue_push(file, device)
+
+    def queue_push(self, file, device):
+        target_dir = open_dir
+        target = str(pathlib.PurePosixPath(target_dir, pathlib.Path(file).name))
+
+        def pushed(transfer):
+            listings.invalidate(device, target, True)
+            self.patch(device, target_dir, add=backend.entries(device, [target]))
+
+        transfers.submit(Transfer(device, 'push', file, target_dir, target, on_done=pushed))
+
+    def find_window(self, device, root):
+        # searches the device-wide file index as you type; results open in the file pane
+        global find_list
+        if find_list is not None and find_list.winfo_exists():
+            find_list.winfo_toplevel().lift()
+            return
+        index = indexes.setdefault(device, FileIndex(backend, device))
+        index.backend = backend
+        win = Toplevel(root)
+        win.title('Find files')
+        win.geometry('600x300')
+        win.iconphoto(False, icon)
+        win.columnconfigure(0, weight=1)
+        win.rowconfigure(2, weight=1)
+        query = StringVar()
+        search_entry = Entry(win, textvariable=query)
+        search_entry.grid(sticky='ew', row=0, column=0)
+        status = StringVar(value=index.status())
+        Label(win, textvariable=status, anchor='w').grid(sticky='ew', row=1, column=0)
+        find_list = VirtualList(win)
+        find_list.grid(sticky='nsew', row=2, column=0)
+        Button(win, text='Refresh index', command=lambda: self.update_index(index)).grid(sticky='w', row=3, column=0)
+        searched = None
+
+        def search():
+            nonlocal searched
+            searched = index.paths
+            find_list.set(index.search(query.get()), True)
+
+        def poll():
+            # shows indexing progress, and searches again once a new index is in place
+            if not win.winfo_exists():
+                return
+            status.set(index.status())
+            if index.paths is not searched:
+                search()
+            win.after(500, poll)
+
+        def open_result(event):
+            selection = find_list.curselection()
+            if selection:
+                self.reveal(device, find_list.items[selection[0]])
+
+        query.trace_add('write', lambda *args: search())
+        find_list.bind('<Double-1>', open_result)
+        find_list.bind('<Return>', open_result)
+        search_entry.bind('<Down>', lambda e: find_list.focus_set())
+        self.update_index(index)
+        poll()
+        search_entry.focus_set()
+
+    @staticmethod
+    def update_index(index):
+        # brings the index up to date in the background, a full scan only the first time
+        if not index.busy:
+            index.busy = True
+            threading.Thread(target=index.update, daemon=True).start()
+
+    def reveal(self, device, path):
+        # shows a path from the index in the file pane: a directory is entered, a file is selected in its own
+        global open_dir
+        global reveal
+        if path.endswith('/'):
+            open_dir = path
+        else:
+            parent, reveal = path.rsplit('/', 1)
+            open_dir = parent + '/'
+        self.reload(device)
+
+    def duplicates_window(self, device, root):
+        # groups of identical files below the open directory, shown as they are found; extra copies can be
+        # selected and deleted in one go
+        finder = DuplicateFinder(backend, device, open_dir)
+        readers.append(finder)
+        win = Toplevel(root)
+        win.title(f'Duplicates in {finder.root}')
+        win.geometry('700x400')
+        win.iconphoto(False, icon)
+        win.columnconfigure(0, weight=1)
+        win.rowconfigure(1, weight=1)
+        status = StringVar(value=finder.status())
+        Label(win, textvariable=status, anchor='w').grid(sticky='ew', row=0, column=0, columnspan=2)
+        # rows are (size, None, copies) for a group and (size, path, number) for each of its files
+        dupes = VirtualList(win, format=lambda row: f'{row[2]} copies of {human_size(row[0])}' if row[1] is None
+                            else f'    {row[1]}', selectmode=EXTENDED)
+        dupes.grid(sticky='nsew', row=1, column=0, columnspan=2)
+        shown = None
+
+        def rebuild():
+            rows = []
+            for size, paths in finder.groups():
+                rows.append((size, None, len(paths)))
+                rows.extend((size, path, number) for number, path in enumerate(paths))
+            dupes.set(rows)
+
+        def poll():
+            nonlocal shown
+            if not win.winfo_exists():
+                finder.cancelled = True
+                return
+            status.set(finder.status())
+            if finder.version != shown:
+                shown = finder.version
+                rebuild()
+            if not finder.done or finder.version != shown:
+                win.after(500, poll)
+
+        def select_extra():
+            # every copy but the first of each group
+            dupes.selected = {index for index, row in enumerate(dupes.items) if row[1] is not None and row[2]}
+            dupes.redraw()
+
+        def delete():
+            paths = [dupes.items[index][1] for index in dupes.curselection() if dupes.items[index][1] is not None]
+            if not paths or not messagebox.askyesno(parent=win, title='Delete duplicates', default=messagebox.NO,
+                                                    message=f'Delete {len(paths)} files?'):
+                return
+            gone = set()
+            for batch in command_batches(paths):
+                try:
+                    backend.check_output(device, ['rm', '-f', *batch])
+                    gone.update(batch)
+                except subprocess.CalledProcessError as ex:
+                    # rm goes on past the files it can't remove: only those are left
+                    kept = backend.run(device, 'ls -d ' + ' '.join(shlex.quote(path) for path in batch))[1]
+                    gone.update(set(batch) - set(kept.decode(errors='replace').splitlines()))
+                    messagebox.showerror('An exception has occurred:', ex.stderr, parent=win)
+            finder.forget(gone)
+            parents = {}
+            for path in gone:
+                parent, name = path.rsplit('/', 1)
+                parents.setdefault(parent or '/', []).append(name)
+            for parent, names in parents.items():
+                for name in names:
+                    listings.invalidate(device, f'{parent.rstrip("/")}/{name}', True)
+                self.patch(device, parent, names)
+            dupes.selected = set()
+            rebuild()
+            status.set(finder.status())
+
+        def open_file(event):
+            selection = dupes.curselection()
+            if selection and dupes.items[selection[0]][1] is not None:
+                self.reveal(device, dupes.items[selection[0]][1])
+
+        dupes.bind('<Double-1>', open_file)
+        dupes.bind('<Return>', open_file)
+        dupes.bind('<Delete>', lambda e: delete())
+        Button(win, text='Select all but the first of each group', command=select_extra).grid(
+            sticky='w', row=2, column=0)
+        Button(win, text='Delete selected', command=delete).grid(sticky='e', row=2, column=1)
+        win.protocol('WM_DELETE_WINDOW', lambda: (setattr(finder, 'cancelled', True), readers.remove(finder),
+                                                  win.destroy()))
+        poll()
 
     def go_abs(self, device, root):
         # will navigate to an absolute path
@@ -502,8 +4570,9 @@ class ADBfm:
             self.reload(device)
         elif status == 1:
             pull_from = pathlib.PurePosixPath(open_dir).parts[-1]
+            entries = backend.entries(device, [open_dir])
             open_dir = str(pathlib.PurePosixPath(open_dir).parent)
-            self.openf(pull_from, device, root, True)
+            self.openf(pull_from, device, root, True, entries[0] if entries else None)
             open_dir = prev_dir
         else:
             print('File does not exist.')
@@ -514,22 +4583,27 @@ class ADBfm:
     def pull(item, device, root, skip):
         # pulls the selected item
         try:
+            size = None
             if not skip:
-                if fileslist[item[0]][-1] == '@' or fileslist[item[0]][-1] == '*':
-                    from_file = fileslist[item[0]][:-1]
-                else:
-                    from_file = fileslist[item[0]]
+                entries = [fileslist[index] for index in item]
+                if len(entries) > 1:
+                    # several items go into a folder, each on its own transfer so they can run in parallel
+                    folder = filedialog.askdirectory(title='Pull files')
+                    for entry in entries if folder else ():
+                        transfers.submit(Transfer(device, 'pull', str(pathlib.PurePosixPath(open_dir, entry.name)),
+                                                  folder, os.path.join(folder, entry.name),
+                                                  entry.size if entry.is_file() else None))
+                    return
+                from_file = entries[0].name
+                if entries[0].is_file():
+                    size = entries[0].size
             else:
                 from_file = item
             file = filedialog.asksaveasfilename(title='Pull file', initialfile=from_file,
                                                 filetypes=[('All Files', '*')])
             if file:
-                root.title('Downloading...')
-                try:
-                    subprocess.Popen(
-                        [adb, '-s', device, 'pull', str(pathlib.PurePosixPath(open_dir, from_file)), file]).wait()
-                finally:
-                    root.title(f'ADB Explorer ({device})')
+                transfers.submit(Transfer(device, 'pull', str(pathlib.PurePosixPath(open_dir, from_file)), file,
+                                          size=size))
         except Exception:
             messagebox.showerror('An exception has occurred:', traceback.format_exc())
             raise
@@ -542,21 +4616,46 @@ class ADBfm:
         dir_name = pathlib.PurePosixPath(open_dir).parts[-1]
         file = filedialog.asksaveasfilename(title='Pull file', initialfile=dir_name, filetypes=[('All Files', '*')])
         if file:
-            root.title('Downloading...')
-            try:
-                subprocess.Popen([adb, '-s', device, 'pull', open_dir, file]).wait()
-            finally:
-                root.title(f'ADB Explorer ({device})')
+            transfers.submit(Transfer(device, 'pull', open_dir, file))
+
+    def mirror(self, device, direction):
+        # syncs the current directory with a local folder, transferring only what differs
+        folder = filedialog.askdirectory(title='Mirror to folder' if direction == 'pull' else 'Mirror from folder')
+        if not folder:
+            return
+        if direction == 'pull':
+            question = f'Also delete files in {folder} that are not in {open_dir}?'
+        else:
+            question = f'Also delete files in {open_dir} that are not in {folder}?'
+        delete = messagebox.askyesno('Mirror', question, default=messagebox.NO)
+        mirror = Mirror(device, direction, open_dir, folder, delete)
+        threading.Thread(target=mirror.run, args=(transfers,), daemon=True).start()
+        self.poll_mirror(device, mirror)
+
+    def poll_mirror(self, device, mirror):
+        if not mirror.done.is_set():
+            files.after(500, lambda: self.poll_mirror(device, mirror))
+            return
+        if mirror.direction == 'push':
+            listings.invalidate(device, mirror.remote, True)
+            if pathlib.PurePosixPath(mirror.remote) == pathlib.PurePosixPath(open_dir):
+                self.reload(device, True)
+        if mirror.error is not None:
+            stderr = getattr(mirror.error, 'stderr', None) or str(mirror.error).encode()
+            messagebox.showerror('Mirror failed', stderr)
+        else:
+            messagebox.showinfo('Mirror finished', mirror.describe())
 
     def delete(self, item, device):
         try:
-            if fileslist[item[0]][-1] == '@' or fileslist[item[0]][-1] == '*':
-                file = fileslist[item[0]][:-1]
-            else:
-                file = fileslist[item[0]]
-            file = str(pathlib.PurePosixPath(open_dir, file))
-            subprocess.check_output([adb, '-s', device, 'shell', 'rm', '-rf', f'"{file}"'], stderr=subprocess.PIPE)
-            self.reload(device)
+            names = [fileslist[index].name for index in item]
+            paths = [str(pathlib.PurePosixPath(open_dir, name)) for name in names]
+            if not paths:
+                return
+            backend.check_output(device, ['rm', '-rf', *paths])
+            for path in paths:
+                listings.invalidate(device, path, True)
+            self.patch(device, open_dir, names)
         except subprocess.CalledProcessError as ex:
             if ex.stderr.endswith(b'Permission denied\n'):
                 messagebox.showerror('Permission denied', ex.stderr)
@@ -579,14 +4678,12 @@ class ADBfm:
     def copy(item, menu_file):
         try:
             global clipboard
-            if fileslist[item[0]][-1] == '@' or fileslist[item[0]][-1] == '*':
-                file = fileslist[item[0]][:-1]
-            else:
-                file = fileslist[item[0]]
-            file = str(pathlib.PurePosixPath(open_dir, file))
+            paths = [str(pathlib.PurePosixPath(open_dir, fileslist[index].name)) for index in item]
+            if not paths:
+                return
             menu_file.entryconfig(6, state=NORMAL)
             menu_rmb.entryconfig(5, state=NORMAL)
-            clipboard = file
+            clipboard = paths
         except Exception:
             messagebox.showerror('An exception has occurred:', traceback.format_exc())
             raise
@@ -598,47 +4695,247 @@ class ADBfm:
             cut = False
             menu_file.entryconfig(6, state=DISABLED)
             menu_rmb.entryconfig(5, state=DISABLED)
-            subprocess.Popen([adb, '-s', device, 'shell', 'mv', f'"{clipboard}"', f'"{open_dir}"']).wait()
+            backend.call(device, ['mv', *clipboard, open_dir])
+            for file in clipboard:
+                listings.invalidate(device, file, True)
+                self.patch(device, str(pathlib.PurePosixPath(file).parent), [pathlib.PurePosixPath(file).name])
         else:
-            subprocess.Popen([adb, '-s', device, 'shell', 'cp', f'"{clipboard}"', f'"{open_dir}"']).wait()
-        self.reload(device)
+            backend.call(device, ['cp', *clipboard, open_dir])
+        targets = [str(pathlib.PurePosixPath(open_dir, pathlib.PurePosixPath(file).name)) for file in clipboard]
+        for target in targets:
+            listings.invalidate(device, target, True)
+        self.patch(device, open_dir, add=backend.entries(device, targets))
 
-    def openf(self, item, device, root, skip):
+    def openf(self, item, device, root, skip, entry=None):
         try:
             global garbage
             if not skip:
-                if fileslist[item[0]][-1] == '@' or fileslist[item[0]][-1] == '*':
-                    file = fileslist[item[0]][:-1]
-                else:
-                    file = fileslist[item[0]]
+                entries = [fileslist[index] for index in item]
+                for other in entries[1:]:
+                    self.openf(other.name, device, root, True, other)
+                file = entries[0].name
+                entry = entries[0]
             else:
                 file = item
-            root.title('Downloading...')
-            tempdir = tempfile.mkdtemp()
-            garbage.append(tempdir)
-            subprocess.Popen([adb, '-s', device, 'pull', str(pathlib.PurePosixPath(open_dir, file)), tempdir]).wait()
-            self.start_file(str(pathlib.Path(tempdir, pathlib.PurePosixPath(file).parts[-1])))
+            remote = str(pathlib.PurePosixPath(open_dir, file))
+            if entry and entry.is_file() and entry.size >= RESUME_MIN_SIZE and file.lower().endswith(TEXT_SUFFIXES):
+                self.view_window(device, root, remote)
+                return
+            # a link's size and mtime are its own, not its target's, so only regular files are cached
+            version = (device, remote, entry.size, entry.mtime) if entry and not entry.is_link() else None
+            size = entry.size if version else None
+            cached = file_cache.get(*version) if version else None
+            if cached:
+                self.start_file(os.path.abspath(cached))
+                return
+            local = file_cache.reserve(*version) if version else None
+            if local is None:
+                version = None
+                tempdir = tempfile.mkdtemp()
+                garbage.append(tempdir)
+                local = str(pathlib.Path(tempdir, pathlib.PurePosixPath(file).parts[-1]))
+
+            def pulled(transfer):
+                if version and transfer.state == Transfer.DONE:
+                    file_cache.put(*version, local)
+                elif version:
+                    file_cache.discard(*version)
+                if transfer.state == Transfer.DONE:
+                    self.start_file(os.path.abspath(local))
+
+            # the pulled file keeps its mtime so the cache can tell it hasn't been edited since
+            transfers.submit(Transfer(device, 'pull', remote, local, local, size, pulled, preserve=True))
         except Exception:
             messagebox.showerror('An exception has occurred:', traceback.format_exc())
             raise
-        finally:
-            root.title(f'ADB Explorer ({device})')
+
+    def view_selected(self, item, device, root):
+        for index in item:
+            if fileslist[index].is_file():
+                self.view_window(device, root, str(pathlib.PurePosixPath(open_dir, fileslist[index].name)))
+
+    @staticmethod
+    def view_window(device, root, path):
+        # a device file read in place: only the window of it on screen is fetched, paging past either end of
+        # the window fetches the next one, and follow streams what gets appended
+        try:
+            remote = RemoteFile(backend, device, path)
+            readers.append(remote)
+        except (OSError, subprocess.SubprocessError) as ex:
+            messagebox.showerror('Unable to view file', str(ex))
+            return
+        win = Toplevel(root)
+        win.title(f'{path} ({human_size(remote.size)})')
+        win.geometry('800x500')
+        win.iconphoto(False, icon)
+        win.columnconfigure(0, weight=1)
+        win.rowconfigure(0, weight=1)
+        text = Text(win, font='TkFixedFont', wrap=NONE, state=DISABLED)
+        text.grid(sticky='nsew', row=0, column=0)
+        scrollbar = Scrollbar(win, command=text.yview)
+        scrollbar.grid(sticky='ns', row=0, column=1)
+        text['yscrollcommand'] = scrollbar.set
+        button_frame = Frame(win)
+        button_frame.grid(sticky='ew', row=1, column=0, columnspan=2)
+        button_frame.columnconfigure(5, weight=1)
+        status = StringVar()
+        following = BooleanVar(value=False)
+        # the bytes [start, end) of the file that are in the text, and a partial last line held back in follow
+        window = [0, 0]
+        content = bytearray()
+        held = bytearray()
+        loaded = queue.Queue()
+        busy = False
+
+        def load(start, end, at_end=False):
+            # fetches [start, end) on a thread, None for the last VIEW_WINDOW bytes as of now
+            nonlocal busy
+            if busy:
+                return
+            busy = True
+            status.set('Loading...')
+
+            def fetch():
+                try:
+                    first, last = start, end
+                    if last is None:
+                        remote.size = remote.stat()
+                        first, last = max(0, remote.size - VIEW_WINDOW), remote.size
+                    # one byte before the window tells whether it starts on a new line
+                    data = remote.read(max(first - 1, 0), last)
+                    loaded.put((first, data if first == 0 else data[1:], data[:1] == b'\n' or first == 0, at_end))
+                except (OSError, subprocess.SubprocessError) as ex:
+                    loaded.put(ex)
+
+            threading.Thread(target=fetch, daemon=True).start()
+
+        def show(start, data, aligned, at_end):
+            # whole lines only, except at the ends of the file
+            if not aligned:
+                cut = data.find(b'\n') + 1
+                data = data[cut:]
+                start += cut
+            if start + len(data) < remote.size and b'\n' in data:
+                data = data[:data.rfind(b'\n') + 1]
+            window[:] = [start, start + len(data)]
+            content[:] = data
+            text.configure(state=NORMAL)
+            text.delete('1.0', END)
+            text.insert('1.0', data.decode(errors='replace'))
+            text.configure(state=DISABLED)
+            text.see(END if at_end else '1.0')
+
+        def append(position, data):
+            # appended data goes in by whole lines; the top is dropped once the text holds several windows
+            if position != window[1] + len(held):
+                return
+            held.extend(data)
+            if b'\n' not in held:
+                return
+            cut = held.rfind(b'\n') + 1
+            lines = bytes(held[:cut])
+            del held[:cut]
+            bottom = text.yview()[1] >= 1.0
+            text.configure(state=NORMAL)
+            text.insert(END, lines.decode(errors='replace'))
+            content.extend(lines)
+            window[1] += len(lines)
+            if len(content) > 4 * VIEW_WINDOW:
+                cut = content.find(b'\n', len(content) - 2 * VIEW_WINDOW) + 1
+                dropped = content.count(b'\n', 0, cut)
+                text.delete('1.0', f'{dropped + 1}.0')
+                del content[:cut]
+                window[0] += cut
+            text.configure(state=DISABLED)
+            if bottom:
+                text.see(END)
+
+        def top():
+            stop_following()
+            load(0, VIEW_WINDOW)
+
+        def end():
+            load(None, None, True)
+
+        def page_down():
+            if window[1] < remote.size:
+                stop_following()
+                load(window[1], window[1] + VIEW_WINDOW)
+
+        def page_up():
+            if window[0] > 0:
+                stop_following()
+                load(max(0, window[0] - VIEW_WINDOW), window[0], True)
+
+        def toggle_follow():
+            if following.get():
+                # following starts from the end of the file
+                end()
+            else:
+                remote.unfollow()
+
+        def stop_following():
+            if following.get():
+                following.set(False)
+                remote.unfollow()
+
+        def key(event, move):
+            # a key that scrolls past the end of the window pages
+            first, last = text.yview()
+            if event.keysym in ('Next', 'Down') and last >= 1.0 or event.keysym in ('Prior', 'Up') and first <= 0:
+                move()
+                return 'break'
+
+        def poll():
+            nonlocal busy
+            if not win.winfo_exists():
+                remote.unfollow()
+                return
+            while not loaded.empty():
+                result = loaded.get()
+                busy = False
+                if isinstance(result, Exception):
+                    stop_following()
+                    messagebox.showerror('Unable to read file', str(result), parent=win)
+                    continue
+                show(*result)
+                if following.get():
+                    held.clear()
+                    remote.follow(window[1])
+            while not remote.appended.empty():
+                append(*remote.appended.get())
+            if not busy:
+                status.set(f'Bytes {window[0]}-{window[1]} of {remote.size}' + (', following' if following.get()
+                                                                                else ''))
+            win.after(100, poll)
+
+        Button(button_frame, text='Top', command=top).grid(row=0, column=0)
+        Button(button_frame, text='Page up', command=page_up).grid(row=0, column=1)
+        Button(button_frame, text='Page down', command=page_down).grid(row=0, column=2)
+        Button(button_frame, text='End', command=lambda: (stop_following(), end())).grid(row=0, column=3)
+        Checkbutton(button_frame, text='Follow', variable=following, command=toggle_follow).grid(row=0, column=4)
+        Label(button_frame, textvariable=status, anchor='e').grid(sticky='ew', row=0, column=5)
+        for keysym in ('Next', 'Down'):
+            text.bind(f'<{keysym}>', lambda e: key(e, page_down))
+        for keysym in ('Prior', 'Up'):
+            text.bind(f'<{keysym}>', lambda e: key(e, page_up))
+        text.bind('<Control-Home>', lambda e: top())
+        text.bind('<Control-End>', lambda e: (stop_following(), end()))
+        win.protocol('WM_DELETE_WINDOW', lambda: (remote.unfollow(), readers.remove(remote), win.destroy()))
+        load(0, VIEW_WINDOW)
+        text.focus_set()
+        poll()
 
     def open_file(self, item, device, root):
         # openf() item if file, if dir use go()
         global fileslist
         global open_dir
         try:
-            if fileslist[item[0]][-1] == '@' or fileslist[item[0]][-1] == '*':
-                file = fileslist[item[0]][:-1]
-            else:
-                file = fileslist[item[0]]
-            file = str(pathlib.PurePosixPath(open_dir, file))
-            status = self.get_file_status(file, device)
-            if status == 1:
-                self.openf(file, device, root, True)
-            elif status == 2:
-                self.go(file, device, root)
+            entry = fileslist[item[0]]
+            if entry.is_file():
+                self.openf(entry.name, device, root, True, entry)
+            elif entry.is_dir():
+                self.go(entry.name, device)
             else:
                 print('Unable to open file')
         except IndexError:
@@ -647,6 +4944,207 @@ class ADBfm:
             messagebox.showerror('An exception has occurred:', traceback.format_exc())
             raise
 
+    def poll_transfers(self, device, root):
+        # runs on the Tk thread: finishes completed transfers and shows overall progress in the title
+        global transfer_poll
+        for transfer in transfers.completed():
+            if transfer.state == Transfer.FAILED:
+                messagebox.showerror('Transfer failed', transfer.describe())
+            if transfer.on_done:
+                transfer.on_done(transfer)
+        summary = transfers.summary()
+        title = f'ADB Explorer ({device})'
+        if stale_since:
+            title += f' - listing from {time.strftime("%Y-%m-%d %H:%M", time.localtime(stale_since))}, refreshing'
+        root.title(f'{title} - {summary}' if summary else title)
+        if transfers_list is not None and transfers_list.winfo_exists():
+            transfers_list.set(list(transfers.transfers))
+            transfers_summary.set(summary or 'No transfers running')
+        transfer_poll = root.after(500, lambda: self.poll_transfers(device, root))
+
+    @staticmethod
+    def transfers_window(root):
+        global transfers_list
+        global transfers_summary
+        if transfers_list is not None and transfers_list.winfo_exists():
+            transfers_list.winfo_toplevel().lift()
+            return
+        win = Toplevel(root)
+        win.title('Transfers')
+        win.geometry('600x250')
+        win.iconphoto(False, icon)
+        win.columnconfigure(0, weight=1)
+        win.rowconfigure(1, weight=1)
+        transfers_summary = StringVar(value=transfers.summary() or 'No transfers running')
+        Label(win, textvariable=transfers_summary, anchor='w').grid(sticky='ew', row=0, column=0)
+        transfers_list = VirtualList(win, Transfer.describe, selectmode=EXTENDED)
+        transfers_list.grid(sticky='nsew', row=1, column=0)
+        transfers_list.set(list(transfers.transfers))
+        button_frame = Frame(win)
+        button_frame.grid(sticky='ew', row=2, column=0)
+        button_frame.columnconfigure(2, weight=1)
+        Button(button_frame, text='Cancel', command=lambda: [transfers_list.items[index].cancel()
+                                                             for index in transfers_list.curselection()]).grid(
+            row=0, column=0)
+        Button(button_frame, text='Clear finished', command=transfers.clear_finished).grid(row=0, column=1)
+        Label(button_frame, text='Parallel per device:').grid(sticky='e', row=0, column=2)
+        Spinbox(button_frame, from_=1, to=16, width=3, textvariable=transfer_limit,
+                command=lambda: transfers.set_limit(transfer_limit.get())).grid(row=0, column=3)
+        Label(button_frame, text='Background MB/s (0: no limit):').grid(sticky='e', row=0, column=4)
+        Spinbox(button_frame, from_=0, to=1000, width=4, textvariable=bulk_bandwidth,
+                command=lambda: setattr(scheduler, 'cap', bulk_bandwidth.get() << 20)).grid(row=0, column=5)
+
+    @staticmethod
+    def fan_out_window(root, serials):
+        # pushes, deletes and shell commands on several devices at once, with the status of each
+        win = Toplevel(root)
+        win.title(f'{len(serials)} devices')
+        win.geometry('600x350')
+        win.iconphoto(False, icon)
+        win.columnconfigure(1, weight=1)
+        win.rowconfigure(5, weight=1)
+        remote = StringVar(value='/sdcard/')
+        command = StringVar()
+        limit = IntVar(value=4)
+        summary = StringVar(value=', '.join(serials))
+        fan_out = None
+        Label(win, text='Device path:').grid(sticky='w', row=0, column=0)
+        Entry(win, textvariable=remote).grid(sticky='ew', row=0, column=1, columnspan=3)
+        Label(win, text='Shell command:').grid(sticky='w', row=1, column=0)
+        command_entry = Entry(win, textvariable=command)
+        command_entry.grid(sticky='ew', row=1, column=1, columnspan=3)
+        button_frame = Frame(win)
+        button_frame.grid(sticky='ew', row=2, column=0, columnspan=4)
+        Label(win, textvariable=summary, anchor='w').grid(sticky='ew', row=4, column=0, columnspan=4)
+        jobs_list = VirtualList(win, DeviceJob.describe)
+        jobs_list.grid(sticky='nsew', row=5, column=0, columnspan=4)
+
+        def start(operation, args):
+            nonlocal fan_out
+            if fan_out is not None and not fan_out.done.is_set():
+                messagebox.showinfo(parent=win, message='Wait for the running operation to finish or cancel it.')
+                return
+            offline = {serial for serial, state, info in tracker.devices if state != 'device'}
+            offline |= set(serials) - {serial for serial, state, info in tracker.devices}
+            # a push takes as long as it takes, a delete or a command that hangs is given up on
+            fan_out = FanOut(transfers, serials, operation, args, limit.get(), None if operation == 'push' else 120,
+                             offline)
+            poll()
+
+        def push(directory):
+            if directory:
+                path = filedialog.askdirectory(parent=win)
+                paths = [path] if path else []
+            else:
+                paths = list(filedialog.askopenfilenames(parent=win))
+            if paths:
+                start('push', (paths, remote.get()))
+
+        def delete():
+            path = remote.get().strip()
+            if path.rstrip('/') and messagebox.askyesno(parent=win, title='Delete', default=messagebox.NO,
+                                                        message=f'Delete {path} on {len(serials)} devices?'):
+                start('delete', [path])
+
+        def shell():
+            if command.get().strip():
+                start('shell', command.get())
+
+        def show_output(event):
+            selection = jobs_list.curselection()
+            if selection:
+                job = jobs_list.items[selection[0]]
+                messagebox.showinfo(parent=win, title=job.device,
+                                    message=(job.output.decode(errors='replace') + job.error).strip() or job.state)
+
+        def poll():
+            if not win.winfo_exists() or fan_out is None:
+                return
+            jobs_list.set(fan_out.jobs)
+            summary.set(fan_out.summary())
+            if not fan_out.done.is_set():
+                win.after(500, poll)
+
+        Button(button_frame, text='Push files...', command=lambda: push(False)).grid(row=0, column=0)
+        Button(button_frame, text='Push dir...', command=lambda: push(True)).grid(row=0, column=1)
+        Button(button_frame, text='Delete path', command=delete).grid(row=0, column=2)
+        Button(button_frame, text='Run command', command=shell).grid(row=0, column=3)
+        Button(button_frame, text='Cancel', command=lambda: fan_out and fan_out.cancel()).grid(row=0, column=4)
+        Label(button_frame, text='Devices at a time:').grid(sticky='e', row=0, column=5)
+        Spinbox(button_frame, from_=1, to=32, width=3, textvariable=limit).grid(row=0, column=6)
+        command_entry.bind('<Return>', lambda e: shell())
+        jobs_list.bind('<Double-1>', show_output)
+        jobs_list.set([DeviceJob(serial) for serial in serials])
+
+    @staticmethod
+    def operations_window(root):
+        # the timed adb invocations: latency histograms per kind of command, then the most recent first
+        global operations_list
+        if operations_list is not None and operations_list.winfo_exists():
+            operations_list.winfo_toplevel().lift()
+            return
+        win = Toplevel(root)
+        win.title('Operations log')
+        win.geometry('700x450')
+        win.iconphoto(False, icon)
+        win.columnconfigure(0, weight=1)
+        win.rowconfigure(0, weight=1)
+        win.rowconfigure(1, weight=1)
+        histograms = Text(win, height=12, font='TkFixedFont', wrap=NONE)
+        histograms.grid(sticky='nsew', row=0, column=0)
+        operations_list = VirtualList(win, Command.describe)
+        operations_list.grid(sticky='nsew', row=1, column=0)
+        button_frame = Frame(win)
+        button_frame.grid(sticky='ew', row=2, column=0)
+        button_frame.columnconfigure(2, weight=1)
+        status = StringVar()
+        Button(button_frame, text='Export...', command=lambda: ADBfm.export_operations(win)).grid(row=0, column=0)
+        Button(button_frame, text='Clear', command=commands.clear).grid(row=0, column=1)
+        Label(button_frame, textvariable=status, anchor='e').grid(sticky='ew', row=0, column=2)
+        shown = None
+
+        def refresh():
+            nonlocal shown
+            if not win.winfo_exists():
+                return
+            records = commands.snapshot()
+            if (commands.count, len(records)) != shown:
+                shown = (commands.count, len(records))
+                status.set(f'{len(records)} of {commands.count} commands kept')
+                operations_list.set(records[::-1])
+                lines = []
+                labels = [f'<{bound} ms' for bound in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]} ms']
+                for kind, (calls, median, slowest, size, buckets) in commands.histograms().items():
+                    lines.append(f'{kind}: {calls} calls, median {median:.1f} ms, 95% under {slowest:.1f} ms, '
+                                 f'{human_size(size)}')
+                    used = [index for index, count in enumerate(buckets) if count]
+                    for index in range(used[0], used[-1] + 1):
+                        bar = '#' * -(-buckets[index] * 40 // max(buckets))
+                        lines.append(f'  {labels[index]:>10} {bar:<40} {buckets[index]}')
+                if scheduler.metrics:
+                    lines += ['', 'Lanes', scheduler.stats()]
+                histograms.configure(state=NORMAL)
+                histograms.delete('1.0', END)
+                histograms.insert('1.0', '\n'.join(lines) or 'No commands yet')
+                histograms.configure(state=DISABLED)
+            win.after(1000, refresh)
+
+        refresh()
+
+    @staticmethod
+    def export_operations(win):
+        path = filedialog.asksaveasfilename(parent=win, defaultextension='.jsonl', initialfile='operations.jsonl',
+                                            filetypes=[('JSON lines', '*.jsonl'), ('All files', '*')])
+        if path:
+            commands.export(path)
+
+    @staticmethod
+    def quit(root):
+        if transfers.active() and not messagebox.askyesno(
+                'Transfers running', 'Transfers are still running. Cancel them and quit?'):
+            return
+        root.destroy()
+
     @staticmethod
     def dismiss(win):
         win.grab_release()
@@ -711,6 +5209,196 @@ class ADBfm:
         self.copy(item, menu_file)
 
 
+# the commands of the batch mode, with the number of arguments they take (None for any number from the first)
+BATCH_COMMANDS = {'ls': (1, 1), 'pull': (2, 2), 'push': (2, 2), 'sync': (3, 3), 'rm': (1, None), 'mv': (2, None)}
+BATCH_USAGE = """commands:
+  ls REMOTE                      list a device directory
+  pull REMOTE LOCAL              download a file or directory
+  push LOCAL REMOTE              upload a file or directory
+  sync pull|push REMOTE LOCAL    mirror only what changed; --delete removes what the source lacks
+  rm REMOTE...                   delete files or directories
+  mv REMOTE... REMOTE            move or rename
+  run JOBFILE                    run the jobs of JOBFILE concurrently, - for stdin
+
+A job file holds one command per line, optionally preceded by -s SERIAL, or one JSON object per line such as
+{"device": "*", "command": "pull", "args": ["/sdcard/logs", "logs/{device}/"]}. A device of * runs the job on
+every connected device, and {device} in its arguments is replaced by the serial. Every job prints one JSON
+line with its result."""
+
+
+def parse_job(words, device=None):
+    # a job from the words of a command line: [-s SERIAL] command args... [--delete]
+    if words[:1] == ['-s']:
+        device, words = words[1], words[2:]
+    delete = '--delete' in words
+    words = [word for word in words if word != '--delete']
+    if not words or words[0] not in BATCH_COMMANDS:
+        raise ValueError(f'unknown command: {" ".join(words)}')
+    least, most = BATCH_COMMANDS[words[0]]
+    if len(words) - 1 < least or most is not None and len(words) - 1 > most:
+        raise ValueError(f'wrong number of arguments: {" ".join(words)}')
+    if words[0] == 'sync' and words[1] not in ('pull', 'push'):
+        raise ValueError(f'sync goes pull or push: {" ".join(words)}')
+    return {'device': device, 'command': words[0], 'args': words[1:], 'delete': delete}
+
+
+def read_jobs(lines, device=None):
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            if line.startswith('{'):
+                job = json.loads(line)
+                words = [job['command'], *job.get('args', [])] + (['--delete'] if job.get('delete') else [])
+                jobs.append(parse_job(words, job.get('device', device)))
+            else:
+                jobs.append(parse_job(shlex.split(line), device))
+        except (ValueError, KeyError, TypeError) as ex:
+            raise ValueError(f'line {number}: {ex}')
+    return jobs
+
+
+def expand_jobs(jobs, online):
+    # one job per device: * stands for every online device, and no device for the only one there is
+    expanded = []
+    for job in jobs:
+        if job['device'] == '*':
+            devices = online
+        elif job['device'] is None and len(online) == 1:
+            devices = online
+        elif job['device'] is None:
+            raise ValueError(f'{len(online)} devices connected, choose one with -s SERIAL or -s "*"')
+        else:
+            devices = [job['device']]
+        for device in devices:
+            expanded.append(dict(job, device=device, args=[arg.replace('{device}', device) for arg in job['args']]))
+    return expanded
+
+
+def run_job(manager, job):
+    # runs one job on the engine the file manager uses, returning its result as a JSON-able dict
+    device, command, args = job['device'], job['command'], job['args']
+    result = {'device': device, 'command': command, 'args': args}
+    started = time.monotonic()
+    try:
+        if command == 'ls':
+            result['entries'] = [{'name': entry.name, 'kind': entry.kind, 'size': entry.size, 'mtime': entry.mtime,
+                                  'target': entry.target} for entry in fetch_listing(device, args[0])]
+        elif command in ('pull', 'push'):
+            src, dst = args
+            if command == 'pull' and dst.endswith(('/', os.sep)):
+                os.makedirs(dst, exist_ok=True)
+            transfer = manager.submit(Transfer(device, command, src, dst))
+            transfer.done.wait()
+            result['bytes'] = transfer.size or transfer.transferred
+            if transfer.checked is not None:
+                result.update(verified=transfer.checked, resent=len(transfer.children))
+            if transfer.archived is not None:
+                result['archived'] = transfer.archived or 'tar'
+            if transfer.state != Transfer.DONE:
+                raise OSError(transfer.error.decode(errors='replace').strip() or transfer.state)
+        elif command == 'sync':
+            direction, remote, local = args
+            mirror = Mirror(device, direction, remote, local, job['delete'])
+            mirror.run(manager)
+            states = [transfer.state for transfer in mirror.transfers.values()]
+            result.update(transferred=states.count(Transfer.DONE), failed=states.count(Transfer.FAILED),
+                          deleted=mirror.deleted)
+            if mirror.error is not None:
+                raise mirror.error
+            if result['failed']:
+                raise OSError(f'{result["failed"]} transfers failed')
+        elif command == 'rm':
+            backend.check_output(device, ['rm', '-rf', *args])
+        elif command == 'mv':
+            backend.check_output(device, ['mv', *args])
+        result['ok'] = True
+    except subprocess.CalledProcessError as ex:
+        result['ok'] = False
+        result['error'] = (ex.stderr or b'').decode(errors='replace').strip() or str(ex)
+    except Exception as ex:
+        result['ok'] = False
+        result['error'] = str(ex) or type(ex).__name__
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def batch(argv):
+    # the headless mode: runs one command or a job file without Tk and prints a JSON line per job
+    global backend
+    global listings
+    parser = argparse.ArgumentParser(prog='main.py', description='ADB Explorer without a window.',
+                                     epilog=BATCH_USAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', dest='device', metavar='SERIAL', help='device to use, * for every connected one')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='jobs run at the same time (default 8)')
+    parser.add_argument('--adb', help='adb executable (default: the one in config.json, or adb)')
+    parser.add_argument('--server', action='store_true', default=None, help='use the adb server protocol')
+    parser.add_argument('--compress', action='store_true', help='compress bulk transfers')
+    parser.add_argument('--verify', action='store_true', help='verify transfers with checksums')
+    parser.add_argument('--bandwidth', type=float, help='MB/s per device for transfers, 0 for no limit '
+                                                         '(default: the one in config.json)')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    options = parser.parse_args(argv)
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'), 'rt') as f:
+            config_data = json.load(f)
+    except (OSError, ValueError):
+        config_data = {}
+    adb_path = options.adb or config_data.get('ADB_Path') or 'adb'
+    use_server = options.server if options.server is not None else config_data.get('Use_Server', False)
+    try:
+        if options.command[:1] == ['run']:
+            if len(options.command) != 2:
+                raise ValueError('run takes one job file')
+            if options.command[1] == '-':
+                jobs = read_jobs(sys.stdin, options.device)
+            else:
+                with open(options.command[1], 'rt') as f:
+                    jobs = read_jobs(f, options.device)
+        elif options.command:
+            jobs = [parse_job(options.command, options.device)]
+        else:
+            parser.print_help()
+            return 2
+    except (OSError, ValueError) as ex:
+        parser.error(str(ex))
+    # local paths are made absolute, the caches live where the file manager keeps them; a trailing separator
+    # still asks for a directory
+    for job in jobs:
+        if job['command'] in ('pull', 'push', 'sync'):
+            local = job['args'][0 if job['command'] == 'push' else -1]
+            local = os.path.abspath(local) + (os.sep if local.endswith(('/', os.sep)) else '')
+            job['args'][0 if job['command'] == 'push' else -1] = local
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    bandwidth = options.bandwidth if options.bandwidth is not None else config_data.get('Bulk_Bandwidth', 0)
+    backend = make_backend(adb_path, use_server, scheduler=Scheduler(cap=int(bandwidth * (1 << 20))))
+    listings = ListingCache()
+    manager = TransferManager(backend, limit=config_data.get('Transfer_Limit', 3), compress=options.compress,
+                              verify=options.verify)
+    pool = ThreadPoolExecutor(max_workers=max(options.jobs, 1))
+    failed = 0
+    try:
+        online = [serial for serial, state, info in backend.devices() if state == 'device']
+        jobs = expand_jobs(jobs, online)
+        futures = {pool.submit(run_job, manager, job): number for number, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            result = dict(job=futures[future], **future.result())
+            failed += not result['ok']
+            print(json.dumps(result), flush=True)
+    except (OSError, ValueError, subprocess.CalledProcessError) as ex:
+        print(json.dumps({'ok': False, 'error': str(ex)}), flush=True)
+        return 2
+    except KeyboardInterrupt:
+        manager.cancel_all()
+        return 130
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        backend.close()
+    return 1 if failed else 0
+
+
 def finish():
     # remove files that have been opened with openf()
     for x in garbage:
@@ -718,13 +5406,36 @@ def finish():
             shutil.rmtree(x)
         except PermissionError:
             pass
-    # save config
+    # stop transfers and prefetching and close the device connections
+    transfers.cancel_all()
+    file_cache.save()
+    if watcher:
+        watcher.stop()
+    if connected:
+        listings.save(connected)
+    tracker.stop()
+    prefetcher.shutdown(wait=False, cancel_futures=True)
+    backend.close()
+    # save config, with the sort from before the disk usage view if it is on
+    sort = usage_sort or (sort_by.get(), sort_reverse.get())
     f = open('config.json', 'wt')
-    f.write(json.dumps({'ADB_Path': adb, 'Show_Hidden': hidden.get()}))
+    f.write(json.dumps({'ADB_Path': adb, 'Show_Hidden': hidden.get(), 'Use_Server': server.get(),
+                        'Sort_By': sort[0], 'Sort_Reverse': sort[1],
+                        'Transfer_Limit': transfer_limit.get(), 'Compress': compress.get(),
+                        'Verify': verify.get(), 'File_Cache_Size': file_cache.budget >> 20,
+                        'Auto_Connect': auto_connect.get(), 'Last_Device': last_device,
+                        'Last_Dir': open_dir if connected else last_dir, 'Watch': watch.get(),
+                        'Bulk_Bandwidth': bulk_bandwidth.get()}))
     f.close()
 
 
-try:
-    ADBfm()
-finally:
-    finish()
+if __name__ == '__main__':
+    # with arguments, run them headless instead of opening the window
+    if len(sys.argv) > 1:
+        sys.exit(batch(sys.argv[1:]))
+    # ensure the script is running in the proper directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        ADBfm()
+    finally:
+        finish()
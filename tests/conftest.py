@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Fixtures for the tests: they reach a "device" through bench/fake_adb.py and bench/fake_server.py, which
+# stand in for the adb executable and the adb server with this machine as the device, so they run without a phone.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main  # noqa: E402
+
+FAKE_ADB = os.path.join(os.path.dirname(HERE), 'bench', 'fake_adb.py')
+FAKE_SERVER = os.path.join(os.path.dirname(HERE), 'bench', 'fake_server.py')
+DEVICE = 'bench'
+
+
+@pytest.fixture
+def subprocess_backend():
+    backend = main.make_backend(FAKE_ADB, False)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def merged_backend(monkeypatch):
+    # an adb without shell_v2, which sends a shell's stderr down its stdout
+    monkeypatch.setenv('FAKE_ADB_MERGED', '1')
+    backend = main.make_backend(FAKE_ADB, False)
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def server_backend():
+    server = subprocess.Popen([sys.executable, FAKE_SERVER, '--port', '0'], stdout=subprocess.PIPE, text=True)
+    # the server prints the port it got once it is listening
+    port = int(server.stdout.readline().split()[-1])
+    backend = main.make_backend(FAKE_ADB, True)
+    backend.address = ('127.0.0.1', port)
+    yield backend
+    backend.close()
+    server.terminate()
+    server.wait()
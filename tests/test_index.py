@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import main
+
+
+def index(dirs, files):
+    # a FileIndex over the given paths, without a device or the index file on disk
+    built = main.FileIndex.__new__(main.FileIndex)
+    built.dirs = {path: 0 for path in dirs}
+    built.files = files
+    built.build()
+    return built
+
+
+def test_search_finds_substrings_and_globs():
+    built = index(['/', '/sdcard', '/sdcard/DCIM'], {'/sdcard/DCIM': ['IMG_1.jpg', 'notes.txt'], '/': ['init.rc']})
+    assert built.search('img') == ['/sdcard/DCIM/IMG_1.jpg']
+    assert built.search('*.JPG') == ['/sdcard/DCIM/IMG_1.jpg']
+    assert built.search('sdcard/dcim/n') == ['/sdcard/DCIM/notes.txt']
+    assert built.search('missing') == []
+
+
+def test_search_after_names_whose_length_changes_when_lowered():
+    # İ lowers to two characters, which must not shift the paths after it
+    dotted = '/' + 'İ' * 20
+    built = index(['/', dotted], {dotted: ['first.txt'], '/': ['zeta.txt']})
+    assert built.search('zeta') == ['/zeta.txt']
+    assert built.search('first.txt') == [dotted + '/first.txt']
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import shlex
+
+import main
+
+
+def test_parse_devices_reads_states_and_properties():
+    out = ('List of devices attached\n'
+           '* daemon started successfully\n'
+           'emulator-5554          device product:sdk model:Pixel_7 transport_id:1\n'
+           'R58M123               unauthorized usb:1-1 transport_id:2\n'
+           '0123456789ABCDEF       no permissions (user in plugdev group); see [http://developer.android.com] '
+           'usb:3-2\n'
+           '\n')
+    assert main.parse_devices(out) == [
+        ('emulator-5554', 'device', {'product': 'sdk', 'model': 'Pixel_7', 'transport_id': '1'}),
+        ('R58M123', 'unauthorized', {'usb': '1-1', 'transport_id': '2'}),
+        ('0123456789ABCDEF', 'no permissions (user in plugdev group); see [http://developer.android.com]',
+         {'usb': '3-2'}),
+    ]
+
+
+def test_parse_devices_without_properties():
+    assert main.parse_devices('List of devices attached\nserial\toffline\n') == [('serial', 'offline', {})]
+
+
+def test_parse_listing_lines_builds_entries():
+    lines = ['41ed/4096/1700000000//sdcard/Music',
+             '81a4/12/1700000001//sdcard/a b.txt',
+             'not a stat line',
+             '']
+    entries = {}
+    added = main.parse_listing_lines(lines, entries)
+    assert [entry.name for entry in added] == ['Music', 'a b.txt']
+    assert entries['Music'].is_dir()
+    assert (entries['a b.txt'].kind, entries['a b.txt'].size, entries['a b.txt'].mtime) == ('f', 12, 1700000001)
+
+
+def test_parse_listing_lines_completes_links_across_batches():
+    entries = {}
+    main.parse_listing_lines(['a1ff/7/1700000000//sdcard/link', 'a1ff/9/1700000000//sdcard/gone'], entries)
+    assert entries['link'].kind == main.DirEntry.OTHER
+    # the link lines of a later batch fill in the entries already there, and add none
+    assert main.parse_listing_lines(['@d//sdcard/link', '/storage/emulated/0', '@o//sdcard/gone', ''],
+                                    entries) == []
+    assert (entries['link'].kind, entries['link'].target) == (main.DirEntry.DIR, '/storage/emulated/0')
+    assert (entries['gone'].kind, entries['gone'].target) == (main.DirEntry.OTHER, '')
+
+
+def listing(*names):
+    return sorted((main.DirEntry(name, main.DirEntry.FILE) for name in names), key=main.entry_key)
+
+
+def test_find_entry_finds_names_and_insertion_points():
+    entries = listing('a', 'B', 'b', 'file2', 'file10')
+    names = [entry.name for entry in entries]
+    for name in names:
+        assert main.find_entry(entries, name) == names.index(name)
+    assert main.find_entry(entries, 'file3') == names.index('file10')
+    assert main.find_entry(entries, 'z') == len(entries)
+
+
+def test_patch_listing_keeps_the_listing_sorted():
+    entries = listing('a', 'c', 'file2')
+    main.patch_listing(entries, remove=['c', 'missing'],
+                       add=[main.DirEntry('file10', main.DirEntry.FILE), main.DirEntry('b', main.DirEntry.DIR),
+                            main.DirEntry('a', main.DirEntry.FILE, size=5)])
+    assert [entry.name for entry in entries] == ['a', 'b', 'file2', 'file10']
+    assert entries[0].size == 5
+
+
+def test_add_range_merges_overlapping_and_touching_ranges():
+    ranges = []
+    ranges = main.add_range(ranges, 10, 20)
+    ranges = main.add_range(ranges, 30, 40)
+    assert ranges == [[10, 20], [30, 40]]
+    assert main.add_range(ranges, 20, 30) == [[10, 40]]
+    assert main.add_range(ranges, 0, 5) == [[0, 5], [10, 20], [30, 40]]
+    assert main.add_range(ranges, 15, 35) == [[10, 40]]
+    assert main.add_range(ranges, 12, 18) == [[10, 20], [30, 40]]
+
+
+def matches(glob, path):
+    return re.fullmatch(main.glob_pattern(glob), path) is not None
+
+
+def test_glob_pattern_stays_within_components():
+    assert matches('*.jpg', 'a.jpg')
+    assert not matches('*.jpg', 'dir/a.jpg')
+    assert matches('**.jpg', 'dir/a.jpg')
+    assert matches('**/a.jpg', 'dir/sub/a.jpg')
+    assert matches('a?c', 'abc')
+    assert not matches('a?c', 'a/c')
+
+
+def test_glob_pattern_character_classes():
+    assert matches('[ab].txt', 'b.txt')
+    assert not matches('[!ab].txt', 'a.txt')
+    assert matches('[!ab].txt', 'c.txt')
+    assert not matches('[!ab]', '/')
+    assert matches('a[.txt', 'a[.txt')
+    assert matches('a+b(1).txt', 'a+b(1).txt')
+
+
+def test_command_batches_stay_within_the_byte_limit():
+    args = [f'/sdcard/{"é" * 40}{i}' for i in range(2000)]
+    batches = list(main.command_batches(args, 4096))
+    assert [arg for batch in batches for arg in batch] == args
+    assert all(len(shlex.join(batch).encode()) <= 4096 for batch in batches)
+    assert list(main.command_batches([])) == []
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import main
+from conftest import DEVICE as BENCH
+
+DEVICE = 'device'
+
+
+def command(scheduler, lane, device=DEVICE):
+    return main.Command(None, device, 'shell', 'true', scheduler, lane)
+
+
+def admit_on_thread(scheduler, lane, device=DEVICE):
+    # starts admitting a command on another thread; the list gets the command once it is admitted
+    admitted = []
+    thread = threading.Thread(target=lambda: admitted.append(command(scheduler, lane, device)), daemon=True)
+    thread.start()
+    return thread, admitted
+
+
+def test_admit_waits_for_a_free_turn_in_the_lane():
+    scheduler = main.Scheduler({main.INTERACTIVE: 1, main.BULK: 1})
+    first = command(scheduler, main.INTERACTIVE)
+    thread, admitted = admit_on_thread(scheduler, main.INTERACTIVE)
+    thread.join(0.2)
+    assert not admitted
+    first.finish()
+    thread.join(2)
+    assert admitted and admitted[0].waited > 0
+    admitted[0].finish()
+    assert scheduler.running[DEVICE] == {main.INTERACTIVE: 0, main.BULK: 0}
+
+
+def test_devices_and_lanes_have_turns_of_their_own():
+    scheduler = main.Scheduler({main.INTERACTIVE: 1, main.BULK: 1})
+    first = command(scheduler, main.BULK)
+    for lane, device in ((main.INTERACTIVE, DEVICE), (main.BULK, 'other')):
+        thread, admitted = admit_on_thread(scheduler, lane, device)
+        thread.join(2)
+        assert admitted
+        admitted[0].finish()
+    first.finish()
+
+
+def test_bulk_waits_while_an_interactive_call_runs():
+    scheduler = main.Scheduler()
+    scheduler.YIELD = 0.5
+    interactive = command(scheduler, main.INTERACTIVE)
+    thread, admitted = admit_on_thread(scheduler, main.BULK)
+    thread.join(0.1)
+    assert not admitted
+    interactive.finish()
+    thread.join(2)
+    assert admitted
+    admitted[0].finish()
+
+
+def test_bulk_starts_after_yielding_for_a_while():
+    scheduler = main.Scheduler()
+    scheduler.YIELD = 0.2
+    interactive = command(scheduler, main.INTERACTIVE)
+    start = time.perf_counter()
+    thread, admitted = admit_on_thread(scheduler, main.BULK)
+    thread.join(2)
+    assert admitted and time.perf_counter() - start >= 0.2
+    admitted[0].finish()
+    interactive.finish()
+
+
+def test_a_thread_holding_a_turn_gets_another_one():
+    scheduler = main.Scheduler({main.INTERACTIVE: 1, main.BULK: 1})
+    outer = command(scheduler, main.INTERACTIVE)
+    inner = command(scheduler, main.INTERACTIVE)
+    inner.finish()
+    outer.finish()
+    assert scheduler.running[DEVICE][main.INTERACTIVE] == 0
+
+
+def test_finish_releases_once_and_counts_metrics():
+    scheduler = main.Scheduler()
+    done = command(scheduler, main.BULK)
+    done.finish()
+    done.finish()
+    assert scheduler.running[DEVICE][main.BULK] == 0
+    assert scheduler.metrics[(DEVICE, main.BULK)][0] == 1
+    assert 'device bulk: 1 calls, 0 running' in scheduler.stats()
+
+
+def test_calls_without_a_device_or_lane_are_not_scheduled():
+    scheduler = main.Scheduler()
+    command(scheduler, None).finish()
+    command(scheduler, main.INTERACTIVE, None).finish()
+    assert scheduler.metrics == {}
+
+
+def test_shell_pool_keeps_a_session_for_the_interactive_lane(subprocess_backend):
+    scheduler = main.Scheduler()
+    pool = subprocess_backend.shells
+    bulk = [command(scheduler, main.BULK, BENCH) for _ in range(pool.size)]
+    sessions = [pool.acquire(BENCH, bulk[0]), pool.acquire(BENCH, bulk[1])]
+    waiting = threading.Thread(target=lambda: sessions.append(pool.acquire(BENCH, bulk[2])), daemon=True)
+    waiting.start()
+    waiting.join(0.2)
+    assert len(sessions) == 2
+    interactive = command(scheduler, main.INTERACTIVE, BENCH)
+    pool.release(pool.acquire(BENCH, interactive))
+    pool.release(sessions.pop(0))
+    waiting.join(2)
+    # the wait for a session counts as time waited in the lane
+    assert len(sessions) == 2 and bulk[2].waited >= 0.2
+    assert scheduler.metrics[(BENCH, main.BULK)][2] >= 0.2
+    for session in sessions:
+        pool.release(session)
+    for call in bulk + [interactive]:
+        call.finish()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import subprocess
+
+import pytest
+
+from conftest import DEVICE
+
+
+@pytest.fixture(params=['subprocess_backend', 'merged_backend'])
+def backend(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_run_returns_status_and_output(backend):
+    assert backend.run(DEVICE, 'echo one; echo two')[:2] == (0, b'one\ntwo\n')
+    assert backend.run(DEVICE, 'exit 3')[0] == 3
+
+
+def test_run_keeps_output_without_trailing_newline(backend):
+    assert backend.run(DEVICE, 'printf abc')[:2] == (0, b'abc')
+
+
+def test_stderr_is_kept_apart_with_separate_streams(subprocess_backend):
+    assert subprocess_backend.run(DEVICE, 'echo out; echo err >&2; exit 1') == (1, b'out\n', b'err\n')
+
+
+def test_merged_stderr_does_not_hang_the_session(merged_backend):
+    # the stderr frame arrives on stdout, which must not be taken for output or waited for on stderr
+    returncode, out, err = merged_backend.run(DEVICE, 'echo out; echo err >&2; exit 1')
+    assert returncode == 1
+    assert b'out\n' in out
+    assert err == b''
+    assert not merged_backend.shells.idle[DEVICE][0].lost
+
+
+def test_sessions_are_reused_between_commands(backend):
+    for i in range(5):
+        assert backend.run(DEVICE, f'echo {i}')[1] == f'{i}\n'.encode()
+    assert backend.shells.open[DEVICE] == 1
+
+
+def test_stream_yields_lines_then_raises_on_failure(backend):
+    assert list(backend.stream(DEVICE, 'printf "a\\nb\\n"')) == [b'a', b'b']
+    lines = []
+    with pytest.raises(subprocess.CalledProcessError) as failure:
+        for line in backend.stream(DEVICE, 'echo a; exit 2'):
+            lines.append(line)
+    assert lines == [b'a']
+    assert failure.value.returncode == 2
+
+
+def test_stream_left_early_does_not_reuse_the_session(backend):
+    stream = backend.stream(DEVICE, 'seq 1 1000')
+    assert next(stream) == b'1'
+    stream.close()
+    assert backend.run(DEVICE, 'echo next')[1] == b'next\n'
+
+
+def test_commands_do_not_read_the_session_input(backend):
+    # a command reading stdin would otherwise swallow the frame of the next one
+    assert backend.run(DEVICE, 'cat; echo done')[:2] == (0, b'done\n')
+    assert backend.run(DEVICE, 'echo after')[1] == b'after\n'
+
+
+def test_find_lines_keeps_what_was_found_when_find_fails(backend, tmp_path):
+    (tmp_path / 'file').write_bytes(b'')
+    lines = list(backend.find_lines(DEVICE, f'find {tmp_path} /missing -type f'))
+    assert lines == [str(tmp_path / 'file')]
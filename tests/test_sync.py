@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# ADB Explorer: An ADB-based utility to manage files on Android devices.
+# Copyright (C) 2022 David Cole <davidco7777@protonmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import stat
+
+import pytest
+
+import main
+from conftest import DEVICE
+
+HUGE = 5 << 30
+
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'small.txt').write_bytes(b'12345')
+    # sparse, so it takes no space, but its size needs the 64-bit fields of LIS2 and STA2
+    with open(tmp_path / 'huge.bin', 'wb') as file:
+        file.truncate(HUGE)
+    os.utime(tmp_path / 'small.txt', (1700000000, 1700000000))
+    return tmp_path
+
+
+def listed(sync, path):
+    return {name: (mode, size, mtime) for name, mode, size, mtime in sync.list(str(path))}
+
+
+def test_lis2_decodes_entries_with_64_bit_sizes(server_backend, tree):
+    with server_backend.sync(DEVICE) as sync:
+        assert 'ls_v2' in sync.features
+        entries = listed(sync, tree)
+    assert stat.S_ISDIR(entries['dir'][0])
+    assert entries['small.txt'][1:] == (5, 1700000000)
+    assert stat.S_ISREG(entries['small.txt'][0])
+    assert entries['huge.bin'][1] == HUGE
+
+
+def test_list_decodes_entries_with_32_bit_sizes(server_backend, tree):
+    with main.SyncConnection(server_backend.service(DEVICE, 'sync:'), set()) as sync:
+        entries = listed(sync, tree)
+    assert entries['small.txt'][1:] == (5, 1700000000)
+    assert entries['huge.bin'][1] == HUGE & 0xffffffff
+
+
+def test_sta2_decodes_files_and_missing_paths(server_backend, tree):
+    with server_backend.sync(DEVICE) as sync:
+        assert 'stat_v2' in sync.features
+        mode, size, mtime = sync.stat(str(tree / 'small.txt'))
+        assert (stat.S_ISREG(mode), size, mtime) == (True, 5, 1700000000)
+        assert sync.stat(str(tree / 'huge.bin'))[1] == HUGE
+        assert sync.stat(str(tree / 'missing')) is None
+        # the connection is still in step after an error
+        assert stat.S_ISDIR(sync.stat(str(tree / 'dir'))[0])
+
+
+def test_stat_decodes_files_and_missing_paths(server_backend, tree):
+    with main.SyncConnection(server_backend.service(DEVICE, 'sync:'), set()) as sync:
+        mode, size, mtime = sync.stat(str(tree / 'small.txt'))
+        assert (stat.S_ISREG(mode), size, mtime) == (True, 5, 1700000000)
+        assert sync.stat(str(tree / 'missing')) is None
+        assert stat.S_ISDIR(sync.stat(str(tree / 'dir'))[0])
+
+
+def test_iterdir_lists_through_sync(server_backend, tree):
+    entries = {entry.name: entry for batch in server_backend.iterdir(DEVICE, str(tree)) for entry in batch}
+    assert set(entries) == {'dir', 'small.txt', 'huge.bin'}
+    assert entries['dir'].is_dir()
+    assert entries['huge.bin'].size == HUGE